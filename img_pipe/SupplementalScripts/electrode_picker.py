@@ -22,16 +22,24 @@ import sys
 #from PyQt4 import QtCore, QtGui
 import matplotlib.patches as mpatches
 import scipy.io
+import scipy.spatial
 import os
 import warnings
+import threading
+from collections import OrderedDict
 from PyQt4.QtGui import *
 from PyQt4.QtCore import *
 from matplotlib.widgets import Slider
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from volume_io import Volume
+import electrode_candidates
 
 warnings.filterwarnings('ignore')
 
+# Size (voxels a side) of the volumes shown while the full resolution ones load
+PREVIEW_SIZE = 96
+
 class inputdialog(QWidget):
     def __init__(self, parent = None):
         super(inputdialog, self).__init__(parent)
@@ -54,6 +62,8 @@ class electrode_picker:
 
     Usage: 
         python electrode_picker.py '/usr/local/freesurfer/subjects/S1' 'rh'
+        python electrode_picker.py '/usr/local/freesurfer/subjects/S1' 'rh' 3
+    where the optional last argument is the snap radius (default 5 voxels)
 
     This assumes that you have processed your data using freesurfer's pipeline
     and that you have a coregistered MRI and CT in subj_dir (e.g. '/usr/local/freesurfer/subjects/S1')
@@ -62,7 +72,7 @@ class electrode_picker:
     Written by Liberty Hamilton, 2017
 
     '''
-    def __init__(self, subj_dir, hem):
+    def __init__(self, subj_dir, hem, snap_radius=5.):
         '''
         Initialize the electrode picker with the user-defined MRI and co-registered
         CT scan in [subj_dir].  Images will be displayed using orientation information 
@@ -78,6 +88,9 @@ class electrode_picker:
             Path to freesurfer subjects
         hem : {'lh', 'rh', 'stereo'}
             Hemisphere of implantation.
+        snap_radius : float
+            Largest distance (in voxels) to snap an added electrode to a
+            candidate electrode over
 
         Attributes
         ----------
@@ -89,6 +102,8 @@ class electrode_picker:
             Data from brain.mgz T1 MRI scan
         ct : nibabel image
             Data from rCT.nii registered CT scan
+        pial_fill : str
+            Filled pial image file (made with mris_fill if it does not exist)
         pial_img : nibabel image
             Filled pial image
         affine : array-like
@@ -104,10 +119,35 @@ class electrode_picker:
             1st and 99th percentile of the image data (for color scaling)
         pial_codes : orientation codes for pial 
         ct_codes : orientation codes for CT
-        elec_data : array-like
-            Mask for the electrodes
-        bin_mat : array-like
-            Temporary mask for populating elec_data
+        ct_data : array-like
+            CT in its stored type, resampled to [256,256,256]
+        ct_threshold : float
+            CT voxels below this value are not displayed
+        loader : threading.Thread
+            Background thread preparing the full resolution volumes, or None
+            once they are displayed
+        loaded : tuple
+            Full resolution volumes from [loader], until they are displayed
+        snap_on : bool
+            Whether added electrodes snap to the nearest candidate electrode
+        snap_radius : float
+            Largest distance (in voxels) to snap an electrode over
+        candidates : dict
+            Candidate electrodes found in the CT (see electrode_candidates),
+            None until they are loaded
+        candidate_coords : array-like
+            Viewer coordinates of the candidates
+        candidate_tree : scipy.spatial.cKDTree
+            Spatial index of [candidate_coords]
+        img_data : array-like
+            uint8 MRI, resampled to [256,256,256]
+        elec_voxels : dict
+            Color index of each voxel (as a tuple of ints) painted with an electrode
+        elec_slices : list of dict
+            For each axis, the painted voxels in each slice along it
+        bin_mat : dict
+            Voxels painted for the last electrode added, with the values they
+            replaced (None if unpainted), so it can be removed
         device_num : int
             Number of current device that has been added
         device_name : str
@@ -160,14 +200,10 @@ class electrode_picker:
         if hem == 'stereo':
             hem = 'lh' # For now, set to lh because hemisphere isn't used in stereo case
         self.hem = hem
-        self.img = nib.load(os.path.join(subj_dir, 'mri', 'brain.mgz'))
-        self.ct = nib.load(os.path.join(subj_dir, 'CT', 'rCT.nii'))
-        pial_fill = os.path.join(subj_dir, 'surf', '%s.pial.filled.mgz'%(self.hem))
-        if not os.path.isfile(pial_fill):
-            pial_surf = os.path.join(subj_dir, 'surf', '%s.pial'%(self.hem))
-            mris_fill = os.path.join(os.environ['FREESURFER_HOME'], 'bin', 'mris_fill')
-            os.system('%s -c -r 1 %s %s'%(mris_fill, pial_surf, pial_fill))
-        self.pial_img = nib.load(pial_fill)
+        self.img = Volume(os.path.join(subj_dir, 'mri', 'brain.mgz'))
+        self.ct = Volume(os.path.join(subj_dir, 'CT', 'rCT.nii'))
+        self.pial_fill = os.path.join(subj_dir, 'surf', '%s.pial.filled.mgz'%(self.hem))
+        self.pial_img = None
 
         #self.slider = QSlider(Qt.Horizontal)
         
@@ -178,47 +214,41 @@ class electrode_picker:
                                    [0., -1., 0., 128.], 
                                    [0., 0., 0., 1.]])
         
-        # Apply orientation to the MRI so that the order of the dimensions will be
-        # sagittal, coronal, axial
+        # Orientation codes to put the dimensions of the MRI and the CT in the
+        # order sagittal, coronal, axial
         self.codes = nib.orientations.axcodes2ornt(nib.orientations.aff2axcodes(self.affine))
-        img_data = nib.orientations.apply_orientation(self.img.get_data(), self.codes)
+        self.ct_codes =nib.orientations.axcodes2ornt(nib.orientations.aff2axcodes(self.ct.affine))
         self.voxel_sizes = nib.affines.voxel_sizes(self.affine)
-        nx,ny,nz = np.array(img_data.shape, dtype='float')
 
         self.inv_affine = np.linalg.inv(self.affine)
-        self.img_clim = np.percentile(img_data, (1., 99.))
 
-        # Apply orientation to pial surface fill
-        self.pial_codes = nib.orientations.axcodes2ornt(nib.orientations.aff2axcodes(self.pial_img.affine))
-        pial_data = nib.orientations.apply_orientation(self.pial_img.get_data(), self.pial_codes)
-        pial_data = scipy.ndimage.binary_closing(pial_data)
+        # Threshold the CT so only bright objects (electrodes) are visible. The
+        # CT is kept in its own type and voxels below the threshold are masked
+        # when a slice is displayed (see get_ct_slice)
+        self.ct_threshold = 1000
+
+        # Volumes resampled by an earlier session are loaded from disk. Otherwise
+        # the window opens with a quick preview of the volumes, and the fully
+        # resampled volumes are made in a background thread and swapped in when
+        # they are ready (see check_loader)
+        self.loader = None
+        self.loaded = None
+        volumes = self.load_cached_volumes()
+        if volumes is None:
+            volumes = self.prepare_volumes(preview=True)
+            self.loader = threading.Thread(target=self.load_volumes)
+            self.loader.daemon = True
+            self.loader.start()
+        img_data, ct_data, pial_data = volumes
 
-        # Apply orientation to the CT so that the order of the dimensions will be
-        # sagittal, coronal, axial
-        self.ct_codes =nib.orientations.axcodes2ornt(nib.orientations.aff2axcodes(self.ct.affine))
-        ct_data = nib.orientations.apply_orientation(self.ct.get_data(), self.ct_codes)
-
-        cx,cy,cz=np.array(ct_data.shape, dtype='float')       
-
-        # Resample both images to the highest resolution
-        voxsz = (256, 256, 256)
-        if ct_data.shape != voxsz:
-            print("Resizing voxels in CT")
-            ct_data = scipy.ndimage.zoom(ct_data, [voxsz[0]/cx, voxsz[1]/cy, voxsz[2]/cz])
-            print(ct_data.shape)
-        if self.img.shape != voxsz:
-            print("Resizing voxels in MRI")
-            img_data = scipy.ndimage.zoom(img_data, [voxsz[0]/nx, voxsz[1]/ny, voxsz[2]/nz])
-            print(img_data.shape)
-        
-        # Threshold the CT so only bright objects (electrodes) are visible
-        ct_data[ct_data < 1000] = np.nan
+        self.img_clim = np.percentile(img_data, (1., 99.))
 
         self.ct_data = ct_data
         self.img_data = img_data
         self.pial_data = pial_data
-        self.elec_data = np.nan+np.zeros((img_data.shape))
-        self.bin_mat = '' # binary mask for electrodes
+        self.elec_voxels = dict() # electrode voxels and their colors
+        self.elec_slices = [dict(), dict(), dict()] # electrode voxels by slice
+        self.bin_mat = dict() # voxels of the last electrode added
         self.device_num = 0 # Start with device 0, increment when we add a new electrode name type
         self.device_name = ''
         self.devices = [] # This will be a list of the devices (grids, strips, depths)
@@ -229,6 +259,17 @@ class electrode_picker:
 
         self.imsz = [256, 256, 256]
         self.ctsz = [256, 256, 256]
+
+        # Candidate electrodes in the CT, loaded (or detected the first time
+        # the CT is opened) in the background
+        self.snap_on = True
+        self.snap_radius = snap_radius
+        self.candidates = None
+        self.candidate_coords = None
+        self.candidate_tree = None
+        candidate_loader = threading.Thread(target=self.load_candidates)
+        candidate_loader.daemon = True
+        candidate_loader.start()
         
         self.current_slice = np.array([self.imsz[0]/2, self.imsz[1]/2, self.imsz[2]/2], dtype=np.float)
         
@@ -254,6 +295,21 @@ class electrode_picker:
 
         self.ax = []
         self.contour = [False, False, False]
+
+        # Pial contours of recently shown slices in each view, by slice index
+        # (None where the slice does not cut the pial surface). Contours are
+        # hidden rather than removed when the slice changes, so scrolling back
+        # and forth does not recompute them (see show_contour).
+        self._contours = [OrderedDict(), OrderedDict(), OrderedDict()]
+
+        # CT maximum intensity projections, by (axis, slice index)
+        self._mips = OrderedDict()
+
+        # What each view currently shows, so update_figure_data only redraws
+        # views that changed. _elec_version is incremented whenever an
+        # electrode is added or removed.
+        self._view_keys = [None, None, None, None]
+        self._elec_version = 0
         self.pial_surf_on = True # Whether pial surface is visible or not
         self.T1_on = True # Whether T1 is visible or not
         
@@ -264,35 +320,23 @@ class electrode_picker:
         for i in np.arange(3):
             self.ax.append(self.fig.add_subplot(2,2,i+1))
             self.ax[i].set_axis_bgcolor('k')
-            if i==0:
-                imdata = img_data[cs[0],:,:].T
-                ctdat  = ct_data[cs[0],:,:].T
-                edat   = self.elec_data[cs[0],:,:].T
-                pdat   = self.pial_data[cs[0],:,:].T
-            elif i==1:
-                imdata = img_data[:,cs[1],:].T
-                ctdat  = ct_data[:,cs[1],:].T
-                edat   = self.elec_data[:,cs[1],:].T
-                pdat   = self.pial_data[:,cs[1],:].T
-            elif i==2:
-                imdata = img_data[:,:,cs[2]].T
-                ctdat  = ct_data[:,:,cs[2]].T
-                edat   = self.elec_data[:,:,cs[2]].T
-                pdat   = self.pial_data[:,:,cs[2]].T
+            imdata = self.get_slice(self.img_data, i, cs[i])
+            ctdat = self.get_ct_slice(i, cs[i])
+            edat = self.get_elec_slice(i, cs[i])
 
             # Show the MRI data in grayscale
-            self.im.append(plt.imshow(imdata, cmap=cm.gray, aspect='auto'))
+            self.im.append(plt.imshow(imdata, cmap=cm.gray, aspect='auto', extent=self.display_extent()))
 
             # Overlay the CT on top in "hot" colormap, slightly transparent
-            self.ct_im.append(plt.imshow(ctdat, cmap=cm.hot, aspect='auto',alpha=0.5, vmin=1000, vmax=3000))
+            self.ct_im.append(plt.imshow(ctdat, cmap=cm.hot, aspect='auto',alpha=0.5, vmin=1000, vmax=3000, extent=self.display_extent()))
             
-            # Overlay the electrodes image on top (starts as NaNs, is eventually filled in)
+            # Overlay the electrodes image on top (starts empty, is eventually filled in)
             self.elec_colors = mcolors.LinearSegmentedColormap.from_list('elec_colors', np.vstack (( cm.Set1(np.linspace(0., 1, 9)), cm.Set2(np.linspace(0., 1, 8)) )) )
             self.elec_im.append(plt.imshow(edat, cmap=self.elec_colors, aspect='auto', alpha=1, vmin=0, vmax=17))
             
             # Overlay the pial surface
-            self.pial_im.append(self.ax[i].contour(pdat, linewidths=0.5, colors = 'y'))
-            self.contour[i] = True
+            self.pial_im.append(None)
+            self.show_contour(i, cs[i])
 
             # Plot a green cursor
             self.cursor.append(plt.plot([cs[1], cs[1]], [self.ax[i].get_ylim()[0]+1, self.ax[i].get_ylim()[1]-1], color=[0, 1, 0] ))
@@ -314,7 +358,7 @@ class electrode_picker:
         self.ct_slice = 's' # Show sagittal MIP to start
         self.ax.append(self.fig.add_subplot(2,2,4))
         self.ax[3].set_axis_bgcolor('k')
-        self.im.append(plt.imshow(np.nanmax(ct_data[cs[0]-15:cs[0]+15,:,:], axis=0).T, cmap=cm.gray, aspect='auto'))
+        self.im.append(plt.imshow(self.get_mip(0, cs[0]), cmap=cm.gray, aspect='auto', extent=self.display_extent()))
         self.cursor.append(plt.plot([cs[1], cs[1]], [self.ax[3].get_ylim()[0]+1, self.ax[3].get_ylim()[1]-1], color=[0, 1, 0] ))
         self.cursor2.append(plt.plot([self.ax[3].get_xlim()[0]+1, self.ax[3].get_xlim()[1]-1], [cs[2], cs[2]], color=[0, 1, 0] ))
         self.ax[3].set_xticks([])
@@ -322,7 +366,7 @@ class electrode_picker:
         plt.gca().invert_yaxis()
         self.ax[3].axis([0,self.imsz[1],0,self.imsz[2]])
 
-        self.elec_im.append(plt.imshow(self.elec_data[cs[0],:,:].T, cmap=self.elec_colors, aspect='auto', alpha=1, vmin=0, vmax=17))
+        self.elec_im.append(plt.imshow(self.get_elec_slice(0, cs[0]), cmap=self.elec_colors, aspect='auto', alpha=1, vmin=0, vmax=17))
         plt.gcf().suptitle("Press 'n' to enter device name, press 'e' to add an electrode at crosshair, press 'h' for more options", fontsize=14)
 
         plt.tight_layout()
@@ -341,10 +385,15 @@ class electrode_picker:
         ct_slider_ax = plt.axes([self.ax[1].get_position().bounds[0]+0.06, 
                       self.ax[1].get_position().bounds[1]+0.42, 
                       self.ax[1].get_position().bounds[2]-0.1, 0.02])
-        print(np.nanmax(ct_data))
-        self.ct_slider = Slider(ct_slider_ax, 'CT max', 1000, np.nanmax(ct_data), facecolor=[0.8, 0.1, 0.1])
+        print(ct_data.max())
+        self.ct_slider = Slider(ct_slider_ax, 'CT max', self.ct_threshold, ct_data.max(), facecolor=[0.8, 0.1, 0.1])
         self.ct_slider.on_changed(self.update_ct)
 
+        if self.loader is not None:
+            self.load_timer = self.fig.canvas.new_timer(interval=500)
+            self.load_timer.add_callback(self.check_loader)
+            self.load_timer.start()
+
         plt.show()
         self.fig.canvas.draw()
 
@@ -357,6 +406,7 @@ class electrode_picker:
         n: enter the name of a new device (e.g. 'frontalgrid','hippocampaldepth')
         e: insert an electrode at the current green crosshair position
         u: remove electrode at the current crosshair position (can be thought of like "undo")
+        m: toggle snapping added electrodes to the nearest electrode candidate found in the CT
 
         Views:
         ----
@@ -397,6 +447,11 @@ class electrode_picker:
             # Toggle T1 scan on and off
             self.T1_on = not self.T1_on
 
+        if event.key == 'm':
+            # Toggle snapping to electrode candidates on and off
+            self.snap_on = not self.snap_on
+            plt.gcf().suptitle("Snapping to electrode candidates %s"%('on' if self.snap_on else 'off'), fontsize=14)
+
         if event.key == 'n':
             plt.gcf().suptitle("Enter device name in pop-up dialog", fontsize=14)
             plt.gcf().canvas.draw()
@@ -434,7 +489,7 @@ class electrode_picker:
 
         if event.key == 'h':
             # Show help 
-            plt.gcf().suptitle("Help: 'n': name device, 'e': add electrode, 'u': remove electrode, 't': toggle pial, 'b': toggle brain, '3': show 3D view\nMaximum intensity projection views: 's': sagittal, 'c': coronal, 'a': axial\nScroll to zoom, arrows to pan, pgup/pgdown or click to go to slice", fontsize=12, y=1.0)
+            plt.gcf().suptitle("Help: 'n': name device, 'e': add electrode, 'u': remove electrode, 'm': toggle snapping, 't': toggle pial, 'b': toggle brain, '3': show 3D view\nMaximum intensity projection views: 's': sagittal, 'c': coronal, 'a': axial\nScroll to zoom, arrows to pan, pgup/pgdown or click to go to slice", fontsize=12, y=1.0)
 
         if event.key == 'e':
             if self.device_name == '':
@@ -585,75 +640,46 @@ class electrode_picker:
         '''
         cs = np.round(self.current_slice).astype(np.int) # Make integer for indexing the volume
 
-        self.im[0].set_data(self.img_data[cs[0],:,:].T)
-        self.im[1].set_data(self.img_data[:,cs[1],:].T)
-        self.im[2].set_data(self.img_data[:,:,cs[2]].T)
-
-        # Show the maximum intensity projection for +/- 15 slices
-        # Sagittal view
-        if self.ct_slice == 's':
-            self.im[3].set_data(np.nanmax(self.ct_data[cs[0]-15:cs[0]+15,:,:], axis=0).T)
-        # Coronal view
-        elif self.ct_slice == 'c':
-            self.im[3].set_data(np.nanmax(self.ct_data[:,cs[1]-15:cs[1]+15,:], axis=1).T)
-        # Axial view
-        elif self.ct_slice == 'a':
-            self.im[3].set_data(np.nanmax(self.ct_data[:,:,cs[2]-15:cs[2]+15], axis=2).T)
-
-        # Show the CT data in the sagittal, coronal, and axial views
-        self.ct_im[0].set_data(self.ct_data[cs[0],:,:].T)
-        self.ct_im[1].set_data(self.ct_data[:,cs[1],:].T)
-        self.ct_im[2].set_data(self.ct_data[:,:,cs[2]].T)
-
-        # Show the pial surface data in the sagittal, coronal, and axial views
+        # Sagittal (0), coronal (1), and axial (2) views: MRI, CT, pial surface
+        # outline and electrodes at the current slice, redrawn only if the slice
+        # or what is displayed has changed
         for a in np.arange(3):
-            if self.contour[a]:
-                try:
-                    for coll in self.pial_im[a].collections:
-                        coll.remove()
-                except:
-                    pass
-        
-        if self.pial_surf_on:
-            if np.any(self.pial_data[cs[0],:,:]):
-                self.pial_im[0] = self.ax[0].contour(self.pial_data[cs[0],:,:].T, linewidths=0.5, colors = 'y')
-                self.contour[0] = True
-            else:
-                self.contour[0] = False
-            if np.any(self.pial_data[:,cs[1],:]):
-                self.pial_im[1] = self.ax[1].contour(self.pial_data[:,cs[1],:].T, linewidths=0.5, colors = 'y')
-                self.contour[1] = True
+            key = (cs[a], self.T1_on, self.pial_surf_on, self._elec_version)
+            if key == self._view_keys[a]:
+                continue
+            self._view_keys[a] = key
+
+            # Turn off T1 image if toggled  
+            imdata = self.get_slice(self.img_data, a, cs[a])
+            if self.T1_on:
+                self.im[a].set_data(imdata)
             else:
-                self.contour[1] = False
-            if np.any(self.pial_data[:,:,cs[2]]):
-                self.pial_im[2] = self.ax[2].contour(self.pial_data[:,:,cs[2]].T, linewidths=0.5, colors = 'y')
-                self.contour[2] = True
+                self.im[a].set_data(np.zeros(imdata.shape))
+            self.ct_im[a].set_data(self.get_ct_slice(a, cs[a]))
+            self.elec_im[a].set_data(self.get_elec_slice(a, cs[a]))
+            if self.pial_surf_on:
+                self.show_contour(a, cs[a])
             else:
-                self.contour[2] = False
-            # Turn off T1 image if toggled  
-        if not self.T1_on:
-            self.im[0].set_data(np.zeros((self.img_data.shape[1], self.img_data.shape[2])))
-            self.im[1].set_data(np.zeros((self.img_data.shape[0], self.img_data.shape[2])))
-            self.im[2].set_data(np.zeros((self.img_data.shape[0], self.img_data.shape[1])))
-        
-        # Show the electrode volume data in the sagittal, coronal, and axial views
-        self.elec_im[0].set_data(self.elec_data[cs[0],:,:].T)
-        self.elec_im[1].set_data(self.elec_data[:,cs[1],:].T)
-        self.elec_im[2].set_data(self.elec_data[:,:,cs[2]].T)
-
-        # Slow the electrodes on the maximum intensity projection, 
-        # make sure the correct slices are shown based on which orientation
+                self.show_contour(a, None)
+
+        # Show the maximum intensity projection for +/- 15 slices, and the
+        # electrodes on it, in the sagittal, coronal or axial orientation
+        ct_axis = {'s': 0, 'c': 1, 'a': 2}[self.ct_slice]
+        key = (self.ct_slice, cs[ct_axis], self._elec_version)
+        if key != self._view_keys[3]:
+            self._view_keys[3] = key
+            self.im[3].set_data(self.get_mip(ct_axis, cs[ct_axis]))
+            self.elec_im[3].set_data(self.get_elec_slice(ct_axis, cs[ct_axis]))
+
+        # Make sure the correct crosshairs are shown based on which orientation
         # we're using
         if self.ct_slice == 's':
-            self.elec_im[3].set_data(self.elec_data[cs[0],:,:].T)
             self.cursor[3][0].set_xdata ([self.current_slice[1], self.current_slice[1]]) 
             self.cursor2[3][0].set_ydata([self.current_slice[2], self.current_slice[2]])
         elif self.ct_slice == 'c':
-            self.elec_im[3].set_data(self.elec_data[:,cs[1],:].T)
             self.cursor[3][0].set_xdata ([self.current_slice[0], self.current_slice[0]]) 
             self.cursor2[3][0].set_ydata([self.current_slice[2], self.current_slice[2]])
         elif self.ct_slice == 'a':
-            self.elec_im[3].set_data(self.elec_data[:,:,cs[2]].T)
             self.cursor[3][0].set_xdata ([self.current_slice[0], self.current_slice[0]]) 
             self.cursor2[3][0].set_ydata([self.current_slice[1], self.current_slice[1]])
 
@@ -691,36 +717,337 @@ class electrode_picker:
             current_RAS = self.slice_to_surfaceRAS()
             self.ax[3].set_xlabel('Surface RAS = [%3.3f, %3.3f, %3.3f]'%(current_RAS[0], current_RAS[1], current_RAS[2]), fontsize=14)
 
+    def open_pial(self):
+        ''' Open the filled pial surface image and get its orientation codes.'''
+        self.pial_img = Volume(self.pial_fill, segmentation=True)
+        self.pial_codes = nib.orientations.axcodes2ornt(nib.orientations.aff2axcodes(self.pial_img.affine))
+
+    def prepare_volumes(self, preview=False):
+        '''
+        Orient the MRI, CT and filled pial surface so that the order of the
+        dimensions is sagittal, coronal, axial, and resample the MRI and CT to
+        [256,256,256] for display.
+
+        Parameters
+        ----------
+        preview : bool
+            Make a quick preview instead: nearest neighbor resampling to
+            [PREVIEW_SIZE] voxels a side (so only those voxels of rCT.nii
+            are read), no smoothing of the pial fill, and no pial fill at
+            all if it has not been made yet (instead of running mris_fill)
+
+        Returns
+        -------
+        img_data : array-like
+            uint8 MRI
+        ct_data : array-like
+            CT in its stored type (float64 is narrowed to float32)
+        pial_data : array-like
+            Filled pial surface as bool
+        '''
+        voxsz = (256, 256, 256)
+        img_data = nib.orientations.apply_orientation(self.img.get_data(), self.codes)
+        ct_data = nib.orientations.apply_orientation(self.ct.get_data(), self.ct_codes)
+
+        # Resample both images to the highest resolution
+        if preview:
+            voxsz = (PREVIEW_SIZE, PREVIEW_SIZE, PREVIEW_SIZE)
+            img_data = _nearest_resample(img_data, voxsz)
+            ct_data = _nearest_resample(ct_data, voxsz)
+        if ct_data.dtype == np.float64:
+            # Scaled images are read as float64, which the CT does not need
+            ct_data = ct_data.astype(np.float32)
+        if ct_data.shape != voxsz:
+            print("Resizing voxels in CT")
+            cx,cy,cz=np.array(ct_data.shape, dtype='float')
+            ct_data = scipy.ndimage.zoom(ct_data, [voxsz[0]/cx, voxsz[1]/cy, voxsz[2]/cz])
+            print(ct_data.shape)
+        if img_data.shape != voxsz:
+            print("Resizing voxels in MRI")
+            nx,ny,nz = np.array(img_data.shape, dtype='float')
+            img_data = scipy.ndimage.zoom(img_data, [voxsz[0]/nx, voxsz[1]/ny, voxsz[2]/nz])
+            print(img_data.shape)
+        img_data = _to_uint8(img_data)
+
+        # Apply orientation to pial surface fill
+        if not os.path.isfile(self.pial_fill):
+            if preview:
+                return img_data, ct_data, np.zeros(voxsz, dtype=bool)
+            pial_surf = os.path.join(self.subj_dir, 'surf', '%s.pial'%(self.hem))
+            mris_fill = os.path.join(os.environ['FREESURFER_HOME'], 'bin', 'mris_fill')
+            os.system('%s -c -r 1 %s %s'%(mris_fill, pial_surf, self.pial_fill))
+        self.open_pial()
+        pial_data = nib.orientations.apply_orientation(self.pial_img.get_data(), self.pial_codes)
+        if preview:
+            pial_data = _nearest_resample(pial_data, voxsz) > 0
+        else:
+            pial_data = scipy.ndimage.binary_closing(pial_data)
+        return img_data, ct_data, pial_data
+
+    def volume_cache_files(self):
+        ''' Files the resampled volumes are cached in (in [subj_dir]/CT), each
+        with the image it is made from.'''
+        ct_dir = os.path.join(self.subj_dir, 'CT')
+        return [(os.path.join(ct_dir, 'picker_brain.npy'), self.img.fname),
+                (os.path.join(ct_dir, 'picker_rCT.npy'), self.ct.fname),
+                (os.path.join(ct_dir, 'picker_%s_pial.npy'%(self.hem)), self.pial_fill)]
+
+    def load_cached_volumes(self):
+        '''
+        Load the volumes made by prepare_volumes in an earlier session, if none
+        of the images they are made from has changed since.
+
+        Returns
+        -------
+        volumes : tuple
+            (img_data, ct_data, pial_data) memory-mapped from the cache files,
+            or None if any of them is missing or out of date
+        '''
+        volumes = []
+        for cache_file, source_file in self.volume_cache_files():
+            if not os.path.isfile(cache_file) or not os.path.isfile(source_file) or \
+               os.path.getmtime(cache_file) < os.path.getmtime(source_file):
+                return None
+            volumes.append(np.load(cache_file, mmap_mode='r'))
+        print("Loading resampled volumes from %s"%(os.path.join(self.subj_dir, 'CT')))
+        self.open_pial()
+        return tuple(volumes)
+
+    def save_cached_volumes(self, volumes):
+        ''' Save the volumes made by prepare_volumes for later sessions.'''
+        for (cache_file, source_file), data in zip(self.volume_cache_files(), volumes):
+            # Write to a temporary file first so a later session never loads a partial file
+            tmp_file = '%s.%d.tmp'%(cache_file, os.getpid())
+            try:
+                with open(tmp_file, 'wb') as f:
+                    np.save(f, data)
+                if os.path.isfile(cache_file):
+                    os.remove(cache_file)
+                os.rename(tmp_file, cache_file)
+            except (IOError, OSError) as e:
+                print("Could not save %s: %s"%(cache_file, e))
+
+    def load_volumes(self):
+        ''' Make the full resolution volumes and cache them on disk. This runs
+        in a background thread, and check_loader displays the volumes.'''
+        try:
+            volumes = self.prepare_volumes()
+        except Exception as e:
+            print("Could not resample the volumes, keeping the preview: %s"%(e))
+            return
+        self.save_cached_volumes(volumes)
+        self.loaded = volumes
+
+    def check_loader(self):
+        ''' Display the full resolution volumes once the background thread has
+        made them (called periodically by a timer on the figure).'''
+        if self.loader is None or self.loader.is_alive():
+            return
+        self.loader = None
+        self.load_timer.stop()
+        if self.loaded is None:
+            return
+        self.img_data, self.ct_data, self.pial_data = self.loaded
+        self.loaded = None
+        self.img_clim = np.percentile(self.img_data, (1., 99.))
+
+        # Drop everything drawn from the preview volumes
+        for im in self.im + self.ct_im[:3]:
+            im.set_extent(self.display_extent())
+        for a in np.arange(3):
+            for cset in self._contours[a].values():
+                if cset is not None:
+                    _remove_contour(cset)
+            self._contours[a] = OrderedDict()
+            self.pial_im[a] = None
+            self.contour[a] = False
+        self._mips.clear()
+        self._view_keys = [None, None, None, None]
+        self.update_figure_data()
+        self.fig.canvas.draw_idle()
+
+    def get_mip(self, axis, index, max_cached=64):
+        '''
+        Maximum intensity projection of the CT over the 30 slices around a slice,
+        as displayed (transposed). Projections are cached, so scrolling back and
+        forth does not recompute them.
+
+        Parameters
+        ----------
+        axis : int
+            Axis to project along (0: sagittal, 1: coronal, 2: axial)
+        index : int
+            Slice index along [axis]
+        max_cached : int
+            Number of projections to keep
+
+        Returns
+        -------
+        mip : array-like
+            2D maximum intensity projection
+        '''
+        key = (axis, index)
+        if key in self._mips:
+            mip = self._mips.pop(key)
+        else:
+            # 15 viewer slices either side, in slices of the (preview) volume
+            center = self.data_index(axis, index)
+            half = max(1, int(np.round(15*(self.ct_data.shape[axis]-1.)/(self.imsz[axis]-1))))
+            slab = [slice(None)]*3
+            slab[axis] = slice(max(center-half, 0), center+half)
+            # The maximum is below the threshold only where all voxels are
+            mip = np.ma.masked_less(self.ct_data[tuple(slab)].max(axis=axis).T, self.ct_threshold)
+        # Most recently used last
+        self._mips[key] = mip
+        while len(self._mips) > max_cached:
+            self._mips.popitem(last=False)
+        return mip
+
+    def get_ct_slice(self, axis, index):
+        '''
+        A slice of the CT as displayed (transposed), with the voxels below
+        [ct_threshold] masked.
+
+        Parameters
+        ----------
+        axis : int
+            Axis to slice (0: sagittal, 1: coronal, 2: axial)
+        index : int
+            Slice index along [axis]
+
+        Returns
+        -------
+        ctdat : masked array
+        '''
+        return np.ma.masked_less(self.get_slice(self.ct_data, axis, index), self.ct_threshold)
+
+    def data_index(self, axis, index):
+        ''' Index into the volumes of viewer slice [index] along [axis]. The
+        preview volumes have fewer slices than the viewer.'''
+        return int(np.round(index*(self.img_data.shape[axis]-1.)/(self.imsz[axis]-1)))
+
+    def get_slice(self, data, axis, index):
+        '''
+        A slice of one of the volumes (img_data, ct_data or pial_data) at
+        viewer slice [index] along [axis], as displayed (transposed).
+        '''
+        vslice = [slice(None)]*3
+        vslice[axis] = self.data_index(axis, index)
+        return data[tuple(vslice)].T
+
+    def display_extent(self):
+        ''' Extent of the volume images in viewer coordinates, so the preview
+        volumes cover the same area as the full resolution ones.'''
+        step = (self.imsz[0]-1.)/(self.img_data.shape[0]-1)
+        return (-0.5*step, self.imsz[0]-1+0.5*step, self.imsz[0]-1+0.5*step, -0.5*step)
+
+    def get_elec_slice(self, axis, index):
+        '''
+        A slice of the electrode overlay as displayed (transposed): the color
+        index of each electrode voxel in the slice and NaN elsewhere.
+
+        Parameters
+        ----------
+        axis : int
+            Axis to slice (0: sagittal, 1: coronal, 2: axial)
+        index : int
+            Slice index along [axis]
+
+        Returns
+        -------
+        edat : array-like
+        '''
+        other = [i for i in range(3) if i != axis]
+        edat = np.nan + np.zeros((self.imsz[other[0]], self.imsz[other[1]]), dtype=np.float32)
+        for vox in self.elec_slices[axis].get(index, ()):
+            edat[vox[other[0]], vox[other[1]]] = self.elec_voxels[vox]
+        return edat.T
+
+    def set_elec_voxel(self, vox, value):
+        '''
+        Paint voxel [vox] (a tuple of ints) with electrode color index [value],
+        or clear it if [value] is None.
+        '''
+        if value is None:
+            if self.elec_voxels.pop(vox, None) is not None:
+                for axis in range(3):
+                    self.elec_slices[axis][vox[axis]].discard(vox)
+        else:
+            self.elec_voxels[vox] = value
+            for axis in range(3):
+                self.elec_slices[axis].setdefault(vox[axis], set()).add(vox)
+
+    def show_contour(self, a, index, max_cached=16):
+        '''
+        Show the pial surface outline of slice [index] in view [a] (0: sagittal,
+        1: coronal, 2: axial), or no outline if [index] is None. The outlines
+        of the last [max_cached] slices shown in each view are kept (hidden)
+        on the axes, and older ones are removed.
+        '''
+        if self.pial_im[a] is not None:
+            _set_contour_visible(self.pial_im[a], False)
+        self.pial_im[a] = None
+        self.contour[a] = False
+        if index is None:
+            return
+
+        contours = self._contours[a]
+        if index in contours:
+            cset = contours.pop(index)
+        else:
+            pdat = self.get_slice(self.pial_data, a, index)
+            if np.any(pdat):
+                # Viewer coordinates of the (preview) volume's voxels
+                step = (self.imsz[0]-1.)/(self.pial_data.shape[0]-1)
+                x = np.arange(pdat.shape[1])*step
+                y = np.arange(pdat.shape[0])*step
+                cset = self.ax[a].contour(x, y, pdat, linewidths=0.5, colors = 'y')
+            else:
+                cset = None
+        # Most recently used last
+        contours[index] = cset
+        while len(contours) > max_cached:
+            _, old_cset = contours.popitem(last=False)
+            if old_cset is not None:
+                _remove_contour(old_cset)
+
+        if cset is not None:
+            _set_contour_visible(cset, True)
+            self.pial_im[a] = cset
+            self.contour[a] = True
+
     def add_electrode(self, add_to_file = True):
         '''
         Add an electrode at the current crosshair point. 
         '''
 
+        # Move to the electrode candidate the user is pointing at
+        if add_to_file and self.snap_on:
+            self.snap_to_candidate()
+
         # Make the current slice into an integer for indexing the volume
 
         cs = np.round(self.current_slice).astype(np.int) 
 
-        # Create a sphere centered around the current point as a binary matrix
+        # Find the voxels of a sphere centered around the current point
         radius = 2
         r2 = np.arange(-radius, radius+1)**2
         dist2 = r2[:,None,None]+r2[:,None]+r2
-        bin_mat = np.array(dist2<=radius**2, dtype=np.float)
-        bin_mat[bin_mat==0] = np.nan
+        sphere = cs + np.argwhere(dist2<=radius**2) - radius
+        # Leave out the voxels past the edges of the volume
+        sphere = sphere[np.all((sphere >= 0) & (sphere < np.array(self.imsz)), axis=1)]
         
-        # The sphere part of the binary matrix will have a value that
-        # increments with device number so that different devices
-        # will show up in different colors
-        bin_mat = bin_mat+self.device_num-2
-        self.bin_mat = bin_mat
+        # The sphere will have a value that increments with device number
+        # so that different devices will show up in different colors
+        value = self.device_num-1
         
-        # Set the electrode data volume for this bounding box (add the
-        # sphere to the electrode "volume" so it shows up in the brain
-        # plots)
-        self.elec_data[cs[0]-radius:cs[0]+radius+1, cs[1]-radius:cs[1]+radius+1, cs[2]-radius:cs[2]+radius+1] = bin_mat
-
-        self.elec_im[0].set_data(self.elec_data[cs[0],:,:].T)
-        self.elec_im[0].set_data(self.elec_data[:,cs[1],:].T)
-        self.elec_im[0].set_data(self.elec_data[:,:,cs[2]].T)
+        # Paint the sphere into the electrode voxels so it shows up in the
+        # brain plots, remembering what it replaced so it can be removed
+        self.bin_mat = dict()
+        for vox in sphere:
+            vox = tuple([int(v) for v in vox])
+            self.bin_mat[vox] = self.elec_voxels.get(vox)
+            self.set_elec_voxel(vox, value)
 
         # As displayed, these coordinates are LSP, and we want RAS,
         # so we do that here
@@ -743,16 +1070,51 @@ class electrode_picker:
         
         self.elec_num[self.device_name] += 1
         self.elec_added = True
+        self._elec_version += 1
         #print("Voxel CRS: %3.3f, %3.3f, %3.3f"%(self.current_slice[0], self.current_slice[1], self.current_slice[2]))
         #print("RAS coordinate: %3.3f, %3.3f, %3.3f"%(elec[0], elec[1], elec[2]))
 
+    def load_candidates(self):
+        ''' Load the candidate electrodes of the CT and index them for snapping
+        (runs in a background thread). Candidates saved by
+        freeCoG.detect_electrode_candidates are used whichever parameters they
+        were detected with; otherwise they are detected at [ct_threshold].'''
+        try:
+            candidates = electrode_candidates.load_candidates(self.ct.fname, threshold=self.ct_threshold,
+                                                              any_params=True)
+        except Exception as e:
+            print("Could not load electrode candidates: %s"%(e))
+            return
+        coords = self.RAS_to_slice(candidates['ras'])
+        self.candidates = candidates
+        self.candidate_coords = coords
+        if coords.shape[0] > 0:
+            self.candidate_tree = scipy.spatial.cKDTree(coords)
+        print("Found %d electrode candidates in the CT"%(coords.shape[0]))
+
+    def snap_to_candidate(self):
+        '''
+        Move the crosshair to the nearest candidate electrode, if there is one
+        within [snap_radius] voxels.
+
+        Returns
+        -------
+        snapped : bool
+            Whether the crosshair was moved
+        '''
+        if self.candidate_tree is None:
+            return False
+        dist, ind = self.candidate_tree.query(self.current_slice, distance_upper_bound=self.snap_radius)
+        if np.isinf(dist):
+            return False
+        self.current_slice = self.candidate_coords[ind].copy()
+        return True
+
     def remove_electrode(self):
         '''
         Remove the electrode at the current crosshair point. 
         '''
-        cs = self.current_slice
-        if self.bin_mat != '':
-            self.bin_mat = ''
+        if self.bin_mat:
             
             # Remove the electrode from elecmatrix
             self.elecmatrix[self.device_name].pop()
@@ -762,11 +1124,10 @@ class electrode_picker:
             scipy.io.savemat(elecfile, {'elecmatrix': np.array(self.elecmatrix[self.device_name])})
 
             # Remove the electrode from the volume display
-            self.elec_data[cs[0]-radius:cs[0]+radius+1, cs[1]-radius:cs[1]+radius+1, cs[2]-radius:cs[2]+radius+1] = np.nan
-
-            self.elec_im[0].set_data(self.elec_data[cs[0],:,:].T)
-            self.elec_im[0].set_data(self.elec_data[:,cs[1],:].T)
-            self.elec_im[0].set_data(self.elec_data[:,:,cs[2]].T)
+            for vox, val in self.bin_mat.items():
+                self.set_elec_voxel(vox, val)
+            self.bin_mat = dict()
+            self._elec_version += 1
 
     def slice_to_surfaceRAS(self, coord = None):
         '''
@@ -796,6 +1157,26 @@ class electrode_picker:
 
         return elec
 
+    def RAS_to_slice(self, ras):
+        '''
+        Convert scanner RAS coordinates (e.g. from the CT header) to viewer
+        coordinates, the inverse of the conversion in slice_to_surfaceRAS
+
+        Parameters
+        ----------
+        ras : array-like
+            [npoints x 3] scanner RAS coordinates
+
+        Returns
+        -------
+        coords : array-like
+            [npoints x 3] viewer coordinates
+        '''
+        elec_CRS = nib.affines.apply_affine(self.inv_affine, np.asarray(ras, dtype=float).reshape(-1, 3))
+        return np.column_stack((self.imsz[0] - elec_CRS[:,0] - 1.,
+                                elec_CRS[:,2],
+                                self.imsz[2] - elec_CRS[:,1] - 1.))
+
     def surfaceRAS_to_slice(self, elec):
         '''
         Convert surface RAS to coordinate to be used in the viewer
@@ -877,6 +1258,45 @@ class electrode_picker:
             curr_min = 1000
             self.ct_im[i].set_clim([curr_min, val])
 
+def _to_uint8(data, block=16):
+    ''' Rescale a volume to 0-255 as uint8, [block] slices at a time. Volumes
+    that are already uint8 (like FreeSurfer's brain.mgz) are returned as is.'''
+    if data.dtype == np.uint8:
+        return data
+    lo = float(data.min())
+    hi = float(data.max())
+    scale = 255./(hi-lo) if hi > lo else 0.
+    out = np.empty(data.shape, dtype=np.uint8)
+    for i in range(0, data.shape[0], block):
+        out[i:i+block] = np.clip(np.round((data[i:i+block]-lo)*scale), 0, 255)
+    return out
+
+def _nearest_resample(data, shape):
+    ''' Nearest neighbor resampling of a volume to [shape], with the corner
+    voxels aligned as scipy.ndimage.zoom does.'''
+    if data.shape == tuple(shape):
+        return data
+    inds = []
+    for n_in, n_out in zip(data.shape, shape):
+        inds.append(np.round(np.arange(n_out)*(n_in-1.)/max(n_out-1, 1)).astype(int))
+    return np.asarray(data[np.ix_(*inds)])
+
+def _set_contour_visible(cset, visible):
+    ''' Show or hide a matplotlib ContourSet (older matplotlib draws it as a
+    list of collections, newer versions as a single artist).'''
+    if hasattr(cset, 'set_visible'):
+        cset.set_visible(visible)
+    else:
+        for coll in cset.collections:
+            coll.set_visible(visible)
+
+def _remove_contour(cset):
+    ''' Remove a matplotlib ContourSet from its axes.'''
+    if hasattr(cset, 'remove'):
+        cset.remove()
+    else:
+        for coll in cset.collections:
+            coll.remove()
 
 if __name__ == '__main__':
     app = QtGui.QApplication([])
@@ -884,4 +1304,5 @@ if __name__ == '__main__':
     app.setWindowIcon(QtGui.QIcon(os.path.join(path_to_this_func, 'icons','leftbrain.png')))
     subj_dir = sys.argv[1]
     hem = sys.argv[2]
-    e = electrode_picker(subj_dir = subj_dir, hem = hem)
+    snap_radius = float(sys.argv[3]) if len(sys.argv) > 3 else 5.
+    e = electrode_picker(subj_dir = subj_dir, hem = hem, snap_radius = snap_radius)
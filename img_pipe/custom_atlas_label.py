@@ -1,9 +1,10 @@
 import xmltodict
 import scipy.io
-import nipy
 import numpy as np
 import os
 
+from volume_io import Volume
+
 #elecfile = '/Users/benspeidel/Documents/dura/data_store2/imaging/subjects/EC187/elecs/TDT_elecs_all_warped.mat'
 subjects_dir = '/Users/benspeidel/Documents/dura/data_store2/imaging/subjects/'
 
@@ -24,6 +25,28 @@ affine = np.array([[-2., 0., 0., 91],
                    [0., 0., 2., -91.],
                    [0., 0., 0., 1.]])
 
+def nearest_nonzero_label(atlas, crs, start=8):
+    ''' Label of the nonzero voxel of [atlas] (a volume_io.Volume) closest to
+    voxel [crs], reading growing boxes around it rather than the whole volume.
+    Ties go to the first voxel in C order, as np.argmin over np.where did.'''
+    crs = np.asarray(crs, dtype=int)
+    r = start
+    while True:
+        lo = np.maximum(crs - r, 0)
+        hi = np.minimum(crs + r + 1, atlas.shape[:3])
+        box = atlas[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+        nonzeros = np.transpose(np.where(box > 0)) + lo
+        whole = np.all(lo == 0) and np.all(hi == atlas.shape[:3])
+        if nonzeros.shape[0] > 0:
+            d = np.sqrt(np.sum((nonzeros - crs)**2, axis=1))
+            vox_ind = np.argmin(d)
+            # Only voxels within r of crs are sure to all be in the box
+            if d[vox_ind] <= r or whole:
+                return box[tuple(nonzeros[vox_ind] - lo)]
+        elif whole:
+            raise ValueError('%s has no labeled voxels'%(atlas.fname))
+        r *= 2
+
 # with open(LUT_path) as fd:
 #     dd = xmltodict.parse(fd.read())['atlas']['data']['label']
 #     id_to_lbl = {}
@@ -40,7 +63,7 @@ with open(LUT_path) as fd:
 for subj in range(0,len(subject_list)):
     clinicalwarpexists=True
     atlas_path=os.path.join(subjects_dir,subject_list[subj],'mri/aparc+aseg.mgz')
-    atlas = nipy.load_image(atlas_path)
+    atlas = Volume(atlas_path, segmentation=True)
 
     if os.path.isfile(os.path.join(subjects_dir,subject_list[subj],'elecs/clinical_elecs_all.mat')):
         elecfile = os.path.join(subjects_dir,subject_list[subj],'elecs/clinical_elecs_all.mat')
@@ -118,20 +141,17 @@ for subj in range(0,len(subject_list)):
         nchans = VoxCRS.shape[0]
         anatomy = np.empty((nchans, 1), dtype=np.object)
 
-        atlas_nonzeros = np.transpose(np.asarray(np.where(atlas._data>0), dtype='f4'))
-        d = np.zeros((1,atlas_nonzeros.shape[0]))
+        # Labels at the electrodes, read with one lookup
+        elec_labels_vox = atlas.get_voxels(VoxCRS[:, :3])
 
         for elec in np.arange(nchans):
             if isnotdepth[elec]:
-                d = np.sqrt((VoxCRS[elec, 0] - atlas_nonzeros[:, 0])**2 + (VoxCRS[elec, 1] - atlas_nonzeros[:, 1])**2 + (VoxCRS[elec, 2] - atlas_nonzeros[:, 2])**2)
-                vox_ind = np.argmin(d)
-                nearest_vox = atlas_nonzeros[vox_ind, :].astype('int')
-                anatomy[elec] = id_to_lbl[atlas._data[nearest_vox[0], nearest_vox[1], nearest_vox[2]]]
+                anatomy[elec] = id_to_lbl[nearest_nonzero_label(atlas, VoxCRS[elec, :3])]
             else:
-                if atlas._data[VoxCRS[elec,0],VoxCRS[elec, 1], VoxCRS[elec, 2]] == 0 or abs(atlas._data[VoxCRS[elec, 0], VoxCRS[elec, 1], VoxCRS[elec, 2]]) > 10000:
+                if elec_labels_vox[elec] == 0 or abs(elec_labels_vox[elec]) > 10000:
                     anatomy[elec] = 'No_Label'
                 else:
-                    anatomy[elec] = id_to_lbl[atlas._data[VoxCRS[elec,0],VoxCRS[elec,1],VoxCRS[elec,2]]]
+                    anatomy[elec] = id_to_lbl[elec_labels_vox[elec]]
 
         AALanatomy = np.empty((nchans,4), dtype=np.object)
         if nchans == elecmontage.shape[0] and nchans==anatomy.shape[0]:
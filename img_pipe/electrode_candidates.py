@@ -0,0 +1,115 @@
+# electrode_candidates.py
+''' This module finds candidate electrode contacts in a co-registered CT
+ (rCT.nii).  Voxels at or above a threshold are grouped into 3D connected
+ components, and each component of a plausible size for a contact gives a
+ candidate at its intensity-weighted centroid.  Candidates are saved next to
+ the CT (e.g. CT/rCT_candidates.mat) and only detected again when the CT is
+ newer than that file or the detection parameters change.
+
+ This module has no relative imports so it can also be used by the scripts
+ in SupplementalScripts, which add the img_pipe directory to sys.path.
+
+ usage: candidates = load_candidates('/path/to/CT/rCT.nii')
+        ras = candidates['ras']
+
+'''
+
+import os
+
+import numpy as np
+import nibabel as nib
+import scipy.io
+import scipy.ndimage
+
+# Fields of a candidate dictionary holding one row per candidate
+CANDIDATE_FIELDS = ['vox', 'ras', 'n_voxels', 'volume', 'max_intensity', 'mean_intensity']
+
+def detect_candidates(ct_data, affine, threshold=1000, min_voxels=2, max_voxels=500):
+    ''' Find candidate electrodes as connected components of bright CT voxels.
+
+    Parameters
+    ----------
+    ct_data : array-like
+        3D CT volume
+    affine : array-like
+        [4 x 4] voxel to RAS transform of the CT
+    threshold : float
+        Voxels at or above this value may belong to an electrode
+    min_voxels : int
+        Smallest component (in voxels) kept as a candidate
+    max_voxels : int
+        Largest component (in voxels) kept as a candidate, to leave out bone
+        and merged artifacts
+
+    Returns
+    -------
+    candidates : dict
+        'vox' ([ncandidates x 3] centroids in CT voxel coordinates), 'ras'
+        ([ncandidates x 3] centroids in RAS), 'n_voxels', 'volume' (in mm^3),
+        'max_intensity' and 'mean_intensity' of each candidate
+    '''
+    ct_data = np.asarray(ct_data)
+    labels, nlabels = scipy.ndimage.label(ct_data >= threshold, structure=np.ones((3, 3, 3)))
+    n_voxels = np.bincount(labels.ravel(), minlength=nlabels+1)
+    index = np.arange(1, nlabels+1)
+    index = index[(n_voxels[index] >= min_voxels) & (n_voxels[index] <= max_voxels)]
+
+    candidates = dict()
+    if index.shape[0] > 0:
+        candidates['vox'] = np.array(scipy.ndimage.center_of_mass(ct_data, labels, index)).reshape(-1, 3)
+    else:
+        candidates['vox'] = np.zeros((0, 3))
+    candidates['ras'] = nib.affines.apply_affine(affine, candidates['vox'])
+    candidates['n_voxels'] = n_voxels[index]
+    candidates['volume'] = n_voxels[index]*abs(np.linalg.det(affine[:3, :3]))
+    candidates['max_intensity'] = np.array(scipy.ndimage.maximum(ct_data, labels, index), dtype=float).ravel()
+    candidates['mean_intensity'] = np.array(scipy.ndimage.mean(ct_data, labels, index), dtype=float).ravel()
+    return candidates
+
+def candidates_file(ct_file):
+    ''' File the candidates of [ct_file] are saved in (e.g. CT/rCT_candidates.mat).'''
+    base = ct_file[:-len('.gz')] if ct_file.endswith('.gz') else ct_file
+    return os.path.splitext(base)[0] + '_candidates.mat'
+
+def load_candidates(ct_file, threshold=1000, min_voxels=2, max_voxels=500, force=False, any_params=False):
+    ''' Candidate electrodes of a CT, detected with detect_candidates unless
+    they were saved for the same CT and parameters before.
+
+    Parameters
+    ----------
+    ct_file : str
+        The co-registered CT, e.g. [subj_dir]/CT/rCT.nii
+    threshold, min_voxels, max_voxels :
+        See detect_candidates
+    force : bool
+        Detect the candidates again even if they were saved
+    any_params : bool
+        Use the saved candidates whichever parameters they were detected
+        with, so the parameters only apply when nothing is saved
+
+    Returns
+    -------
+    candidates : dict
+        See detect_candidates
+    '''
+    cand_file = candidates_file(ct_file)
+    params = 'threshold=%s, min_voxels=%s, max_voxels=%s'%(threshold, min_voxels, max_voxels)
+    if not force and os.path.isfile(cand_file) and os.path.getmtime(cand_file) >= os.path.getmtime(ct_file):
+        saved = scipy.io.loadmat(cand_file)
+        if any_params or str(saved['params'][0]) == params:
+            candidates = dict()
+            for name in CANDIDATE_FIELDS:
+                candidates[name] = saved[name].reshape(-1, 3) if name in ['vox', 'ras'] else saved[name].ravel()
+            return candidates
+
+    print("Detecting electrode candidates in %s"%(ct_file))
+    img = nib.load(ct_file)
+    candidates = detect_candidates(np.asanyarray(img.dataobj), img.affine, threshold=threshold,
+                                   min_voxels=min_voxels, max_voxels=max_voxels)
+    try:
+        to_save = dict(candidates)
+        to_save['params'] = params
+        scipy.io.savemat(cand_file, to_save)
+    except (IOError, OSError) as e:
+        print("Could not save %s: %s"%(cand_file, e))
+    return candidates
@@ -14,9 +14,14 @@
 import os
 import glob
 import pickle
+import hashlib
 import shutil
 import argparse
 import inspect
+import subprocess
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import nibabel as nib
 from tqdm import tqdm
@@ -31,14 +36,19 @@ from matplotlib import cm
 from matplotlib.backends.backend_pdf import PdfPages
 
 # For CT to MRI registration
-from nipy.core.api import AffineTransform
+from nipy.core.api import AffineTransform, Image
 import nipy.algorithms
 import nipy.algorithms.resample
 import nipy.algorithms.registration.histogram_registration
+import nipy.algorithms.registration.affine
 
 # For reading and unpacking binary files
 import struct
 
+from . import mesh_cache
+from . import mesh_io
+from . import electrode_candidates
+from .volume_io import Volume
 from .plotting.mlab_3D_to_2D import get_world_to_view_matrix, get_view_to_display_matrix, apply_transform_to_points
 
 # For animations, from pycortex
@@ -156,6 +166,16 @@ class freeCoG:
         self.img_pipe_dir = os.path.dirname(os.path.realpath(__file__))
         self.zero_indexed_electrodes = zero_indexed_electrodes
 
+        # Spatial indices for vertices that are not from a cached mesh file,
+        # most recently used last (see get_vert_tree)
+        self._vert_trees = OrderedDict()
+
+        # On-disk caches of derived mesh data, by mesh file (see get_mesh_cache)
+        self._mesh_caches = dict()
+
+        # Meshes loaded by get_surf, kept up to mesh_store.max_bytes (see mesh_io.MeshStore)
+        self.mesh_store = mesh_io.MeshStore()
+
         # Freesurfer home directory
         self.fs_dir = fs_dir
 
@@ -287,7 +307,7 @@ class freeCoG:
         aparc_aseg = os.path.join(self.subj_dir, self.subj, 'mri', 'aparc.a2009s+aseg.mgz')
         os.system("freeview --volume %s:opacity=0.8 --volume %s:opacity=0.6 --volume %s:colormap=lut:opacity=0.5:visible=0 --viewport 'coronal'"%(brain_mri, elecs_CT, aparc_aseg))
         
-    def make_dural_surf(self, radius=3, num_iter=30, dilate=0.0):
+    def make_dural_surf(self, radius=3, num_iter=30, dilate=0.0, engine='freesurfer', smoothing='laplacian'):
         '''
         Create smoothed dural surface for projecting electrodes to.
 
@@ -296,9 +316,20 @@ class freeCoG:
         radius : float 
             radius for smoothing (currently ignored)
         num_iter : int
-            Number of iterations for mris_smooth
+            Number of smoothing iterations (of mris_smooth, or of [smoothing]
+            for the 'python' engine)
         dilate : float
             Amount of dilation for dural surface (argument to mris_expand)
+        engine : {'freesurfer', 'python'}
+            'freesurfer' fills, smooths and expands the surface with mris_fill,
+            mris_extract_main_component, mris_smooth and mris_expand.
+            'python' does the same steps in memory with numpy/scipy (see
+            surface_warping_scripts/dural_surf.py), so FreeSurfer does not need
+            to be installed and only the final ?h.dural is written.
+        smoothing : {'laplacian', 'taubin'}
+            Smoothing of the 'python' engine. 'taubin' alternates shrinking and
+            inflating steps, so the surface does not shrink as it is smoothed.
+            The 'freesurfer' engine only does 'laplacian' (mris_smooth).
 
         Returns
         ----------
@@ -306,10 +337,27 @@ class freeCoG:
         
         '''
         
-        from surface_warping_scripts.make_outer_surf import make_outer_surf # From ielu
+        if engine not in ['freesurfer', 'python']:
+            raise ValueError("engine must be 'freesurfer' or 'python'")
+        if smoothing not in ['laplacian', 'taubin']:
+            raise ValueError("smoothing must be 'laplacian' or 'taubin'")
+        if engine == 'freesurfer' and smoothing != 'laplacian':
+            raise ValueError("%s smoothing needs engine='python'"%(smoothing))
+
+        if engine == 'python':
+            from .surface_warping_scripts.dural_surf import dural_surface
+        else:
+            from surface_warping_scripts.make_outer_surf import make_outer_surf # From ielu
         # Create mask of pial surface
         hems = ['lh', 'rh']
         for hem in hems:
+            if engine == 'python':
+                pial_surf = os.path.join(self.subj_dir, self.subj, 'surf', hem+'.pial')
+                dura_surf = os.path.join(self.subj_dir, self.subj, 'surf', hem+'.dural')
+                print("Creating dural surface %s from %s"%(dura_surf, pial_surf))
+                dural_surface(pial_surf, dura_surf, num_iter=num_iter, dilate=dilate, smoothing=smoothing)
+                continue
+
             print("Creating mask of %s pial surface"%(hem))
             pial_surf = os.path.join(self.subj_dir, self.subj, 'surf', hem+'.pial')
             pial_fill_image = os.path.join(self.subj_dir, self.subj, 'surf', hem+'.pial.filled.mgz')
@@ -337,13 +385,19 @@ class freeCoG:
         
         self.convert_fsmesh2mlab(mesh_name = 'dural')
 
-    def mark_electrodes(self):
+    def mark_electrodes(self, snap_radius=5.):
         ''' Launch the electrode picker for this subject. The electrode
         picker requires the Qt4Agg backend, so is launched via an external
         python script. 
 
         Inputs to the electrode_picker.py script include the subject directory and the hemisphere
         of implantation.
+
+        Parameters
+        ----------
+        snap_radius : float
+            Largest distance (in voxels) over which added electrodes snap to a
+            candidate electrode (see detect_electrode_candidates)
         '''
         individual_elecs_dir = os.path.join(self.subj_dir,self.subj,'elecs','individual_elecs')
         if not os.path.isdir(individual_elecs_dir):
@@ -351,9 +405,41 @@ class freeCoG:
             os.mkdir(individual_elecs_dir)
         print("Launching electrode picker")
         epicker = os.path.join(self.img_pipe_dir, 'SupplementalScripts', 'electrode_picker.py')
-        os.system('python %s %s %s'%(epicker, os.path.join(self.subj_dir, self.subj), self.hem))
+        os.system('python %s %s %s %s'%(epicker, os.path.join(self.subj_dir, self.subj), self.hem, snap_radius))
+
+    def detect_electrode_candidates(self, threshold=1000, min_voxels=2, max_voxels=500, force=False):
+        ''' Find candidate electrode contacts in the registered CT (CT/rCT.nii) as
+        connected components of voxels above [threshold], which the electrode
+        picker snaps added electrodes to. The candidates are saved in
+        CT/rCT_candidates.mat and only detected again if the CT or the
+        parameters change, so running this before mark_electrodes saves the
+        picker from doing it.
+
+        Parameters
+        ----------
+        threshold : float
+            CT intensity of electrode voxels
+        min_voxels : int
+            Smallest component (in voxels) kept as a candidate
+        max_voxels : int
+            Largest component (in voxels) kept as a candidate
+        force : bool
+            Detect the candidates again even if they were saved
+
+        Returns
+        -------
+        candidates : dict
+            'ras' ([ncandidates x 3] scanner RAS centroids), 'vox' (CT voxel
+            centroids), 'n_voxels', 'volume', 'max_intensity' and
+            'mean_intensity' of each candidate
+        '''
+        ct_file = os.path.join(self.CT_dir, 'rCT.nii')
+        candidates = electrode_candidates.load_candidates(ct_file, threshold=threshold, min_voxels=min_voxels,
+                                                          max_voxels=max_voxels, force=force)
+        print("Found %d electrode candidates in %s"%(candidates['ras'].shape[0], ct_file))
+        return candidates
 
-    def convert_fsmesh2mlab(self, mesh_name='pial'):
+    def convert_fsmesh2mlab(self, mesh_name='pial', n_jobs=1, force=False):
         '''Creates surface mesh triangle and vertex .mat files
         If no argument for mesh_name is given, lh.pial and rh.pial
         are converted into lh_pial_trivert.mat and rh_pial_trivert.mat
@@ -362,10 +448,38 @@ class freeCoG:
 
         Parameters
         ----------
-        mesh_name : {'pial', 'white', 'inflated'}
+        mesh_name : {'pial', 'white', 'inflated', 'dural'} or list of these
+            Surface(s) to convert. Both hemispheres of each are converted.
+        n_jobs : int
+            Number of surfaces to convert at the same time
+        force : bool
+            Convert surfaces even if their .mat files are newer than the surface
         
         '''
 
+        if isinstance(mesh_name, str):
+            mesh_names = [mesh_name]
+        else:
+            mesh_names = list(mesh_name)
+
+        _convert_fsmeshes(self._fsmesh2mlab_jobs(mesh_names, force=force), n_jobs=n_jobs)
+        self._set_surf_files(mesh_names)
+
+    def _set_surf_files(self, mesh_names):
+        '''Point the *_surf_file attributes at the converted [mesh_names].'''
+        for mesh_name in mesh_names:
+            if mesh_name=='pial':
+                self.pial_surf_file = dict()
+                self.pial_surf_file['lh'] = os.path.join(self.subj_dir, self.subj, 'Meshes', 'lh_pial_trivert.mat')
+                self.pial_surf_file['rh'] = os.path.join(self.subj_dir, self.subj, 'Meshes', 'rh_pial_trivert.mat')
+            else:
+                setattr(self, mesh_name+'_surf_file', os.path.join(self.mesh_dir, 'rh_%s_trivert.mat'%(mesh_name)))
+
+    def _fsmesh2mlab_jobs(self, mesh_names, force=False):
+        '''The (surface, trivert .mat, MATLAB .mat) files of each hemisphere of
+        [mesh_names] that need converting, i.e. whose .mat files are missing
+        or older than the surface (all of them if force=True).'''
+
         hems = ['lh', 'rh']
 
         if not os.path.isdir(self.mesh_dir):
@@ -373,26 +487,21 @@ class freeCoG:
             # Make the Meshes directory in subj_dir if it does not yet exist
             os.mkdir(self.mesh_dir)
 
-        # Loop through hemispheres for this mesh, create one .mat file for each
-        for h in hems:
-            print("Making %s mesh"%(h))
-            mesh_surf = os.path.join(self.surf_dir, h+'.'+mesh_name)
-            vert, tri = nib.freesurfer.read_geometry(mesh_surf)
-            out_file = os.path.join(self.mesh_dir, '%s_%s_trivert.mat'%(h, mesh_name))
-            out_file_struct = os.path.join(self.mesh_dir, '%s_%s_%s.mat'%(self.subj, h, mesh_name))
-            scipy.io.savemat(out_file, {'tri': tri, 'vert': vert})
-
-            cortex = {'tri': tri+1, 'vert': vert}
-            scipy.io.savemat(out_file_struct, {'cortex': cortex})
-
-        if mesh_name=='pial':
-            self.pial_surf_file = dict()
-            self.pial_surf_file['lh'] = os.path.join(self.subj_dir, self.subj, 'Meshes', 'lh_pial_trivert.mat')
-            self.pial_surf_file['rh'] = os.path.join(self.subj_dir, self.subj, 'Meshes', 'rh_pial_trivert.mat')
-        else:
-            setattr(self, mesh_name+'_surf_file', out_file)
+        jobs = []
+        for mesh_name in mesh_names:
+            for h in hems:
+                mesh_surf = os.path.join(self.surf_dir, h+'.'+mesh_name)
+                out_file = os.path.join(self.mesh_dir, '%s_%s_trivert.mat'%(h, mesh_name))
+                out_file_struct = os.path.join(self.mesh_dir, '%s_%s_%s.mat'%(self.subj, h, mesh_name))
+                if not force and os.path.isfile(out_file) and os.path.isfile(out_file_struct) and \
+                   min(os.path.getmtime(out_file), os.path.getmtime(out_file_struct)) >= os.path.getmtime(mesh_surf):
+                    print("%s is up to date"%(out_file))
+                    continue
+                jobs.append((mesh_surf, out_file, out_file_struct))
+        return jobs
   
-    def reg_img(self, source='CT.nii', target='orig.mgz', smooth=0., reg_type='rigid', interp='pv', xtol=0.0001, ftol=0.0001):
+    def reg_img(self, source='CT.nii', target='orig.mgz', smooth=0., reg_type='rigid', interp='pv', xtol=0.0001, ftol=0.0001,
+                pyramid=None, level_tol=None, time_budget=None, force=False):
         '''Runs nmi coregistration between two images.
         Usually run as patient.reg_img() 
         You can also specify the source (usually a CT scan, assumed to be in $SUBJECTS_DIR/subj/CT)
@@ -413,6 +522,25 @@ class freeCoG:
             tolerance parameter for function minimization
         ftol : float
             tolerance parameter for function minimization
+        pyramid : list of ints, optional
+            Run the registration coarse to fine. At each level both images are
+            downsampled by [factor] along each axis (averaging blocks of voxels),
+            e.g. [4, 2, 1] ends at full resolution. Each level starts from the
+            transform found at the previous level.
+        level_tol : float or list of floats, optional
+            In pyramid mode, the xtol and ftol of the optimizer at each level (a
+            single value is used for all levels). Defaults to nipy's tolerances.
+        time_budget : float, optional
+            Time limit in seconds for pyramid mode. Once it is used up no further
+            levels are started and the transform from the last completed level is
+            used. The first level is always run.
+        force : bool
+            The optimized affine is saved to CT/r[source]_reg.mat (e.g. rCT_reg.mat)
+            together with the similarity value, the registration parameters and
+            content hashes of the two images. When this file matches the images
+            and parameters, its affine is reused; when only the parameters
+            differ, the optimizer starts from it. Set force=True to ignore the
+            saved registration and start from scratch.
 
             
         '''
@@ -420,6 +548,19 @@ class freeCoG:
         source_file = os.path.join(self.CT_dir, source)
         target_file = os.path.join(self.mri_dir, target)
 
+        outfile = os.path.join(self.CT_dir, 'r'+source)
+        reg_file = os.path.splitext(outfile)[0] + '_reg.mat'
+        source_hash = mesh_cache.file_hash(source_file)
+        target_hash = mesh_cache.file_hash(target_file)
+        params = 'reg_type=%s, smooth=%s, interp=%s, pyramid=%s, level_tol=%s'%(reg_type, smooth, interp, pyramid, level_tol)
+
+        # A previous registration of the same two images
+        saved = None
+        if not force and os.path.isfile(reg_file):
+            saved = scipy.io.loadmat(reg_file)
+            if str(saved['source_hash'][0]) != source_hash or str(saved['target_hash'][0]) != target_hash:
+                saved = None
+
         print("Computing registration from %s to %s"%(source_file, target_file))
         ctimg  = nipy.load_image(source_file)
         mriimg = nipy.load_image(target_file)
@@ -427,14 +568,49 @@ class freeCoG:
         ct_cmap = ctimg.coordmap  
         mri_cmap = mriimg.coordmap
 
-        # Compute registration
-        ct_to_mri_reg = nipy.algorithms.registration.histogram_registration.HistogramRegistration(ctimg, mriimg, similarity='nmi', smooth=smooth, interp=interp)
-        aff = ct_to_mri_reg.optimize(reg_type).as_affine()   
+        if saved is not None and str(saved['params'][0]) == params:
+            print("Using the registration saved in %s"%(reg_file))
+            aff = saved['affine']
+        else:
+            if saved is not None:
+                # Warm start from the saved affine
+                print("Starting from the registration saved in %s"%(reg_file))
+                T = nipy.algorithms.registration.affine.affine_transforms[reg_type](array=saved['affine'])
+            else:
+                T = reg_type
+
+            # Compute registration
+            ct_to_mri_reg = nipy.algorithms.registration.histogram_registration.HistogramRegistration(ctimg, mriimg, similarity='nmi', smooth=smooth, interp=interp)
+            if pyramid is None:
+                T = ct_to_mri_reg.optimize(T)
+            else:
+                histogram_registration = nipy.algorithms.registration.histogram_registration
+                if level_tol is None:
+                    level_tol = histogram_registration.XTOL
+                tols = _per_level(level_tol, len(pyramid), 'level_tol')
+                start = time.time()
+                for level, factor in enumerate(pyramid):
+                    if level > 0 and time_budget is not None and time.time() - start > time_budget:
+                        print("Time budget of %.0f s used, skipping the remaining levels"%(time_budget))
+                        break
+                    print("Registration level %d of %d (downsampling by %d)"%(level+1, len(pyramid), factor))
+                    if factor == 1:
+                        level_reg = ct_to_mri_reg
+                    else:
+                        level_reg = histogram_registration.HistogramRegistration(_downsample_image(ctimg, factor),
+                                                                                 _downsample_image(mriimg, factor),
+                                                                                 similarity='nmi', smooth=smooth, interp=interp)
+                    T = level_reg.optimize(T, xtol=tols[level], ftol=tols[level])
+            aff = T.as_affine()
+
+            print("Saving registration affine as %s"%(reg_file))
+            scipy.io.savemat(reg_file, {'affine': aff, 'similarity': ct_to_mri_reg.eval(T),
+                                        'source_hash': source_hash, 'target_hash': target_hash,
+                                        'params': params})
 
         ct_to_mri = AffineTransform(ct_cmap.function_range, mri_cmap.function_range, aff)  
         reg_CT = nipy.algorithms.resample.resample(ctimg, mri_cmap, ct_to_mri.inverse(), mriimg.shape)    
 
-        outfile = os.path.join(self.CT_dir, 'r'+source)
         print("Saving registered CT image as %s"%(outfile))
         nipy.save_image(reg_CT, outfile)
 
@@ -558,7 +734,7 @@ class freeCoG:
     def project_electrodes(self, elecfile_prefix='hd_grid', use_mean_normal=True, \
                                  surf_type='dural', \
                                  num_iter=30, dilate=0.0, grid=True,
-                                 convex_hull=True):
+                                 convex_hull=True, max_bytes=2**28):
         '''
         Project electrodes to the brain's surface to correct for deformation.
         
@@ -587,6 +763,9 @@ class freeCoG:
             Whether to use the convex hull of the relevant surface or not.  Often
             this can result in a smoother looking projection rather than a "wavy"
             looking grid.
+        max_bytes : int, optional
+            Memory budget (in bytes) for the temporary arrays of each chunk of
+            ray-triangle tests (default 256 MB)
 
         Returns
         ---------
@@ -594,7 +773,7 @@ class freeCoG:
 
         '''
         
-        from .surface_warping_scripts.project_electrodes_anydirection import project_electrodes_anydirection
+        from .surface_warping_scripts.project_electrodes_anydirection import project_electrodes_anydirection, BVH_MIN_TRIANGLES
 
         print('Projection Params: \n\t Grid Name: %s.mat \n\t Use Mean Normal: %s \n\t \
                Surface Type: %s \n\t Number of Smoothing Iterations (if using dural): %d'\
@@ -671,16 +850,22 @@ class freeCoG:
 
         print('::: Loading Mesh data :::')
         print(os.path.join(self.subj_dir, self.subj, 'Meshes', '%s_%s_trivert.mat'%(self.hem, surf_type)))
-        cortex = scipy.io.loadmat(os.path.join(self.subj_dir, self.subj, 'Meshes', '%s_%s_trivert.mat'%(self.hem, surf_type)))
-        tri, vert = cortex['tri'], cortex['vert']
+        cache = self.get_mesh_cache(hem=self.hem, roi=surf_type)
+        tri, vert = cache.mesh['tri'], cache.mesh['vert']
 
         if convex_hull:
-            tri = scipy.spatial.Delaunay(vert).convex_hull
+            tri = cache.convex_hull()
+
+        # The bounding volume hierarchy is only worth building for large
+        # meshes, and is cached with the mesh so it is built only once
+        bvh = None
+        if tri.shape[0] >= BVH_MIN_TRIANGLES:
+            bvh = cache.triangle_bvh(convex_hull=convex_hull)
 
         print('::: Projecting electrodes to mesh :::')
         elecmatrix = scipy.io.loadmat(os.path.join(self.subj_dir, self.subj, 'elecs', 'individual_elecs', '%s_orig.mat'%(elecfile_prefix)))['elecmatrix']
         print(direction)
-        elecs_proj = project_electrodes_anydirection(tri, vert, elecmatrix, direction)
+        elecs_proj = project_electrodes_anydirection(tri, vert, elecmatrix, direction, max_bytes=max_bytes, bvh=bvh)
         scipy.io.savemat(os.path.join(self.subj_dir, self.subj, 'elecs', 'individual_elecs', '%s.mat'%(elecfile_prefix)),{'elecmatrix':elecs_proj})
         print('::: Done :::')
 
@@ -909,7 +1094,7 @@ class freeCoG:
         subcort_tri = np.array(np.vstack((subcort_tri)), dtype=np.int)
 
         outfile = '%s_subcort_trivert.mat' % (nuc)
-        scipy.io.savemat(outfile, {'tri': subcort_tri, 'vert': subcort_vert})  # save tri/vert matrix
+        mesh_io.save_trivert(outfile, subcort_vert, subcort_tri)  # save tri/vert matrix
 
         # convert inds to scipy mat
         subcort_inds = scipy.mat(subcort_inds)
@@ -1040,43 +1225,200 @@ class freeCoG:
 
         return elecs_all
 
-    def nearest_electrode_vert(self, cortex_verts, elecmatrix):
+    def get_mesh_cache(self, hem='', roi='pial', template=None):
+        ''' Get the on-disk cache of derived data (vertex spatial index, vertex normals,
+        vertex adjacency, convex hull) for a mesh in the Meshes directory.  Cached
+        files live in Meshes/.cache and are keyed by a hash of the mesh file, so they
+        are recomputed automatically whenever the mesh is rewritten.
+
+        Parameters
+        ----------
+        hem : {'', 'lh', 'rh'}
+            Hemisphere for the surface. If blank, defaults to self.hem
+        roi : str
+            The mesh to use, which should exist as [hem]_[roi]_trivert.mat
+        template : str, optional
+            Name of the template to use instead of this subject, e.g. 'cvs_avg35_inMNI152'
+
+        Returns
+        -------
+        cache : img_pipe.mesh_cache.MeshCache
+            cache.mesh holds the 'tri' and 'vert' of the mesh
+
+        '''
+        if hem == '':
+            hem = self.hem
+        if template is None:
+            mesh_file = os.path.join(self.mesh_dir, '%s_%s_trivert.mat'%(hem, roi))
+        else:
+            mesh_file = os.path.join(self.subj_dir, template, 'Meshes', '%s_%s_trivert.mat'%(hem, roi))
+        return self._open_mesh_cache(mesh_file)
+
+    def _open_mesh_cache(self, mesh_file):
+        '''The MeshCache of [mesh_file], opened again if the file has changed.'''
+        cache = self._mesh_caches.get(mesh_file)
+        if cache is None or not cache.is_current():
+            cache = mesh_cache.MeshCache(mesh_file, mesh_store=self.mesh_store)
+            self._mesh_caches[mesh_file] = cache
+        return cache
+
+    def get_vert_tree(self, cortex_verts, mesh_file=None, max_trees=4):
+        ''' Get the k-d tree spatial index for the vertices of a mesh.
+        For a mesh file, this is the tree saved by its mesh cache (see
+        get_mesh_cache), which is also used when [cortex_verts] are the
+        vertices of an open mesh cache (e.g. returned by get_surf). Trees
+        for other vertices are kept for the [max_trees] most recently used.
+
+        Parameters
+        ----------
+        cortex_verts : array-like
+            [nvertices x 3] matrix of vertices on the surface mesh
+        mesh_file : str, optional
+            The trivert .mat file [cortex_verts] were loaded from
+        max_trees : int
+            Number of trees to keep for vertices that are not from a mesh file
+
+        Returns
+        -------
+        tree : scipy.spatial.cKDTree
+            Spatial index over cortex_verts
+        '''
+        if mesh_file is not None:
+            return self._open_mesh_cache(mesh_file).vert_tree()
+        for cache in self._mesh_caches.values():
+            if cache.source_file in self.mesh_store and cache.mesh['vert'] is cortex_verts:
+                return cache.vert_tree()
+
+        key = _vert_digest(cortex_verts)
+        tree = self._vert_trees.pop(key, None)
+        if tree is None:
+            tree = scipy.spatial.cKDTree(cortex_verts)
+        self._vert_trees[key] = tree
+        while len(self._vert_trees) > max_trees:
+            self._vert_trees.popitem(last=False)
+        return tree
+
+    def nearest_electrode_vert(self, cortex_verts, elecmatrix, k=1, tree=None):
         ''' Find the vertex on a mesh that is closest to the given electrode
         coordinates.
-        
+
         Parameters
         ----------
         cortex_verts : array-like
             [nvertices x 3] matrix of vertices on the cortical surface mesh
         elecmatrix : array-like
-            [nchans x 3] matrix of 3D electrode coordinates 
+            [nchans x 3] matrix of 3D electrode coordinates
+        k : int, optional
+            Number of nearest vertices to return for each electrode (default: 1)
+        tree : scipy.spatial.cKDTree, optional
+            Prebuilt spatial index over cortex_verts (e.g. from get_mesh_cache).
+            If None, uses get_vert_tree.
 
         Returns
         -------
         vert_inds : array-like
-            Array of vertex indices that are closest to each of the 
-            electrode 
+            Array of vertex indices that are closest to each of the
+            electrode. If k > 1, this is [nchans x k], sorted by distance.
         nearest_verts : array-like
             Coordinates for the nearest cortical vertices
         '''
 
-        nchans = elecmatrix.shape[0]
-        d = np.zeros((nchans, cortex_verts.shape[0]))
-
-        # Find the distance between each electrode and all possible vertices
-        # on the surface mesh
-        for chan in np.arange(nchans):
-            d[chan,:] = np.sqrt((elecmatrix[chan,0] - cortex_verts[:,0])**2 + \
-                                (elecmatrix[chan,1] - cortex_verts[:,1])**2 + \
-                                (elecmatrix[chan,2] - cortex_verts[:,2])**2)
+        if tree is None:
+            tree = self.get_vert_tree(cortex_verts)
+        elecmatrix = np.atleast_2d(elecmatrix)
 
-        # Find the index of the vertex nearest to each electrode
-        vert_inds = np.argmin(d, axis = 1)
+        # Electrodes with NaN coordinates are assigned vertex 0, as before
+        good_elecs = np.all(np.isfinite(elecmatrix), axis=1)
+        if k == 1:
+            vert_inds = np.zeros((elecmatrix.shape[0],), dtype=int)
+        else:
+            vert_inds = np.zeros((elecmatrix.shape[0], k), dtype=int)
+        if np.any(good_elecs):
+            vert_inds[good_elecs] = tree.query(elecmatrix[good_elecs,:], k=k)[1]
         nearest_verts = cortex_verts[vert_inds,:]
 
         return vert_inds, nearest_verts
 
-    def label_elecs(self, elecfile_prefix='TDT_elecs_all', atlas_surf='desikan-killiany', atlas_depth='destrieux', elecs_all=True):
+    def electrode_verts_in_radius(self, cortex_verts, elecmatrix, radius, tree=None):
+        ''' Find all of the vertices on a mesh within a given distance
+        of each electrode.
+
+        Parameters
+        ----------
+        cortex_verts : array-like
+            [nvertices x 3] matrix of vertices on the cortical surface mesh
+        elecmatrix : array-like
+            [nchans x 3] matrix of 3D electrode coordinates
+        radius : float
+            Search radius (in mm)
+        tree : scipy.spatial.cKDTree, optional
+            Prebuilt spatial index over cortex_verts (e.g. from get_mesh_cache).
+            If None, uses get_vert_tree.
+
+        Returns
+        -------
+        vert_inds : list of array-like
+            For each electrode, the indices of the vertices within [radius].
+            Electrodes with NaN coordinates get an empty array.
+        '''
+
+        if tree is None:
+            tree = self.get_vert_tree(cortex_verts)
+        elecmatrix = np.atleast_2d(elecmatrix)
+
+        vert_inds = [np.array([], dtype=int) for e in range(elecmatrix.shape[0])]
+        good_elecs = np.where(np.all(np.isfinite(elecmatrix), axis=1))[0]
+        if len(good_elecs) > 0:
+            hits = tree.query_ball_point(elecmatrix[good_elecs,:], radius)
+            for e, h in zip(good_elecs, hits):
+                vert_inds[e] = np.array(sorted(h), dtype=int)
+
+        return vert_inds
+
+    def get_vert_labels(self, hem='', atlas='desikan-killiany'):
+        ''' Get the atlas label of every vertex of the surface, read directly from
+        the freesurfer annotation file (label/[hem].aparc.annot for Desikan-Killiany,
+        label/[hem].aparc.a2009s.annot for Destrieux).  The parsed arrays are cached
+        in Meshes/.cache and keyed by a hash of the annotation file.
+
+        Parameters
+        ----------
+        hem : {'', 'lh', 'rh'}
+            Hemisphere for the surface. If blank, defaults to self.hem
+        atlas : {'desikan-killiany', 'destrieux'}
+            Which annotation to read
+
+        Returns
+        -------
+        vert_labels : array-like
+            [nvertices] index into label_names for each vertex, -1 where the vertex
+            has no label
+        label_names : array-like
+            Object array of label names, with 'Unknown' as the last entry so that
+            label_names[vert_labels] gives 'Unknown' for unlabeled vertices
+
+        Raises IOError/OSError if the annotation file does not exist.
+        '''
+        if hem == '':
+            hem = self.hem
+        if atlas == 'destrieux':
+            annot_name = 'aparc.a2009s'
+        else:
+            annot_name = 'aparc'
+        annot_file = os.path.join(self.subj_dir, self.subj, 'label', '%s.%s.annot'%(hem, annot_name))
+
+        def read_labels():
+            vert_labels, ctab, names = nib.freesurfer.read_annot(annot_file)
+            names = [n.decode('utf-8') if isinstance(n, bytes) else n for n in names]
+            label_names = np.array([n.strip() for n in names] + ['Unknown'], dtype=object)
+            return vert_labels.astype(np.int32), label_names
+
+        print('Loading vertex labels from %s'%(annot_file))
+        cache = mesh_cache.DerivedCache(annot_file, cache_dir=os.path.join(self.mesh_dir, mesh_cache.CACHE_DIRNAME))
+        return cache.get('vert_labels', read_labels)
+
+    def label_elecs(self, elecfile_prefix='TDT_elecs_all', atlas_surf='desikan-killiany', atlas_depth='destrieux', elecs_all=True,
+                    depth_radius=0):
         ''' Automatically labels electrodes based on the freesurfer annotation file.
         Assumes TDT_elecs_all.mat or clinical_elecs_all.mat files
         Uses both the Desikan-Killiany Atlas and the Destrieux Atlas, as described 
@@ -1092,6 +1434,9 @@ class freeCoG:
             The atlas to use for labeling of depth electrodes.
         elecs_all : bool
             Label all electrodes
+        depth_radius : float
+            If > 0, label each depth electrode with the most common label within this many
+            voxels of the contact, and print the label proportions (see label_depth_elecs)
         
         Returns
         -------
@@ -1107,15 +1452,6 @@ class freeCoG:
         else:
             surf_atlas_flag = ''
 
-        print(self.subj_dir)
-        print('Creating labels from the freesurfer annotation file for use in automated electrode labeling')
-        gyri_labels_dir = os.path.join(self.subj_dir, self.subj, 'label', 'gyri')
-        if not os.path.isdir(gyri_labels_dir):
-            os.mkdir(gyri_labels_dir)
-         
-        # This version of mri_annotation2label uses the coarse labels from the Desikan-Killiany Atlas, unless
-        # atlas_surf is 'destrieux', in which case the more detailed labels are used
-        os.system('mri_annotation2label --subject %s --hemi %s --surface pial %s --outdir %s'%(self.subj, self.hem, surf_atlas_flag, gyri_labels_dir))
         print('Loading electrode matrix')
         elecfile = os.path.join(self.elecs_dir, elecfile_prefix+'.mat')
         elecmatrix = scipy.io.loadmat(elecfile)['elecmatrix']
@@ -1165,22 +1501,8 @@ class freeCoG:
             # Find the non depth electrodes
             isnotdepth = np.array([r!='depth' for r in grid_or_depth])
             
-        # Use the surface label files to get which label goes with each surface vertex
-        label_files = glob.glob(os.path.join(gyri_labels_dir, '%s.*.label'%(self.hem)))
-        vert_label = {}
-        for label in label_files:
-            label_name = label.split('.')[1]
-            print('Loading label %s'%label_name)
-            fid = open(label,'r')
-            d = np.genfromtxt(fid, delimiter=' ', \
-                              skip_header=2)
-            vertnum, x, y, z, junk=d[~np.isnan(d)].reshape((-1,5)).T
-            for v in vertnum:
-                vert_label[np.int(v)] = label_name.strip()
-            fid.close()
-
-        trivert_file = os.path.join(self.mesh_dir, '%s_pial_trivert.mat'%(self.hem))
-        cortex_verts = scipy.io.loadmat(trivert_file)['vert']
+        cache = self.get_mesh_cache(hem=self.hem)
+        cortex_verts = cache.mesh['vert']
 
         # Only use electrodes that are grid or strips
         if len(isnotdepth)>0:
@@ -1189,15 +1511,14 @@ class freeCoG:
             elecmatrix_new = elecmatrix
 
         print('Finding nearest mesh vertex for each electrode')
-        vert_inds, nearest_verts = self.nearest_electrode_vert(cortex_verts, elecmatrix_new)
+        vert_inds, nearest_verts = self.nearest_electrode_vert(cortex_verts, elecmatrix_new, tree=cache.vert_tree())
 
-        ## Now make a dictionary of the label for each electrode
-        elec_labels_notdepth=[]
-        for v in range(len(vert_inds)):
-            if vert_inds[v] in vert_label:
-                elec_labels_notdepth.append(vert_label[vert_inds[v]].strip())
-            else:
-                elec_labels_notdepth.append('Unknown')
+        try:
+            vert_labels, label_names = self.get_vert_labels(hem=self.hem, atlas=atlas_surf)
+            elec_labels_notdepth = list(label_names[vert_labels[vert_inds]])
+        except (IOError, OSError):
+            print('No %s annotation file found, creating label files with mri_annotation2label instead'%(atlas_surf))
+            elec_labels_notdepth = self._label_verts_from_label_files(vert_inds, surf_atlas_flag)
 
         if elecfile_prefix == 'TDT_elecs_all' or elecfile_prefix == 'clinical_elecs_all' or elecs_all:
             elec_labels[isnotdepth,3] = elec_labels_notdepth
@@ -1217,62 +1538,8 @@ class freeCoG:
             print('*************************************************')
             print('Now doing the depth electrodes')
 
-            # Get the volume corresponding to the labels from the Destrieux atlas, which is more 
-            # detailed than Desikan-Killiany (https://surfer.nmr.mgh.harvard.edu/fswiki/CorticalParcellation)
-            if atlas_depth == 'desikan-killiany':
-                depth_atlas_nm = ''
-            elif atlas_depth == 'destrieux':
-                depth_atlas_nm = '.a2009s'
-            else:
-                depth_atlas_nm = '.a2009s'
-
-            aseg_file = os.path.join(self.subj_dir, self.subj, 'mri', 'aparc%s+aseg.mgz'%(depth_atlas_nm))
-            dat = nib.freesurfer.load(aseg_file)
-            aparc_dat = dat.get_data()
-             
-            # Define the affine transform to go from surface coordinates to volume coordinates (as CRS, which is
-            # the slice *number* as x,y,z in the 3D volume. That is, if there are 256 x 256 x 256 voxels, the
-            # CRS coordinate will go from 0 to 255.)
-            affine = np.array([[  -1.,    0.,    0.,  128.],
-                               [   0.,    0.,    1., -128.],
-                               [   0.,   -1.,    0.,  128.],
-                               [   0.,    0.,    0.,    1.]])
-
             elecs_depths = elecmatrix[np.invert(isnotdepth),:]
-            intercept = np.ones(len(elecs_depths))
-            elecs_ones = np.column_stack((elecs_depths,intercept))
-
-            # Find voxel CRS
-            VoxCRS = np.dot(np.linalg.inv(affine), elecs_ones.transpose()).transpose().astype(int)
-            # Make meshgrid the same size as aparc_dat (only for gaussian blob version), ignore
-            #xx, yy, zz = np.mgrid[0:aparc_dat.shape[0], 0:aparc_dat.shape[1], 0:aparc_dat.shape[2]]
-            #unique_labels = np.unique(aparc_dat)
-            #unique_labels = unique_labels[unique_labels>0]
-
-            # Get the names of these labels using Freesurfer's lookup table (LUT)
-            print("Loading lookup table for freesurfer labels")
-            fid = open(os.path.join(self.fs_dir,'FreeSurferColorLUT.txt'))
-            LUT = fid.readlines()
-            fid.close()
-
-            # Make dictionary of labels
-            LUT = [row.split() for row in LUT]
-            lab = {}
-            for row in LUT:
-                if len(row)>1 and row[0][0] is not '#' and row[0][0] is not '\\': # Get rid of the comments
-                    lname = row[1]
-                    lab[np.int(row[0])] = lname
-
-            # Label the electrodes according to the aseg volume
-            nchans = VoxCRS.shape[0]
-            anatomy = np.empty((nchans,), dtype=np.object)
-            print("Labeling electrodes...")
-
-            for elec in np.arange(nchans):
-                anatomy[elec] = lab[aparc_dat[VoxCRS[elec,0], VoxCRS[elec,1], VoxCRS[elec,2]]]
-                print("E%d, Vox CRS: [%d, %d, %d], Label #%d = %s"%(elec, VoxCRS[elec,0], VoxCRS[elec,1], VoxCRS[elec,2], 
-                                                                    aparc_dat[VoxCRS[elec,0], VoxCRS[elec,1], VoxCRS[elec,2]], 
-                                                                    anatomy[elec]))
+            anatomy, label_dist = self.label_depth_elecs(elecs_depths, atlas_depth=atlas_depth, radius=depth_radius)
 
             elec_labels[np.invert(isnotdepth),3] = anatomy
             
@@ -1287,7 +1554,137 @@ class freeCoG:
 
         return elec_labels
 
-    def warp_all(self, elecfile_prefix='TDT_elecs_all', warp_depths=True, warp_surface=True, template='cvs_avg35_inMNI152'):
+    def label_depth_elecs(self, elecmatrix, atlas_depth='destrieux', radius=0):
+        ''' Label depth electrodes from the freesurfer volume parcellation
+        (aparc+aseg.mgz or aparc.a2009s+aseg.mgz), looking up all electrodes at once.
+
+        Parameters
+        ----------
+        elecmatrix : array-like
+            [nchans x 3] depth electrode coordinates (surface RAS)
+        atlas_depth : {'destrieux', 'desikan-killiany'}
+            Which parcellation to use. Destrieux is more detailed so is usually
+            a good choice for depth electrodes.
+        radius : float
+            If 0 (default), each electrode gets the label of the voxel it is in.
+            Otherwise each electrode gets the most common label among the voxels
+            within [radius] voxels of it (the center voxel wins ties), which is
+            more robust at tissue boundaries, and the label proportions are printed.
+
+        Returns
+        -------
+        anatomy : array-like
+            [nchans] object array of label names
+        label_dist : list
+            For each electrode, a list of (label name, proportion of voxels) tuples
+            sorted from most to least common
+        '''
+
+        # Get the volume corresponding to the labels from the Destrieux atlas, which is more 
+        # detailed than Desikan-Killiany (https://surfer.nmr.mgh.harvard.edu/fswiki/CorticalParcellation)
+        if atlas_depth == 'desikan-killiany':
+            depth_atlas_nm = ''
+        else:
+            depth_atlas_nm = '.a2009s'
+
+        aseg_file = os.path.join(self.subj_dir, self.subj, 'mri', 'aparc%s+aseg.mgz'%(depth_atlas_nm))
+        aparc_dat = Volume(aseg_file, segmentation=True)
+
+        # Define the affine transform to go from surface coordinates to volume coordinates (as CRS, which is
+        # the slice *number* as x,y,z in the 3D volume. That is, if there are 256 x 256 x 256 voxels, the
+        # CRS coordinate will go from 0 to 255.)
+        affine = np.array([[  -1.,    0.,    0.,  128.],
+                           [   0.,    0.,    1., -128.],
+                           [   0.,   -1.,    0.,  128.],
+                           [   0.,    0.,    0.,    1.]])
+
+        elecmatrix = np.atleast_2d(elecmatrix)
+        elecs_ones = np.column_stack((elecmatrix, np.ones(len(elecmatrix))))
+
+        # Find voxel CRS
+        VoxCRS = np.dot(np.linalg.inv(affine), elecs_ones.transpose()).transpose()[:,:3].astype(int)
+
+        # Voxel offsets within the radius, with the center voxel first
+        r = int(np.floor(radius))
+        grid = np.mgrid[-r:r+1, -r:r+1, -r:r+1].reshape(3,-1).T
+        grid = grid[np.sum(grid**2, axis=1) <= radius**2]
+        offsets = grid[np.argsort(np.sum(grid**2, axis=1), kind='mergesort')]
+
+        # [nchans x noffsets] label numbers, clipped to the volume
+        crs = VoxCRS[:,np.newaxis,:] + offsets[np.newaxis,:,:]
+        for i in range(3):
+            crs[:,:,i] = np.clip(crs[:,:,i], 0, aparc_dat.shape[i]-1)
+        vox_labels = aparc_dat.get_voxels(crs.reshape(-1,3)).reshape(crs.shape[:2]).astype(int)
+
+        # Count each label in each electrode's neighborhood
+        unique_labels, inv = np.unique(vox_labels, return_inverse=True)
+        inv = inv.reshape(vox_labels.shape)
+        nchans, nvox = vox_labels.shape
+        counts = np.bincount((np.arange(nchans)[:,np.newaxis]*len(unique_labels) + inv).ravel(),
+                             minlength=nchans*len(unique_labels)).reshape(nchans, len(unique_labels))
+        votes = counts.astype(float)
+        votes[np.arange(nchans), inv[:,0]] += 0.5 # the center voxel breaks ties
+        winners = unique_labels[np.argmax(votes, axis=1)]
+
+        # Get the names of these labels using Freesurfer's lookup table (LUT)
+        lab = _load_fs_lut(os.path.join(self.fs_dir, 'FreeSurferColorLUT.txt'))
+        names = np.array([lab.get(l, 'Unknown') for l in unique_labels], dtype=object)
+        anatomy = np.array([lab.get(l, 'Unknown') for l in winners], dtype=object)
+
+        label_dist = []
+        for elec in np.arange(nchans):
+            present = np.where(counts[elec,:] > 0)[0]
+            present = present[np.argsort(-counts[elec,present], kind='mergesort')]
+            label_dist.append([(names[i], counts[elec,i]/float(nvox)) for i in present])
+
+        if radius > 0:
+            print('Label proportions within %g voxels of each electrode:'%(radius))
+            for elec in np.arange(nchans):
+                print('E%d, Vox CRS: [%d, %d, %d], %s'%(elec, VoxCRS[elec,0], VoxCRS[elec,1], VoxCRS[elec,2],
+                                                       ', '.join(['%s %.2f'%(n, prop) for n, prop in label_dist[elec]])))
+        print('Labeled %d depth electrodes'%(nchans))
+
+        return anatomy, label_dist
+
+    def _label_verts_from_label_files(self, vert_inds, surf_atlas_flag=''):
+        ''' Label vertices using the .label files written by mri_annotation2label,
+        for subjects that do not have the annotation file label_elecs reads.'''
+
+        print(self.subj_dir)
+        print('Creating labels from the freesurfer annotation file for use in automated electrode labeling')
+        gyri_labels_dir = os.path.join(self.subj_dir, self.subj, 'label', 'gyri')
+        if not os.path.isdir(gyri_labels_dir):
+            os.mkdir(gyri_labels_dir)
+         
+        # This version of mri_annotation2label uses the coarse labels from the Desikan-Killiany Atlas, unless
+        # atlas_surf is 'destrieux', in which case the more detailed labels are used
+        os.system('mri_annotation2label --subject %s --hemi %s --surface pial %s --outdir %s'%(self.subj, self.hem, surf_atlas_flag, gyri_labels_dir))
+
+        # Use the surface label files to get which label goes with each surface vertex
+        label_files = glob.glob(os.path.join(gyri_labels_dir, '%s.*.label'%(self.hem)))
+        vert_label = {}
+        for label in label_files:
+            label_name = label.split('.')[1]
+            print('Loading label %s'%label_name)
+            fid = open(label,'r')
+            d = np.genfromtxt(fid, delimiter=' ', \
+                              skip_header=2)
+            vertnum, x, y, z, junk=d[~np.isnan(d)].reshape((-1,5)).T
+            for v in vertnum:
+                vert_label[np.int(v)] = label_name.strip()
+            fid.close()
+
+        ## Now make a dictionary of the label for each electrode
+        elec_labels_notdepth=[]
+        for v in range(len(vert_inds)):
+            if vert_inds[v] in vert_label:
+                elec_labels_notdepth.append(vert_label[vert_inds[v]].strip())
+            else:
+                elec_labels_notdepth.append('Unknown')
+        return elec_labels_notdepth
+
+    def warp_all(self, elecfile_prefix='TDT_elecs_all', warp_depths=True, warp_surface=True, template='cvs_avg35_inMNI152',
+                 n_jobs=1, surface_engine='label2label'):
         ''' Warps surface and depth electrodes and runs quality checking functions for them. 
 
         Parameters
@@ -1301,6 +1698,10 @@ class freeCoG:
         template : str, optional
             which atlas brain to use (default: 'cvs_avg35_inMNI152').  Must be an atlas
             in the freesurfer subjects directory.
+        n_jobs : int, optional
+            number of surface warp processes to run at the same time (see compute_surface_warp)
+        surface_engine : {'label2label', 'combined', 'sphere'}, optional
+            how to run the surface warp (see compute_surface_warp)
 
         Returns
         -------
@@ -1344,7 +1745,7 @@ class freeCoG:
         if warp_surface:
             #if surface warp already run, don't run again
             if not os.path.isfile(os.path.join(self.subj_dir,self.subj,'elecs', elecfile_prefix + '_surface_warped.mat')):
-                self.get_surface_warp(elecfile_prefix,template)
+                self.get_surface_warp(elecfile_prefix,template,n_jobs=n_jobs,engine=surface_engine)
             else:
                 print('Found %s, not running surface warp again'%(os.path.join(self.subj_dir,self.subj,'elecs', elecfile_prefix + '_surface_warped.mat')))
             elecfile_surface_warped = os.path.join(self.elecs_dir, elecfile_prefix+'_surface_warped.mat')
@@ -1478,7 +1879,8 @@ class freeCoG:
         return elecmatrix
 
     # Method to perform surface warps
-    def get_surface_warp(self, basename='TDT_elecs_all', template='cvs_avg35_inMNI152'):
+    def get_surface_warp(self, basename='TDT_elecs_all', template='cvs_avg35_inMNI152', n_jobs=1,
+                         engine='label2label'):
         ''' Perform surface warps on [basename].mat file, warping to template [template]
         which should also be present in the freesurfer $SUBJECTS_DIR
         
@@ -1489,6 +1891,10 @@ class freeCoG:
         template : str, optional
             Name of the template atlas for performing the surface warp 
             (default: 'cvs_avg35_inMNI152')
+        n_jobs : int, optional
+            number of mri_label2label processes to run at the same time (default: 1)
+        engine : {'label2label', 'combined', 'sphere'}, optional
+            how to run the surface warp (see compute_surface_warp)
 
         '''               
         
@@ -1502,7 +1908,8 @@ class freeCoG:
             elecmatrix = scipy.io.loadmat(os.path.join(self.elecs_dir, basename + '.mat'))['elecmatrix']
             anatomy = scipy.io.loadmat(os.path.join(self.elecs_dir, basename + '.mat'))['anatomy']
             labelpath = os.path.join(self.subj_dir, self.subj, 'label')
-            elecs_warped = self.compute_surface_warp(elecmatrix, anatomy, labelpath, basename, template)
+            elecs_warped = self.compute_surface_warp(elecmatrix, anatomy, labelpath, basename, template, n_jobs=n_jobs,
+                                                     engine=engine)
 
             scipy.io.savemat(elecfile, {'elecmatrix': np.array(elecs_warped), 'anatomy': anatomy})
 
@@ -1510,7 +1917,7 @@ class freeCoG:
 
 
     def compute_surface_warp(self, elecmatrix, anatomy=None, labelpath='tmp/', basename='',
-                             template='cvs_avg35_inMNI152'):
+                             template='cvs_avg35_inMNI152', n_jobs=1, retries=1, engine='label2label'):
         """
         wrapper that uses freesurfer's label_mri2mri to warp electrodes from one cortical surface to another.
         Parameters
@@ -1526,6 +1933,17 @@ class freeCoG:
           default = ''
         template : str
           default='cvs_avg35_inMNI152'
+        n_jobs : int
+          number of mri_label2label processes to run at the same time (default = 1)
+        retries : int
+          number of times to re-run mri_label2label for a channel that failed (default = 1).
+          Channels that still fail are left as NaN and reported at the end.
+        engine : {'label2label', 'combined', 'sphere'}
+          'label2label' (default) runs mri_label2label once per electrode. 'combined' writes
+          the nearest vertices of all electrodes into one label and warps them with a single
+          call, then warps any channel missing from the result separately. 'sphere' does the
+          same lookup as mri_label2label in python, by matching each electrode's vertex to the
+          nearest vertex of the template's ?h.sphere.reg, and needs no FreeSurfer binaries.
         
         Returns
         -------
@@ -1533,17 +1951,10 @@ class freeCoG:
           (n x 3 np.array)
         """
 
-        labels_to_warp_path = os.path.join(labelpath, 'labels_to_warp')
-        warped_labels_dir = os.path.join(labelpath, 'warped_labels')
-
-        if not os.path.isdir(labelpath):
-            os.mkdir(labelpath)
-        if not os.path.isdir(warped_labels_dir):
-            os.mkdir(warped_labels_dir)
-        if not os.path.isdir(labels_to_warp_path):
-            os.mkdir(labels_to_warp_path)
+        if engine not in ['label2label', 'combined', 'sphere']:
+            raise ValueError('Unknown surface warp engine %s' % (engine))
 
-        cortex_src = self.get_surf()
+        cache = self.get_mesh_cache(hem=self.hem)
         atlas_file = os.path.join(self.subj_dir, template, 'Meshes', self.hem + '_pial_trivert.mat')
         if not os.path.isfile(atlas_file):
             atlas_patient = freeCoG(subj=template, subj_dir=self.subj_dir, hem=self.hem)
@@ -1558,41 +1969,131 @@ class freeCoG:
             surface_indices = range(len(elecmatrix))
 
         print("Finding nearest surface vertex for each electrode")
-        vert_inds, nearest_verts = self.nearest_electrode_vert(cortex_src['vert'], elecmatrix[surface_indices, :])
+        vert_inds, nearest_verts = self.nearest_electrode_vert(cache.mesh['vert'], elecmatrix[surface_indices, :],
+                                                               tree=cache.vert_tree())
         elecmatrix = nearest_verts
 
-        print('Warping each electrode separately:')
-        elecs_warped = np.nan * np.ones((len(surface_indices), 3))
+        if engine == 'sphere':
+            from .surface_warping_scripts.sphere_warp import read_sphere, sphere_tree, sphere_surface_warp
+
+            print('Warping electrodes through %s.sphere.reg' % (self.hem))
+            src_sphere = read_sphere(self.subj_dir, self.subj, self.hem)
+            trg_sphere_file = os.path.join(self.subj_dir, template, 'surf', '%s.sphere.reg' % (self.hem))
+            # Keep the template's sphere index with the template meshes, since the
+            # template's surf directory is often not writable
+            trg_cache = mesh_cache.DerivedCache(trg_sphere_file,
+                                                cache_dir=os.path.join(self.subj_dir, template, 'Meshes', mesh_cache.CACHE_DIRNAME))
+            trg_tree = trg_cache.get('sphere_tree', lambda: sphere_tree(read_sphere(self.subj_dir, template, self.hem)))
+            trg_vert = self.get_mesh_cache(hem=self.hem, template=template).mesh['vert']
+            _, elecs_warped = sphere_surface_warp(vert_inds, src_sphere, None, trg_vert, trg_tree=trg_tree)
+            return elecs_warped
 
-        for c in np.arange(len(surface_indices)):
-            chan = surface_indices[c]
-            # Open label file for writing
-            labelname_nopath = '%s.%s.chan%03d.label' % (self.hem, basename, chan)
-            labelname = os.path.join(labels_to_warp_path, labelname_nopath)
+        labels_to_warp_path = os.path.join(labelpath, 'labels_to_warp')
+        warped_labels_dir = os.path.join(labelpath, 'warped_labels')
 
+        if not os.path.isdir(labelpath):
+            os.mkdir(labelpath)
+        if not os.path.isdir(warped_labels_dir):
+            os.mkdir(warped_labels_dir)
+        if not os.path.isdir(labels_to_warp_path):
+            os.mkdir(labels_to_warp_path)
+
+        elecs_warped = np.nan * np.ones((len(surface_indices), 3))
+
+        def write_label(labelname, channels):
+            # The stat column holds each point's position in surface_indices, so the
+            # points of a combined label can be matched back to their channels
             with open(labelname, 'w') as fid:
                 fid.write('%s\n' % (labelname))
                 # Print header of label file
-                fid.write('#!ascii label  , from subject %s vox2ras=TkReg\n1\n' % (self.subj))
-                fid.write('%i %.9f %.9f %.9f 0.0000000' % (vert_inds[chan], elecmatrix[chan, 0],
-                                                           elecmatrix[chan, 1], elecmatrix[chan, 2]))
+                fid.write('#!ascii label  , from subject %s vox2ras=TkReg\n%d\n' % (self.subj, len(channels)))
+                for c in channels:
+                    fid.write('%i %.9f %.9f %.9f %.7f\n' % (vert_inds[c], elecmatrix[c, 0],
+                                                           elecmatrix[c, 1], elecmatrix[c, 2], c))
+
+        def run_label2label(labelname, trglabel):
+            cmd = ['mri_label2label', '--srclabel', labelname, '--srcsubject', self.subj,
+                   '--trgsubject', template, '--trglabel', trglabel, '--regmethod', 'surface',
+                   '--hemi', self.hem, '--trgsurf', 'pial', '--paint', '6', 'pial', '--sd', self.subj_dir]
+
+            error = ''
+            for attempt in range(retries + 1):
+                if os.path.isfile(trglabel):
+                    os.remove(trglabel)
+                try:
+                    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                    output = proc.communicate()[0].decode('utf-8', 'replace').strip()
+                except OSError as e:
+                    # e.g. mri_label2label is not on the path, retrying will not help
+                    return None, str(e)
+
+                # Get the point rows of the label file (after the two header lines)
+                if proc.returncode == 0 and os.path.isfile(trglabel):
+                    with open(trglabel, 'r') as fid2:
+                        rows = [line.split() for line in fid2.readlines()[2:]]
+                    if len(rows) > 0:
+                        return rows, None
+                # Keep the last line of output, which usually has the error message
+                error = 'mri_label2label exited with %d: %s' % (proc.returncode, output.split('\n')[-1])
+            return None, error
+
+        def warp_channel(c):
+            labelname_nopath = '%s.%s.chan%03d.label' % (self.hem, basename, surface_indices[c])
+            labelname = os.path.join(labels_to_warp_path, labelname_nopath)
+            write_label(labelname, [c])
 
-            print("Warping ch %d" % (chan))
             trglabel = os.path.join(warped_labels_dir, '%s.to.%s.%s' % (self.subj, template, labelname_nopath))
-            os.system('mri_label2label --srclabel ' + labelname + ' --srcsubject ' + self.subj + \
-                      ' --trgsubject ' + template + ' --trglabel ' + trglabel + ' --regmethod surface --hemi ' + self.hem + \
-                      ' --trgsurf pial --paint 6 pial --sd ' + self.subj_dir)
-
-            # Get the electrode coordinate from the label file
-            with open(trglabel, 'r') as fid2:
-                coord = fid2.readlines()[2].split()  # Get the third line
+            rows, error = run_label2label(labelname, trglabel)
+            try:
+                return c, [float(rows[0][1]), float(rows[0][2]), float(rows[0][3])], None
+            except (TypeError, IndexError, ValueError):
+                return c, None, error or 'could not read %s' % (trglabel)
+
+        remaining = np.arange(len(surface_indices))
+        if engine == 'combined' and len(remaining) > 0:
+            print('Warping all electrodes with a single call to mri_label2label')
+            labelname_nopath = '%s.%s.all_chans.label' % (self.hem, basename)
+            labelname = os.path.join(labels_to_warp_path, labelname_nopath)
+            write_label(labelname, remaining)
 
-            elecs_warped[c, :] = ([np.float(coord[1]), np.float(coord[2]), np.float(coord[3])])
-            # else:
-            #     print("Channel %d is a depth electrode, not warping"%(chan))
-            #     elecs_warped.append([np.nan, np.nan, np.nan])
+            trglabel = os.path.join(warped_labels_dir, '%s.to.%s.%s' % (self.subj, template, labelname_nopath))
+            rows, error = run_label2label(labelname, trglabel)
+            if rows is None:
+                print('Combined surface warp failed (%s)' % (error))
+                rows = []
+            for row in rows:
+                try:
+                    c = int(round(float(row[4])))
+                    coord = [float(row[1]), float(row[2]), float(row[3])]
+                except (IndexError, ValueError):
+                    continue
+                # Keep the first point found for each channel
+                if c >= 0 and c < len(surface_indices) and np.isnan(elecs_warped[c, 0]):
+                    elecs_warped[c, :] = coord
+
+            remaining = np.where(np.isnan(elecs_warped[:, 0]))[0]
+            if len(remaining) > 0:
+                print('%d channel(s) were missing from the combined warp' % (len(remaining)))
+
+        if len(remaining) > 0:
+            print('Warping each electrode separately, %d at a time:' % (n_jobs))
+
+        failed = dict()
+        pool = ThreadPool(max(1, n_jobs))
+        try:
+            for c, coord, error in tqdm(pool.imap_unordered(warp_channel, remaining), total=len(remaining)):
+                if coord is None:
+                    failed[surface_indices[c]] = error
+                else:
+                    elecs_warped[c, :] = coord
+        finally:
+            pool.close()
+            pool.join()
 
-            # intersect, t, u, v, xcoor = TriangleRayIntersection(elec, [1000, 0, 0], vert1,vert2,vert3, fullReturn=True)
+        if len(failed) > 0:
+            print('Surface warp failed for %d channel(s), their coordinates are NaN:' % (len(failed)))
+            for chan in sorted(failed):
+                print('  ch %d: %s' % (chan, failed[chan]))
 
         if labelpath == 'tmp/':
             shutil.rmtree(labels_to_warp_path)
@@ -1638,17 +2139,16 @@ class freeCoG:
             depth_atlas_nm = '.a2009s'
 
         #template brain (cvs)
-        cvs_img=nib.freesurfer.load(os.path.join(self.subj_dir, template, 'mri', 'aparc' + depth_atlas_nm + '+aseg.mgz'))
-        cvs_dat=cvs_img.get_data()
+        cvs_dat = Volume(os.path.join(self.subj_dir, template, 'mri', 'aparc' + depth_atlas_nm + '+aseg.mgz'), segmentation=True)
 
         #subj brain 
-        subj_img=nib.freesurfer.load(os.path.join(self.mri_dir, 'aparc' + depth_atlas_nm + '+aseg.mgz'))
-        subj_dat=subj_img.get_data()
+        subj_dat = Volume(os.path.join(self.mri_dir, 'aparc' + depth_atlas_nm + '+aseg.mgz'), segmentation=True)
+        cmap_max = cvs_dat.max()
 
         pdf = PdfPages(os.path.join(self.elecs_dir, 'depthWarpsQC.pdf'))
         for i in range(len(subj_elecnums)): 
             if subj_elecs[i][0] != 0 and subj_elecs[i][0] != 10000:
-                self.plot_elec(subj_elecs[i], warped_elecs[i], subj_dat, cvs_dat, subj_elecnums[i], pdf)
+                self.plot_elec(subj_elecs[i], warped_elecs[i], subj_dat, cvs_dat, subj_elecnums[i], pdf, cmap_max=cmap_max)
         pdf.close()
 
     def apply_xfm(self, xfm_dir='mri/transforms', xfm_file='talairach.xfm', 
@@ -1741,7 +2241,7 @@ class freeCoG:
         print("Done.")
 
      #helper method to check the cvs depth warps:
-    def plot_elec(self, orig_coords, warped_coords, subj_dat, cvs_dat, elec_num,pdf):
+    def plot_elec(self, orig_coords, warped_coords, subj_dat, cvs_dat, elec_num,pdf, cmap_max=None):
         ''' helper method to check the cvs depth warps. Each electrode is one page      
         in the resulting PDF.       
         Top row shows electrodes warped to the CVS brain, bottom row shows the electrodes       
@@ -1749,18 +2249,23 @@ class freeCoG:
         for the warped location matches that of the original subject brain, it is counted       
         as a "MATCH" and has a title in green, otherwise it is a "MISMATCH" and is      
         marked with a red title.        
+
+        subj_dat and cvs_dat can be arrays or img_pipe.volume_io.Volume objects, of
+        which only the three slices through the electrode are read. cmap_max is the
+        largest label in cvs_dat (computed here if not given).
         '''
 
+        if cmap_max is None:
+            cmap_max = cvs_dat.max()
         fs_lut = os.path.join(self.img_pipe_dir, 'SupplementalFiles', 'FreeSurferLUTRGBValues.npy')
-        cmap = matplotlib.colors.ListedColormap(np.load(fs_lut)[:cvs_dat.max()+1,:])
+        cmap = matplotlib.colors.ListedColormap(np.load(fs_lut)[:cmap_max+1,:])
 
         lookupTable = os.path.join(self.img_pipe_dir, 'SupplementalFiles', 'FreeSurferLookupTable')
         lookup_dict = pickle.load(open(lookupTable,'r'))
         fig = plt.figure(figsize=((30,17)))
-        nonzero_indices = np.where(cvs_dat>0)
         offset = 35 #this is how much you want to trim the mri by, there is a lot of empty space
 
-        cvs_dat = cvs_dat[offset:-offset,offset:-offset,offset:-offset]
+        cvs_dat = _CroppedVolume(cvs_dat, offset)
         cvs_vox_CRS = np.array([warped_coords[0]-offset,warped_coords[1]-offset,warped_coords[2]-offset],dtype='int')
 
         plt.subplot(2,3,1)
@@ -1780,7 +2285,7 @@ class freeCoG:
         plt.plot(cvs_vox_CRS[0],cvs_vox_CRS[1],'r*',markersize=14,color='#FFFFFF')
         plt.axis('tight'); ax = plt.gca(); ax.set_axis_off()
 
-        subj_dat = subj_dat[offset:-offset,offset:-offset,offset:-offset]
+        subj_dat = _CroppedVolume(subj_dat, offset)
         subj_vox_CRS = np.array([orig_coords[0]-offset,orig_coords[1]-offset,orig_coords[2]-offset],dtype='int')
 
         ax1=plt.subplot(2,3,4).axes
@@ -1880,6 +2385,7 @@ class freeCoG:
         roi : str
             The region of interest to load.  Should be a Mesh that exists
             in the subject's Meshes directory, called [roi]_trivert.mat
+            (or its binary [roi]_trivert.mesh, see mesh_io)
         template : str, optional
             Name of the template to use if plotting electrodes on an atlas brain. e.g. 'cvs_avg35_inMNI152'
         
@@ -1887,6 +2393,8 @@ class freeCoG:
         -------
         cortex : dict
             Dictionary containing 'tri' and 'vert' for the loaded region of interest mesh.
+            Meshes are kept in self.mesh_store, so the arrays are shared and read-only;
+            copy them before modifying them.
 
         '''
         if hem == '':
@@ -1894,20 +2402,20 @@ class freeCoG:
         if roi == 'pial':
             if hem == 'lh' or hem == 'rh':
                 if template == None:
-                    cortex = scipy.io.loadmat(self.pial_surf_file[hem])
+                    cortex = self.mesh_store.get(self.pial_surf_file[hem])
                 else:
                     template_file = os.path.join(self.subj_dir, template, 'Meshes', hem+'_pial_trivert.mat')
-                    cortex = scipy.io.loadmat(template_file)
+                    cortex = self.mesh_store.get(template_file)
             elif hem == 'stereo':
                 cortex = dict()
                 for h in ['lh', 'rh']:
                     if template == None:
-                        cortex[h] = scipy.io.loadmat(self.pial_surf_file[h])
+                        cortex[h] = self.mesh_store.get(self.pial_surf_file[h])
                     else:
                         template_file = os.path.join(self.subj_dir, template, 'Meshes', h+'_pial_trivert.mat')
-                        cortex[h] = scipy.io.loadmat(template_file)
+                        cortex[h] = self.mesh_store.get(template_file)
         else: 
-            cortex = scipy.io.loadmat(os.path.join(self.mesh_dir, hem + '_' + roi + '_trivert.mat'))
+            cortex = self.mesh_store.get(os.path.join(self.mesh_dir, hem + '_' + roi + '_trivert.mat'))
         return cortex
 
     class roi:
@@ -2069,19 +2577,26 @@ class freeCoG:
                 #use pial surface of the entire hemisphere
                 if roi_name in ('pial', 'lh_pial'):
                     lh_pial = self.get_surf(hem='lh', template=template)
+                    if gaussian:
+                        kwargs.update(tree=self.get_mesh_cache(hem='lh', template=template).vert_tree())
                     mesh, mlab = ctmr_brain_plot.ctmr_gauss_plot(lh_pial['tri'], lh_pial['vert'], **kwargs)
 
                 if roi_name in ('pial', 'rh_pial'):
                     rh_pial = self.get_surf(hem='rh', template=template)
+                    if gaussian:
+                        kwargs.update(tree=self.get_mesh_cache(hem='rh', template=template).vert_tree())
                     mesh, mlab = ctmr_brain_plot.ctmr_gauss_plot(rh_pial['tri'], rh_pial['vert'], **kwargs)
                     
             else:
                 subcort_dir = os.path.join(self.mesh_dir,'subcortical')
                 if os.path.isdir(subcort_dir) and '%s_subcort_trivert.mat'%(roi_name) in os.listdir(subcort_dir):
-                    roi_mesh = scipy.io.loadmat(os.path.join(subcort_dir,'%s_subcort_trivert.mat'%(roi_name)))
+                    roi_file = os.path.join(subcort_dir,'%s_subcort_trivert.mat'%(roi_name))
                 else:
-                    roi_mesh = scipy.io.loadmat(os.path.join(self.mesh_dir,'%s_trivert.mat'%(roi_name)))
+                    roi_file = os.path.join(self.mesh_dir,'%s_trivert.mat'%(roi_name))
+                roi_mesh = self.mesh_store.get(roi_file)
 
+                if gaussian:
+                    kwargs.update(tree=self.get_vert_tree(roi_mesh['vert'], mesh_file=roi_file))
                 mesh, mlab = ctmr_brain_plot.ctmr_gauss_plot(roi_mesh['tri'], roi_mesh['vert'], **kwargs)
 
         if not any_gaussian and elecs is not None:
@@ -2342,8 +2857,11 @@ class freeCoG:
         from .plotting import ctmr_brain_plot as ctmr_brain_plot
         from .SupplementalFiles import FS_colorLUT as FS_colorLUT
 
+        # Copies, since the vertices are shifted below
         subj_brain = self.get_surf()
+        subj_brain['vert'] = subj_brain['vert'].copy()
         template_brain = self.get_surf(template=template)
+        template_brain['vert'] = template_brain['vert'].copy()
 
         # Get native space and warped electrodes
         subj_e = self.get_elecs(elecfile_prefix=elecfile_prefix)
@@ -2448,6 +2966,37 @@ class freeCoG:
 
         '''
 
+        roi_meshes = self.make_roi_meshes({roi_name: label_list}, hem=hem, save=save)
+        if roi_meshes is None:
+            return
+        roi_mesh = roi_meshes[roi_name]
+
+        if showfig:
+            from .plotting import ctmr_brain_plot as ctmr_brain_plot   
+            mesh,mlab = ctmr_brain_plot.ctmr_gauss_plot(roi_mesh['tri'],roi_mesh['vert'])
+            mlab.show()
+        
+        return roi_mesh
+
+    def make_roi_meshes(self, rois, hem=None, save=True):
+        ''' Makes meshes for several cortical ROIs in one pass, loading the
+        hemisphere's surface and each label file only once (see make_roi_mesh).
+
+        Parameters
+        ----------
+        rois : dict
+            ROI name -> list of labels making up that ROI (as label_list in make_roi_mesh)
+        hem : {None, 'lh', 'rh'}
+            If None, defaults to the implantation hemisphere.  Otherwise uses the hemisphere specified by the user.
+        save : bool
+            If save=True, the meshes are saved to the $SUBJECTS_DIR/Meshes/.  Otherwise they are not saved.
+
+        Returns
+        -------
+        roi_meshes : dict
+            ROI name -> dictionary with the 'tri' and 'vert' of its mesh
+        '''
+
         if hem==None:
             if self.hem != 'lh' and self.hem != 'rh':
                 print('You need to specify which hemisphere this ROI is in. Please try again and specify the hemisphere in the hem argument.')
@@ -2457,43 +3006,102 @@ class freeCoG:
 
         cortex = self.get_surf(hem=hem)
 
-        roi_mesh = {}
-        vertnums = []
-
-        for label in label_list:
-            this_label = os.path.join(self.patient_dir, 'label', 'gyri', '%s.%s.label'%(hem, label))
-            f = open(this_label, 'r')
-            all_lines_str = [x.split() for x in f.read().split('\n')[2:][:-1]]
-            all_lines_float = []
-            for line in range(len(all_lines_str)):
-                all_lines_float.append([float(x) for x in all_lines_str[line]])
-            verts = np.array(all_lines_float, dtype=np.int)
-            vertnums.extend(verts[:,0].tolist())
-        vertnums = sorted(vertnums)
-        roi_mesh['vert'] = cortex['vert'][vertnums, :]
-        
-        # Find the triangles for these vertex numbers
-        tri_row_inds = np.sort(np.array(list(set(np.where(np.in1d(cortex['tri'][:,0],vertnums))[0]) & set(np.where(np.in1d(cortex['tri'][:,1],vertnums))[0]) & set(np.where(np.in1d(cortex['tri'][:,2],vertnums))[0]))))
-        tri_list = cortex['tri'][tri_row_inds,:]
-        lookup = {vertnums[i]:i for i in range(len(vertnums))}
-       
-        tri_list_reindexed = np.copy(tri_list)
-        for k, v in lookup.iteritems():
-            tri_list_reindexed[tri_list==k] = v
+        label_verts = dict()
+        roi_meshes = dict()
+        for roi_name, label_list in rois.items():
+            vertnums = []
+            for label in label_list:
+                if label not in label_verts:
+                    this_label = os.path.join(self.patient_dir, 'label', 'gyri', '%s.%s.label'%(hem, label))
+                    label_verts[label] = nib.freesurfer.read_label(this_label)
+                vertnums.append(label_verts[label])
+
+            roi_mesh = dict()
+            roi_mesh['vert'], roi_mesh['tri'] = mesh_cache.extract_submesh(cortex['vert'], cortex['tri'], np.hstack(vertnums))
+            roi_meshes[roi_name] = roi_mesh
+
+            if save:
+                output_mesh = os.path.join(self.mesh_dir,'%s_%s_trivert.mat'%(hem, roi_name))
+                print("Saving this mesh to %s"%(output_mesh))
+                mesh_io.save_trivert(output_mesh, roi_mesh['vert'], roi_mesh['tri'])
+
+        return roi_meshes
+
+    def split_surface_rois(self, hem=None, atlas='desikan-killiany', save=False):
+        ''' Splits a hemisphere's pial surface into one mesh per label of a
+        freesurfer parcellation, reading the annotation once (see get_vert_labels)
+        and partitioning all triangles in a single pass. As in make_roi_mesh, each
+        ROI mesh has every vertex with that label and the triangles whose three
+        vertices all have that label.
 
-        roi_mesh['tri'] = tri_list_reindexed
+        Parameters
+        ----------
+        hem : {None, 'lh', 'rh'}
+            If None, defaults to the implantation hemisphere.
+        atlas : {'desikan-killiany', 'destrieux'}
+            Which parcellation to split the surface by
+        save : bool
+            If save=True, each mesh is saved to Meshes/[hem]_[roi]_trivert.mat
 
-        if showfig:
-            from .plotting import ctmr_brain_plot as ctmr_brain_plot   
-            mesh,mlab = ctmr_brain_plot.ctmr_gauss_plot(roi_mesh['tri'],roi_mesh['vert'])
-            mlab.show()
+        Returns
+        -------
+        roi_meshes : dict
+            ROI name -> dictionary with the 'tri' and 'vert' of its mesh. Vertices
+            without a label are not part of any ROI.
+
+        Raises IOError/OSError if the annotation file does not exist.
+        '''
+
+        if hem==None:
+            if self.hem != 'lh' and self.hem != 'rh':
+                print('You need to specify which hemisphere to split. Please try again and specify the hemisphere in the hem argument.')
+                return
+            else:
+                hem = self.hem
+
+        vert_labels, label_names = self.get_vert_labels(hem=hem, atlas=atlas)
+        cortex = self.get_surf(hem=hem)
+        vert, tri = cortex['vert'], cortex['tri']
+
+        # Unlabeled vertices (-1) go with the last, 'Unknown', entry
+        nlabels = label_names.shape[0]
+        vert_labels = np.where(vert_labels < 0, nlabels - 1, vert_labels)
+
+        # Group the vertices by label (in increasing index order within a label)
+        # and number them from 0 within their label
+        vert_order = np.argsort(vert_labels, kind='mergesort')
+        vert_counts = np.bincount(vert_labels, minlength=nlabels)
+        vert_starts = np.cumsum(vert_counts) - vert_counts
+        new_inds = np.zeros(vert_labels.shape, dtype=tri.dtype)
+        new_inds[vert_order] = np.arange(vert_order.shape[0]) - np.repeat(vert_starts, vert_counts)
+
+        # Triangles whose vertices share a label, grouped by that label
+        tri_labels = vert_labels[tri]
+        inside = (tri_labels[:,0] == tri_labels[:,1]) & (tri_labels[:,1] == tri_labels[:,2])
+        roi_tri = new_inds[tri[inside,:]]
+        tri_labels = tri_labels[inside,0]
+        tri_order = np.argsort(tri_labels, kind='mergesort')
+        roi_tri = roi_tri[tri_order,:]
+        tri_counts = np.bincount(tri_labels, minlength=nlabels)
+        tri_starts = np.cumsum(tri_counts) - tri_counts
+
+        roi_meshes = dict()
+        for label in range(nlabels - 1):
+            if vert_counts[label] == 0:
+                continue
+            roi_mesh = dict()
+            roi_mesh['vert'] = vert[vert_order[vert_starts[label]:vert_starts[label]+vert_counts[label]],:]
+            roi_mesh['tri'] = roi_tri[tri_starts[label]:tri_starts[label]+tri_counts[label],:]
+            roi_meshes[label_names[label]] = roi_mesh
+
+            if save:
+                output_mesh = os.path.join(self.mesh_dir,'%s_%s_trivert.mat'%(hem, label_names[label]))
+                mesh_io.save_trivert(output_mesh, roi_mesh['vert'], roi_mesh['tri'])
 
         if save:
-            output_mesh = os.path.join(self.mesh_dir,'%s_%s_trivert.mat'%(hem, roi_name))
-            print("Saving this mesh to %s"%(output_mesh))
-            scipy.io.savemat(output_mesh, roi_mesh)
-        
-        return roi_mesh
+            print("Saved %d ROI meshes to %s"%(len(roi_meshes), self.mesh_dir))
+
+        return roi_meshes
     
     def write_to_obj(self, hem=None, roi_name='pial'):
         '''This function writes the mesh for a given roi to .obj format.
@@ -2571,7 +3179,7 @@ class freeCoG:
             tri[:, 2] = face[:, 6] - 1
 
         out_file_trivert = os.path.join(self.mesh_dir, '%s_%s_trivert.mat'%(hem, roi_name))
-        scipy.io.savemat(out_file_trivert, {'tri': tri, 'vert': vert})
+        mesh_io.save_trivert(out_file_trivert, vert, tri)
 
         cortex = {'tri': tri+1, 'vert': vert}
         out_file_struct = os.path.join(self.mesh_dir, '%s_%s.mat' % (hem, roi_name))
@@ -2682,12 +3290,17 @@ class freeCoG:
             color_dict = FS_colorLUT.get_lut()
 
         mlab.figure(fgcolor=(0, 0, 0), bgcolor=bgcolor, size=size)
-        rois = self.get_rois()
+        rois = [roi for roi in self.get_rois() if 'ctx-' + self.hem + '-' + roi in color_dict]
+        try:
+            roi_meshes = self.split_surface_rois()
+            rois = [roi for roi in rois if roi in roi_meshes]
+        except (IOError, OSError):
+            # No annotation file, build the meshes from the label files
+            roi_meshes = self.make_roi_meshes(dict([(roi, [roi]) for roi in rois]), save=False)
         for roi in tqdm(rois):
-            if 'ctx-' + self.hem + '-' + roi in color_dict:
-                mesh = self.make_roi_mesh(roi, [roi], save=False)
-                color = np.array(color_dict['ctx-' + self.hem + '-' + roi]) / 255.
-                ctmr_gauss_plot(mesh['tri'], mesh['vert'], color=color, new_fig=False, **kwargs)
+            mesh = roi_meshes[roi]
+            color = np.array(color_dict['ctx-' + self.hem + '-' + roi]) / 255.
+            ctmr_gauss_plot(mesh['tri'], mesh['vert'], color=color, new_fig=False, **kwargs)
 
         if self.hem == 'lh':
             azimuth = 180
@@ -2934,6 +3547,32 @@ class freeCoG:
 
 # Functions #
 
+def convert_fsmesh2mlab_cohort(patients, mesh_name='pial', n_jobs=1, force=False):
+    '''
+    Convert the surfaces of several subjects to .mat files in one pool of
+    workers (see freeCoG.convert_fsmesh2mlab). Surfaces whose .mat files
+    are newer than the surface are skipped.
+
+    Parameters
+    ----------
+    patients : list of freeCoG
+        The subjects to convert surfaces for
+    mesh_name : str or list of str
+        Surface(s) to convert, e.g. ['pial', 'white', 'inflated', 'dural']
+    n_jobs : int
+        Number of surfaces to convert at the same time
+    force : bool
+        Convert surfaces even if their .mat files are up to date
+    '''
+    if isinstance(mesh_name, str):
+        mesh_name = [mesh_name]
+    jobs = []
+    for patient in patients:
+        jobs.extend(patient._fsmesh2mlab_jobs(mesh_name, force=force))
+    _convert_fsmeshes(jobs, n_jobs=n_jobs)
+    for patient in patients:
+        patient._set_surf_files(mesh_name)
+
 def remove_whitespace(brain_image):
     '''
     Remove white space from an image
@@ -2963,6 +3602,112 @@ def remove_whitespace(brain_image):
     return brain_image, x_offset, y_offset
 
 # Private Functions
+class _CroppedVolume(object):
+    ''' View of a volume (array or volume_io.Volume) with [offset] voxels trimmed
+    from every side, that reads only the voxels that are indexed.'''
+    def __init__(self, data, offset):
+        self.data = data
+        self.offset = offset
+        self.shape = tuple([n - 2*offset for n in data.shape])
+
+    def __getitem__(self, key):
+        # Integers and slices, translated like numpy does for an array of
+        # self.shape; missing trailing indices select the whole axis
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > len(self.shape):
+            raise IndexError('too many indices for volume of shape %s'%(self.shape,))
+        key = key + (slice(None),)*(len(self.shape) - len(key))
+        data_key = []
+        for k, n in zip(key, self.shape):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(n)
+                stop = stop + self.offset
+                # A stop before the first voxel (negative steps) means "through index 0"
+                data_key.append(slice(start + self.offset, stop if stop >= 0 else None, step))
+            else:
+                k = int(k)
+                if k < -n or k >= n:
+                    raise IndexError('index %d is out of bounds for axis with size %d'%(k, n))
+                data_key.append((k + n if k < 0 else k) + self.offset)
+        return self.data[tuple(data_key)]
+
+def _convert_fsmesh(job):
+    ''' Write the trivert and MATLAB .mat files of one FreeSurfer surface.'''
+    mesh_surf, out_file, out_file_struct = job
+    vert, tri = nib.freesurfer.read_geometry(mesh_surf)
+    mesh_io.save_trivert(out_file, vert, tri)
+    mesh_cache.invalidate(out_file)
+
+    cortex = {'tri': tri+1, 'vert': vert}
+    scipy.io.savemat(out_file_struct, {'cortex': cortex})
+    return out_file
+
+def _convert_fsmeshes(jobs, n_jobs=1):
+    ''' Run _convert_fsmesh over [jobs] in a pool of [n_jobs] threads.'''
+    if len(jobs) == 0:
+        return
+    if n_jobs == 1:
+        for job in jobs:
+            print("Making %s"%(job[1]))
+            _convert_fsmesh(job)
+        return
+    pool = ThreadPool(max(1, n_jobs))
+    try:
+        for out_file in tqdm(pool.imap_unordered(_convert_fsmesh, jobs), total=len(jobs)):
+            pass
+    finally:
+        pool.close()
+        pool.join()
+
+def _vert_digest(verts):
+    ''' Content hash of a vertex array, used to key per-mesh spatial indices.'''
+    verts = np.ascontiguousarray(verts)
+    h = hashlib.sha1(str(verts.shape).encode('utf-8') + str(verts.dtype).encode('utf-8'))
+    h.update(verts.view(np.uint8))
+    return h.hexdigest()
+
+def _per_level(value, nlevels, name):
+    ''' A scalar repeated, or a list checked, for each of [nlevels] levels.'''
+    values = np.atleast_1d(value)
+    if values.shape[0] == 1:
+        return np.repeat(values, nlevels)
+    if values.shape[0] != nlevels:
+        raise ValueError('%s must be a single value or one value per pyramid level'%(name))
+    return values
+
+def _downsample_image(img, factor):
+    ''' A nipy image averaged over blocks of [factor] voxels along each axis,
+    with its coordinate map scaled to match (for the pyramid levels of reg_img).
+    Voxels left over at the far edges are dropped.'''
+    data = img.get_fdata()
+    n = [s//factor for s in data.shape[:3]]
+    data = data[:n[0]*factor, :n[1]*factor, :n[2]*factor]
+    data = data.reshape(n[0], factor, n[1], factor, n[2], factor).mean(axis=(1, 3, 5))
+    # Coarse voxel i is centered on fine voxel i*factor + (factor-1)/2
+    scale = np.diag([factor, factor, factor, 1.])
+    scale[:3, 3] = (factor - 1)/2.
+    cmap = img.coordmap
+    coordmap = AffineTransform(cmap.function_domain, cmap.function_range, np.dot(cmap.affine, scale))
+    return Image.from_image(img, data=data, coordmap=coordmap)
+
+# Parsed FreeSurferColorLUT.txt files, keyed by (path, mtime)
+_fs_luts = dict()
+
+def _load_fs_lut(lut_file):
+    ''' Dictionary of label number to label name from a freesurfer color lookup
+    table, parsed once per session.'''
+    key = (os.path.abspath(lut_file), os.path.getmtime(lut_file))
+    if key not in _fs_luts:
+        lab = {}
+        with open(lut_file) as fid:
+            for row in fid:
+                row = row.split()
+                if len(row)>1 and row[0].isdigit(): # Get rid of the comments
+                    lab[int(row[0])] = row[1]
+        _fs_luts[key] = lab
+    return _fs_luts[key]
+
 def _str2bool(v):
     ''' Changes a string to a boolean.'''
     if v.lower() in ('yes', 'true', 't', 'y', '1'):
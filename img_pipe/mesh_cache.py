@@ -0,0 +1,280 @@
+# mesh_cache.py
+''' This module contains a small on-disk cache for quantities that are
+ derived from triangle-mesh files (the vertex spatial index, vertex normals,
+ vertex adjacency, the convex hull, ...).  Artifacts are stored in a
+ hidden directory next to the mesh (e.g. [subj_dir]/[subj]/Meshes/.cache)
+ and are keyed by a content hash of the source file, so a mesh that is
+ rewritten (for example by freeCoG.convert_fsmesh2mlab) is never matched
+ with stale artifacts.
+
+ usage: cache = MeshCache('/path/to/Meshes/lh_pial_trivert.mat')
+        tree = cache.vert_tree()
+        hull = cache.convex_hull()
+
+'''
+
+import os
+import hashlib
+import pickle
+
+import numpy as np
+import scipy.io
+import scipy.sparse
+import scipy.spatial
+
+from . import mesh_io
+
+CACHE_DIRNAME = '.cache'
+
+# Content hashes already computed in this session, keyed by (path, mtime, size)
+_file_hashes = dict()
+
+def file_hash(fname, blocksize=2**20):
+    ''' Get the SHA1 content hash of a file.  Hashes are remembered for the
+    rest of the session as long as the file's modification time and size
+    do not change.
+
+    Parameters
+    ----------
+    fname : str
+        Path to the file
+    blocksize : int
+        Number of bytes to read at a time
+
+    Returns
+    -------
+    digest : str
+        Hex digest of the file contents
+    '''
+    st = os.stat(fname)
+    key = (os.path.abspath(fname), st.st_mtime, st.st_size)
+    if key not in _file_hashes:
+        h = hashlib.sha1()
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(blocksize), b''):
+                h.update(block)
+        _file_hashes[key] = h.hexdigest()
+    return _file_hashes[key]
+
+def invalidate(source_file, cache_dir=None):
+    ''' Remove every cached artifact that was derived from [source_file],
+    whatever version of the file it was computed from.
+
+    Parameters
+    ----------
+    source_file : str
+        Path to the mesh (or other source) file
+    cache_dir : str, optional
+        Cache directory. Defaults to the .cache directory next to [source_file]
+    '''
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(source_file), CACHE_DIRNAME)
+    if not os.path.isdir(cache_dir):
+        return
+    prefix = os.path.basename(source_file) + '.'
+    for fname in os.listdir(cache_dir):
+        if fname.startswith(prefix):
+            os.remove(os.path.join(cache_dir, fname))
+
+def vertex_normals(tri, vert):
+    ''' Area-weighted unit normal vector at each vertex of a triangle mesh.
+
+    Parameters
+    ----------
+    tri : array-like
+        [ntriangles x 3] zero-indexed triangle vertex indices
+    vert : array-like
+        [nvertices x 3] vertex coordinates
+
+    Returns
+    -------
+    normals : array-like
+        [nvertices x 3] unit normals.  Vertices that do not belong to any
+        triangle get a zero vector.
+    '''
+    tri = np.asarray(tri, dtype=int)
+    vert = np.asarray(vert, dtype=float)
+    # Un-normalized face normals have a length of twice the triangle area
+    face_normals = np.cross(vert[tri[:,1],:] - vert[tri[:,0],:],
+                            vert[tri[:,2],:] - vert[tri[:,0],:])
+    normals = np.zeros(vert.shape)
+    for i in range(3):
+        for j in range(3):
+            normals[:,j] += np.bincount(tri[:,i], weights=face_normals[:,j], minlength=vert.shape[0])
+    norm = np.sqrt(np.sum(normals**2, axis=1))
+    norm[norm == 0] = 1.
+    return normals / norm[:,np.newaxis]
+
+def vertex_adjacency(tri, nverts):
+    ''' Sparse, symmetric vertex adjacency matrix of a triangle mesh.
+
+    Parameters
+    ----------
+    tri : array-like
+        [ntriangles x 3] zero-indexed triangle vertex indices
+    nverts : int
+        Number of vertices in the mesh
+
+    Returns
+    -------
+    adjacency : scipy.sparse.csr_matrix
+        [nverts x nverts] matrix with ones wherever two vertices share an edge
+    '''
+    tri = np.asarray(tri, dtype=int)
+    rows = np.hstack((tri[:,0], tri[:,1], tri[:,2], tri[:,1], tri[:,2], tri[:,0]))
+    cols = np.hstack((tri[:,1], tri[:,2], tri[:,0], tri[:,0], tri[:,1], tri[:,2]))
+    adjacency = scipy.sparse.coo_matrix((np.ones(rows.shape[0]), (rows, cols)),
+                                        shape=(nverts, nverts)).tocsr()
+    # Edges shared by two triangles were counted twice
+    adjacency.data[:] = 1.
+    return adjacency
+
+def extract_submesh(vert, tri, vert_inds):
+    ''' The part of a triangle mesh made of the given vertices and the
+    triangles whose three vertices are all among them.
+
+    Parameters
+    ----------
+    vert : array-like
+        [nvertices x 3] vertex coordinates
+    tri : array-like
+        [ntriangles x 3] zero-indexed triangle vertex indices
+    vert_inds : array-like
+        Indices of the vertices to keep (duplicates are ignored)
+
+    Returns
+    -------
+    sub_vert : array-like
+        [nkept x 3] coordinates of the kept vertices, in increasing index order
+    sub_tri : array-like
+        Triangles of the submesh, indexing into [sub_vert]
+    '''
+    vert = np.asarray(vert)
+    tri = np.asarray(tri)
+    vert_inds = np.unique(np.asarray(vert_inds, dtype=int))
+    keep = np.zeros((vert.shape[0],), dtype=bool)
+    keep[vert_inds] = True
+    sub_tri = tri[np.all(keep[tri], axis=1),:]
+    # Old to new vertex index
+    new_inds = -np.ones((vert.shape[0],), dtype=tri.dtype)
+    new_inds[vert_inds] = np.arange(vert_inds.shape[0])
+    return vert[vert_inds,:], new_inds[sub_tri]
+
+class DerivedCache(object):
+    ''' On-disk cache of artifacts derived from one source file.
+
+    Parameters
+    ----------
+    source_file : str
+        The file the cached artifacts are computed from
+    cache_dir : str, optional
+        Where to store the artifacts. Defaults to a .cache directory next
+        to [source_file].
+
+    Attributes
+    ----------
+    source_file : str
+    cache_dir : str
+    key : str
+        Content hash of [source_file] when the cache was opened
+    '''
+
+    def __init__(self, source_file, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(source_file), CACHE_DIRNAME)
+        self.source_file = source_file
+        self.cache_dir = cache_dir
+        self.key = file_hash(source_file)
+        self._memory = dict()
+
+    def is_current(self):
+        ''' Whether the source file still has the contents this cache was opened with.'''
+        return os.path.isfile(self.source_file) and file_hash(self.source_file) == self.key
+
+    def cache_file(self, name):
+        ''' Path of the cache file holding the artifact [name].'''
+        return os.path.join(self.cache_dir, '%s.%s.%s.pkl'%(os.path.basename(self.source_file), self.key[:16], name))
+
+    def get(self, name, compute):
+        ''' Get the artifact [name], computing and storing it with [compute]
+        (a function of no arguments) if it has not been cached yet.'''
+        if name in self._memory:
+            return self._memory[name]
+
+        fname = self.cache_file(name)
+        value = None
+        if os.path.isfile(fname):
+            try:
+                with open(fname, 'rb') as f:
+                    value = pickle.load(f)
+            except Exception:
+                # Unreadable (e.g. written by another python version), recompute it
+                value = None
+
+        if value is None:
+            value = compute()
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # Write to a temporary file first so readers never see a partial file
+            tmp_fname = '%s.%d.tmp'%(fname, os.getpid())
+            with open(tmp_fname, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            if os.path.isfile(fname):
+                os.remove(fname)
+            os.rename(tmp_fname, fname)
+
+        self._memory[name] = value
+        return value
+
+class MeshCache(DerivedCache):
+    ''' On-disk cache of artifacts derived from a [hem]_[roi]_trivert.mat mesh.
+
+    Parameters
+    ----------
+    mesh_file : str
+        Path to the .mat file with 'tri' and 'vert'
+    cache_dir : str, optional
+        Where to store the artifacts. Defaults to [Meshes]/.cache
+    mesh_store : mesh_io.MeshStore, optional
+        Store to load the mesh from, so its arrays are shared (read-only)
+        with the other users of the store
+
+    '''
+
+    def __init__(self, mesh_file, cache_dir=None, mesh_store=None):
+        super(MeshCache, self).__init__(mesh_file, cache_dir=cache_dir)
+        self.mesh_store = mesh_store
+        self._mesh = None
+
+    @property
+    def mesh(self):
+        ''' Dictionary with the 'tri' and 'vert' of the mesh, loaded on first access.'''
+        if self.mesh_store is not None:
+            return self.mesh_store.get(self.source_file)
+        if self._mesh is None:
+            self._mesh = mesh_io.load_trivert(self.source_file)
+        return self._mesh
+
+    def vert_tree(self):
+        ''' k-d tree (scipy.spatial.cKDTree) over the mesh vertices.'''
+        return self.get('vert_tree', lambda: scipy.spatial.cKDTree(self.mesh['vert']))
+
+    def vert_normals(self):
+        ''' [nvertices x 3] area-weighted unit vertex normals.'''
+        return self.get('vert_normals', lambda: vertex_normals(self.mesh['tri'], self.mesh['vert']))
+
+    def vert_adjacency(self):
+        ''' Sparse vertex adjacency matrix.'''
+        return self.get('vert_adjacency', lambda: vertex_adjacency(self.mesh['tri'], self.mesh['vert'].shape[0]))
+
+    def convex_hull(self):
+        ''' Triangles of the Delaunay convex hull of the mesh vertices.'''
+        return self.get('convex_hull', lambda: scipy.spatial.Delaunay(self.mesh['vert']).convex_hull)
+
+    def triangle_bvh(self, convex_hull=False):
+        ''' Bounding volume hierarchy over the mesh triangles (or over the
+        triangles of the convex hull), for intersecting lines with the mesh.'''
+        from .surface_warping_scripts.triangle_bvh import TriangleBVH
+        if convex_hull:
+            return self.get('hull_bvh', lambda: TriangleBVH(self.mesh['vert'], self.convex_hull()))
+        return self.get('bvh', lambda: TriangleBVH(self.mesh['vert'], self.mesh['tri']))
@@ -0,0 +1,211 @@
+# mesh_io.py
+''' This module contains a compact binary format for triangle meshes, written
+ next to the [hem]_[roi]_trivert.mat files.  A .mesh file is a 16 byte
+ header (the magic string IPMESH followed by a two digit format version,
+ then the number of vertices and of triangles as little-endian int32)
+ followed by the vertices as little-endian float64 and the zero-indexed
+ triangles as little-endian int32.  It is loaded with np.memmap, so opening
+ a mesh does not parse or copy it.  The vertices are float64, like those
+ read from the .mat files, so loading from either gives the same values.
+
+ The .mat files are still written (MATLAB and older code read them), and a
+ .mesh file is only used while it is at least as new as its .mat file and
+ has the current format version (version 01 files held float32 vertices).
+
+ usage: save_trivert('/path/to/Meshes/lh_pial_trivert.mat', vert, tri)
+        cortex = load_trivert('/path/to/Meshes/lh_pial_trivert.mat')
+        store = MeshStore(max_bytes=256*2**20)
+        cortex = store.get('/path/to/Meshes/lh_pial_trivert.mat')
+
+'''
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+import scipy.io
+
+MAGIC = b'IPMESH'
+VERSION = b'02'
+HEADER_DTYPE = np.dtype([('magic', 'S8'), ('nvert', '<i4'), ('ntri', '<i4')])
+
+# Default byte budget of a MeshStore
+MESH_STORE_BYTES = 512*2**20
+
+def mesh_file(trivert_file):
+    ''' Path of the binary mesh that goes with a [hem]_[roi]_trivert.mat file.'''
+    return os.path.splitext(trivert_file)[0] + '.mesh'
+
+def write_mesh(fname, vert, tri):
+    ''' Write a mesh in the binary format.
+
+    Parameters
+    ----------
+    fname : str
+        Output file (usually mesh_file([trivert .mat file]))
+    vert : array-like
+        [nvertices x 3] vertex coordinates
+    tri : array-like
+        [ntriangles x 3] zero-indexed triangle vertex indices
+    '''
+    vert = np.ascontiguousarray(vert, dtype='<f8').reshape(-1, 3)
+    tri = np.ascontiguousarray(tri, dtype='<i4').reshape(-1, 3)
+    header = np.array([(MAGIC + VERSION, vert.shape[0], tri.shape[0])], dtype=HEADER_DTYPE)
+    # Write to a temporary file first so readers never see a partial file
+    tmp_fname = '%s.%d.tmp'%(fname, os.getpid())
+    with open(tmp_fname, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(vert.tobytes())
+        f.write(tri.tobytes())
+    if os.path.isfile(fname):
+        os.remove(fname)
+    os.rename(tmp_fname, fname)
+
+def read_mesh(fname):
+    ''' Read a mesh in the binary format.
+
+    Parameters
+    ----------
+    fname : str
+        A file written by write_mesh
+
+    Returns
+    -------
+    mesh : dict
+        'vert' ([nvertices x 3] float64) and 'tri' ([ntriangles x 3] int32),
+        memory-mapped copy-on-write from [fname]
+
+    Raises ValueError if [fname] is not a binary mesh of the current version.
+    '''
+    header = np.fromfile(fname, dtype=HEADER_DTYPE, count=1)
+    if header.shape[0] != 1 or header['magic'][0][:len(MAGIC)] != MAGIC:
+        raise ValueError('%s is not a binary mesh file'%(fname))
+    if header['magic'][0][len(MAGIC):] != VERSION:
+        raise ValueError('%s is a binary mesh of an older version'%(fname))
+    nvert = int(header['nvert'][0])
+    ntri = int(header['ntri'][0])
+    offset = HEADER_DTYPE.itemsize
+    mesh = dict()
+    mesh['vert'] = np.memmap(fname, dtype='<f8', mode='c', offset=offset, shape=(nvert, 3))
+    mesh['tri'] = np.memmap(fname, dtype='<i4', mode='c', offset=offset + nvert*3*8, shape=(ntri, 3))
+    return mesh
+
+def save_trivert(trivert_file, vert, tri):
+    ''' Save a mesh as a trivert .mat file and as a binary mesh next to it.
+
+    Parameters
+    ----------
+    trivert_file : str
+        The .mat file, e.g. [Meshes]/lh_pial_trivert.mat
+    vert : array-like
+        [nvertices x 3] vertex coordinates
+    tri : array-like
+        [ntriangles x 3] zero-indexed triangle vertex indices
+    '''
+    scipy.io.savemat(trivert_file, {'tri': tri, 'vert': vert})
+    write_mesh(mesh_file(trivert_file), vert, tri)
+
+def load_trivert(trivert_file):
+    ''' Load a trivert mesh, from its binary mesh if that is up to date (and
+    of the current version) and from the .mat file otherwise.
+
+    Parameters
+    ----------
+    trivert_file : str
+        The .mat file, e.g. [Meshes]/lh_pial_trivert.mat
+
+    Returns
+    -------
+    mesh : dict
+        Dictionary with the 'tri' and 'vert' of the mesh
+    '''
+    fname = mesh_file(trivert_file)
+    if os.path.isfile(fname) and (not os.path.isfile(trivert_file) or
+                                  os.path.getmtime(fname) >= os.path.getmtime(trivert_file)):
+        try:
+            return read_mesh(fname)
+        except ValueError:
+            if not os.path.isfile(trivert_file):
+                raise
+    return scipy.io.loadmat(trivert_file)
+
+class MeshStore(object):
+    ''' In-memory store of trivert meshes, loaded on first access and kept
+    until the total size of the stored meshes exceeds [max_bytes], when the
+    least recently used meshes are dropped. A mesh whose .mat or .mesh file
+    has changed is loaded again.
+
+    The arrays handed out are read-only, since they are shared by every
+    caller; copy them before modifying them.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Byte budget for the stored 'tri' and 'vert' arrays
+
+    Attributes
+    ----------
+    max_bytes : int
+    nbytes : int
+        Bytes currently stored
+    '''
+
+    def __init__(self, max_bytes=MESH_STORE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._meshes = OrderedDict()
+
+    def _stamp(self, trivert_file):
+        # Modification times of the files load_trivert may read
+        stamp = []
+        for fname in [trivert_file, mesh_file(trivert_file)]:
+            stamp.append(os.path.getmtime(fname) if os.path.isfile(fname) else None)
+        return tuple(stamp)
+
+    def get(self, trivert_file):
+        ''' The mesh stored in [trivert_file] (see load_trivert).
+
+        Parameters
+        ----------
+        trivert_file : str
+            The .mat file, e.g. [Meshes]/lh_pial_trivert.mat
+
+        Returns
+        -------
+        mesh : dict
+            A new dictionary with the (read-only) 'tri' and 'vert' of the mesh
+        '''
+        key = os.path.abspath(trivert_file)
+        stamp = self._stamp(trivert_file)
+        entry = self._meshes.pop(key, None)
+        if entry is not None and entry[0] != stamp:
+            self.nbytes -= entry[2]
+            entry = None
+        if entry is None:
+            loaded = load_trivert(trivert_file)
+            mesh = dict()
+            for name in ['tri', 'vert']:
+                mesh[name] = loaded[name].view()
+                mesh[name].flags.writeable = False
+            nbytes = mesh['tri'].nbytes + mesh['vert'].nbytes
+            entry = (stamp, mesh, nbytes)
+            self.nbytes += nbytes
+        # Most recently used last
+        self._meshes[key] = entry
+        self._evict()
+        return dict(entry[1])
+
+    def __contains__(self, trivert_file):
+        ''' Whether [trivert_file] is stored (whether or not it is up to date).'''
+        return os.path.abspath(trivert_file) in self._meshes
+
+    def _evict(self):
+        # Drop least recently used meshes, but always keep the newest one
+        while self.nbytes > self.max_bytes and len(self._meshes) > 1:
+            _, (_, _, nbytes) = self._meshes.popitem(last=False)
+            self.nbytes -= nbytes
+
+    def clear(self):
+        ''' Drop all stored meshes.'''
+        self._meshes.clear()
+        self.nbytes = 0
@@ -26,6 +26,7 @@ Kai Miller and Dora Hermes (ctmr_gui, see https://github.com/dorahermes/Paper_He
 '''
 
 import scipy.io
+import scipy.spatial
 import mayavi
 from mayavi import mlab
 import numpy as np
@@ -35,7 +36,8 @@ from matplotlib import cm
 def ctmr_gauss_plot(tri, vert, color=(0.8, 0.8, 0.8), elecs=None, weights=None,
                     opacity = 1.0, representation='surface', line_width=1.0, gsp = 10,
                     cmap=mpl.cm.get_cmap('RdBu_r'), show_colorbar=True, new_fig=True, vmin=None, vmax=None,
-                    ambient=0.4225, specular = 0.333, specular_power = 66, diffuse = 0.6995, interpolation='phong'):
+                    ambient=0.4225, specular = 0.333, specular_power = 66, diffuse = 0.6995, interpolation='phong',
+                    gauss_cutoff=1e-6, dtype=np.float64, tree=None):
     ''' This function plots the 3D brain surface mesh
     
     Parameters
@@ -61,6 +63,13 @@ def ctmr_gauss_plot(tri, vert, color=(0.8, 0.8, 0.8), elecs=None, weights=None,
         gsp : float
             gaussian smoothing parameter, larger makes electrode activity
             more spread out across the surface if specified
+        gauss_cutoff, dtype, tree :
+            passed to gauss_weights to compute the gaussian weights. The
+            cutoff applies before the colors are scaled to the largest
+            weight, so if only the tails of the gaussians reach the mesh
+            (its colors are below 1000*gauss_cutoff of the largest weight)
+            the weights are computed again without the cutoff. A mesh that
+            no electrode reaches is plotted in [color].
     
     Returns
     -------
@@ -74,18 +83,20 @@ def ctmr_gauss_plot(tri, vert, color=(0.8, 0.8, 0.8), elecs=None, weights=None,
     #c = np.zeros(vert.shape[0],)
 
     if elecs is not None:
-        brain_color = np.zeros(vert.shape[0],)
-        for i in np.arange(elecs.shape[0]):
-            b_z = np.abs(vert[:, 2] - elecs[i, 2])
-            b_y = np.abs(vert[:, 1] - elecs[i, 1])
-            b_x = np.abs(vert[:, 0] - elecs[i, 0])
-            gauss_wt = np.nan_to_num(weights[i] * np.exp((-(b_x**2+b_z**2+b_y**2))/gsp)) #gaussian
-            brain_color = brain_color + gauss_wt
-
-        #scale the colors so that it matches the weights that were passed in
-        brain_color = brain_color * (np.abs(weights).max()/np.abs(brain_color).max())
-        if vmin==None and vmax==None:
-            vmin, vmax = -np.abs(brain_color).max(), np.abs(brain_color).max()
+        brain_color = gauss_weights(vert, elecs, weights, gsp=gsp, cutoff=gauss_cutoff, dtype=dtype, tree=tree)
+        weights_max = np.abs(weights).max()
+        if gauss_cutoff > 0 and np.abs(brain_color).max() < 1000*gauss_cutoff*weights_max:
+            # The scaling below would magnify what the cutoff left out
+            brain_color = gauss_weights(vert, elecs, weights, gsp=gsp, cutoff=0, dtype=dtype)
+
+        if np.abs(brain_color).max() > 0:
+            #scale the colors so that it matches the weights that were passed in
+            brain_color = brain_color * (weights_max/np.abs(brain_color).max())
+            if vmin==None and vmax==None:
+                vmin, vmax = -np.abs(brain_color).max(), np.abs(brain_color).max()
+        else:
+            print("No electrode weights reach this mesh, plotting it without them")
+            elecs = None
 
     # plot cortex and begin display
     if new_fig:
@@ -115,7 +126,7 @@ def ctmr_gauss_plot(tri, vert, color=(0.8, 0.8, 0.8), elecs=None, weights=None,
 
     #mesh2 = mlab.pipeline.set_active_attribute(mesh, cell_scalars = 'Cell data')
     #mlab.pipeline.surface(mesh)
-    if weights is not None and show_colorbar:
+    if elecs is not None and weights is not None and show_colorbar:
         mlab.colorbar()
 
     # change OpenGL mesh properties for phong point light shading
@@ -135,6 +146,89 @@ def ctmr_gauss_plot(tri, vert, color=(0.8, 0.8, 0.8), elecs=None, weights=None,
 
     return mesh, mlab
 
+def gauss_weights(vert, elecs, weights, gsp=10, cutoff=1e-6, dtype=np.float64, tree=None, max_pairs=2**22):
+    ''' Paints the electrode weights onto the mesh vertices: the value at each
+    vertex is the sum over electrodes of weights[i]*exp(-d**2/gsp), with d
+    the distance from the vertex to electrode i.
+
+    Parameters
+    ----------
+        vert : array-like
+            [nverts x 3] matrix of mesh vertices
+        elecs : array-like
+            [nchans x 3] matrix of electrode coordinate values in 3D
+        weights : array-like
+            [nchans] weight of each electrode
+        gsp : float
+            gaussian smoothing parameter
+        cutoff : float
+            contributions smaller than [cutoff] times the electrode's weight
+            are left out, so only the vertices within sqrt(-gsp*log(cutoff))
+            of each electrode are evaluated. Use 0 to evaluate every vertex.
+        dtype : numpy dtype
+            type of the result and of the computation (np.float32 is faster
+            and uses half the memory)
+        tree : scipy.spatial.cKDTree
+            spatial index over [vert] to find the vertices near each electrode
+            (e.g. from freeCoG.get_vert_tree), built here if not given
+        max_pairs : int
+            approximate number of (electrode, vertex) pairs to evaluate at a
+            time, to bound memory use. With a cutoff, the blocks of electrodes
+            are sized from the number of nearby vertices found so far
+
+    Returns
+    -------
+    brain_color : array-like
+        [nverts] painted weights
+    '''
+    vert = np.asarray(vert)
+    elecs = np.atleast_2d(np.asarray(elecs, dtype=float))
+    weights = np.asarray(weights, dtype=float).ravel()
+    brain_color = np.zeros((vert.shape[0],), dtype=dtype)
+
+    # Electrodes with NaN coordinates or weights do not paint anything
+    good = np.all(np.isfinite(elecs), axis=1) & np.isfinite(weights)
+    elecs = elecs[good,:].astype(dtype)
+    weights = weights[good].astype(dtype)
+    if elecs.shape[0] == 0 or vert.shape[0] == 0:
+        return brain_color
+
+    if cutoff <= 0:
+        # Every vertex, for a block of electrodes at a time
+        vert = vert.astype(dtype)
+        chunk_size = max(1, max_pairs//vert.shape[0])
+        for start in range(0, elecs.shape[0], chunk_size):
+            stop = start + chunk_size
+            dist2 = np.sum((vert[None,:,:] - elecs[start:stop,None,:])**2, axis=2)
+            brain_color += np.dot(weights[start:stop], np.exp(-dist2/gsp))
+        return brain_color
+
+    # Only the vertices near each electrode
+    radius = np.sqrt(-gsp*np.log(cutoff))
+    if tree is None:
+        tree = scipy.spatial.cKDTree(vert)
+    # Blocks of electrodes sized from the number of vertices found near the
+    # electrodes so far, so each block has about max_pairs pairs
+    start, chunk_size = 0, 1
+    npairs, nelecs = 0, 0
+    while start < elecs.shape[0]:
+        stop = min(start + chunk_size, elecs.shape[0])
+        neighbors = tree.query_ball_point(elecs[start:stop,:], radius)
+        counts = np.array([len(n) for n in neighbors], dtype=int)
+        npairs += counts.sum()
+        nelecs += stop - start
+        chunk_size = max(1, int(max_pairs*nelecs//max(npairs, 1)))
+        elec_inds = start + np.repeat(np.arange(stop - start), counts)
+        start = stop
+        if counts.sum() == 0:
+            continue
+        vert_inds = np.concatenate([np.asarray(n, dtype=int) for n in neighbors])
+        dist2 = np.sum((vert[vert_inds,:].astype(dtype) - elecs[elec_inds,:])**2, axis=1)
+        gauss_wt = weights[elec_inds]*np.exp(-dist2/gsp)
+        # Add up the contributions to each vertex and add them to the buffer
+        painted, inv = np.unique(vert_inds, return_inverse=True)
+        brain_color[painted] += np.bincount(inv.ravel(), weights=gauss_wt).astype(dtype)
+    return brain_color
 
 def el_add(elecs, color = (1., 0., 0.), msize = 2, numbers = None, label_offset=-1.0, ambient = 0.3261, specular = 1, specular_power = 16, diffuse = 0.6995, interpolation = 'phong', **kwargs):
     '''This function adds the electrode matrix [elecs] (nchans x 3) to
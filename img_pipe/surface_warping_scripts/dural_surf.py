@@ -0,0 +1,181 @@
+import numpy as np
+import nibabel as nib
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
+from mne import write_surface
+
+from .make_outer_surf import outer_surf_from_fill, conformed_vox2ras_tkr
+from .triangle_bvh import TriangleBVH
+from ..mesh_cache import vertex_normals, vertex_adjacency
+
+def fill_surface(vert, tri, shape, vox2ras, max_pairs=2**22):
+    '''
+    Voxels of a volume that lie inside a closed surface, as made by
+    mris_fill. A line is cast along the third voxel axis through the center
+    of each column of voxels, and voxels are inside if the line crosses the
+    surface an odd number of times before reaching them.
+
+     Inputs: vert:       [nvertices x 3] surface RAS vertex coordinates
+             tri:        [ntriangles x 3] zero-indexed triangle vertex indices
+             shape:      shape of the volume to fill
+             vox2ras:    [4 x 4] voxel to surface RAS transform of the volume
+             max_pairs:  approximate number of (line, triangle) candidate
+                         pairs to test at a time, to bound memory use
+
+     Output: filled:     uint8 volume of [shape], 1 inside the surface
+    '''
+    tri = np.asarray(tri, dtype=int)
+    vox = nib.affines.apply_affine(np.linalg.inv(vox2ras), np.asarray(vert, dtype=float))
+    filled = np.zeros(shape[:3], dtype=np.uint8)
+
+    lo = np.maximum(np.floor(vox.min(axis=0)).astype(int), 0)
+    hi = np.minimum(np.ceil(vox.max(axis=0)).astype(int) + 1, shape[:3])
+    if np.any(hi <= lo):
+        return filled
+
+    # Shift the lines off the voxel centers by a fraction of a voxel so they
+    # do not pass exactly through vertices or edges on a regular grid
+    jitter = np.array([1.234e-4, 2.345e-4])
+    bvh = TriangleBVH(vox, tri)
+    v0, v1, v2 = vox[tri[:,0],:], vox[tri[:,1],:], vox[tri[:,2],:]
+
+    # Number of crossings below each voxel center (only its parity matters)
+    toggles = np.zeros(hi - lo, dtype=np.uint8)
+    ny = hi[1] - lo[1]
+    rows_per_chunk = max(1, int(max_pairs // max(1, ny*64)))
+    for i0 in range(lo[0], hi[0], rows_per_chunk):
+        i1 = min(i0 + rows_per_chunk, hi[0])
+        ii, jj = np.mgrid[i0:i1, lo[1]:hi[1]]
+        orig = np.zeros((ii.size, 3))
+        orig[:,0] = ii.ravel() + jitter[0]
+        orig[:,1] = jj.ravel() + jitter[1]
+        ray_inds, tri_inds = bvh.query_line(orig, np.array([0., 0., 1.]))
+        if ray_inds.shape[0] == 0:
+            continue
+
+        # Barycentric coordinates of the line in the xy projection of each triangle
+        p = orig[ray_inds,:2]
+        a, b, c = v0[tri_inds,:], v1[tri_inds,:], v2[tri_inds,:]
+        e1 = b[:,:2] - a[:,:2]
+        e2 = c[:,:2] - a[:,:2]
+        d = p - a[:,:2]
+        det = e1[:,0]*e2[:,1] - e1[:,1]*e2[:,0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            u = (d[:,0]*e2[:,1] - d[:,1]*e2[:,0])/det
+            w = (e1[:,0]*d[:,1] - e1[:,1]*d[:,0])/det
+        hit = (det != 0) & (u >= 0) & (w >= 0) & (u + w <= 1)
+        z = a[hit,2] + u[hit]*(b[hit,2] - a[hit,2]) + w[hit]*(c[hit,2] - a[hit,2])
+
+        # First voxel center above each crossing
+        k = np.floor(z).astype(int) + 1 - lo[2]
+        ray = ray_inds[hit]
+        keep = k < toggles.shape[2]
+        np.add.at(toggles, (ii.ravel()[ray[keep]] - lo[0], jj.ravel()[ray[keep]] - lo[1],
+                            np.maximum(k[keep], 0)), 1)
+
+    inside = np.cumsum(toggles, axis=2, dtype=np.uint8) % 2
+    filled[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]] = inside
+    return filled
+
+def largest_component(vert, tri):
+    '''
+    Keeps the largest connected piece of a triangle mesh, as
+    mris_extract_main_component does.
+
+     Inputs: vert:       [nvertices x 3] vertex coordinates
+             tri:        [ntriangles x 3] zero-indexed triangle vertex indices
+
+     Output: vert:       vertices of the largest component
+             tri:        its triangles, indexing into the returned [vert]
+    '''
+    tri = np.asarray(tri, dtype=int)
+    ncomp, comp = connected_components(vertex_adjacency(tri, vert.shape[0]), directed=False)
+    if ncomp > 1:
+        # Size of each component in triangles
+        sizes = np.bincount(comp[tri[:,0]], minlength=ncomp)
+        main = np.argmax(sizes)
+        tri = tri[comp[tri[:,0]] == main,:]
+    used = np.unique(tri)
+    new_inds = -np.ones((vert.shape[0],), dtype=int)
+    new_inds[used] = np.arange(used.shape[0])
+    return vert[used,:], new_inds[tri]
+
+def smooth_surface(vert, tri, num_iter, method='laplacian'):
+    '''
+    Smooths a surface by repeatedly moving each vertex towards the mean of
+    its neighbors.
+
+     Inputs: vert:       [nvertices x 3] vertex coordinates
+             tri:        [ntriangles x 3] zero-indexed triangle vertex indices
+             num_iter:   number of iterations
+             method:     'laplacian' replaces each vertex with the average
+                         of itself and its neighbors, as mris_smooth does.
+                         'taubin' alternates a shrinking and an inflating
+                         step, which smooths without shrinking the surface.
+
+     Output: vert:       smoothed vertex coordinates
+    '''
+    if method not in ['laplacian', 'taubin']:
+        raise ValueError("method must be 'laplacian' or 'taubin'")
+    vert = np.asarray(vert, dtype=float)
+    adjacency = vertex_adjacency(tri, vert.shape[0])
+    nnbrs = np.asarray(adjacency.sum(axis=1)).ravel()
+    if method == 'laplacian':
+        # Average of the vertex and its neighbors
+        avg = scipy.sparse.diags(1./(nnbrs + 1)).dot(adjacency + scipy.sparse.identity(vert.shape[0]))
+        steps = [(avg, 1.)]
+    else:
+        nnbrs[nnbrs == 0] = 1
+        avg = scipy.sparse.diags(1./nnbrs).dot(adjacency)
+        steps = [(avg, 0.5), (avg, -0.53)]
+    for it in range(num_iter):
+        for avg, factor in steps:
+            vert = vert + factor*(avg.dot(vert) - vert)
+    return vert
+
+def dilate_surface(vert, tri, dist):
+    '''
+    Moves each vertex of a closed surface outwards along its normal.
+
+     Inputs: vert:       [nvertices x 3] vertex coordinates
+             tri:        [ntriangles x 3] zero-indexed triangle vertex indices
+             dist:       distance to move each vertex (in mm)
+
+     Output: vert:       dilated vertex coordinates
+    '''
+    vert = np.asarray(vert, dtype=float)
+    tri = np.asarray(tri, dtype=int)
+    normals = vertex_normals(tri, vert)
+    # The normals point outwards if the enclosed (signed) volume is positive
+    volume = np.sum(vert[tri[:,0],:]*np.cross(vert[tri[:,1],:], vert[tri[:,2],:]))
+    if volume < 0:
+        normals = -normals
+    return vert + dist*normals
+
+def dural_surface(pial_file, outfile, num_iter=30, dilate=0.0, smoothing='laplacian'):
+    '''
+    Creates a smoothed dural surface from a pial surface without calling
+    FreeSurfer: the pial surface is filled, its outer surface is found as in
+    make_outer_surf, and the largest piece of that surface is smoothed,
+    dilated and written to [outfile].
+
+     Inputs: pial_file:  pial surface (e.g. lh.pial)
+             outfile:    surface file to write the dural surface to (e.g. lh.dural)
+             num_iter:   number of smoothing iterations
+             dilate:     distance (in mm) to move the surface outwards
+             smoothing:  'laplacian' or 'taubin' (see smooth_surface)
+    '''
+    vert, tri, volume_info = nib.freesurfer.read_geometry(pial_file, read_metadata=True)
+    shape = (256, 256, 256)
+    if 'volume' in volume_info:
+        shape = tuple([int(n) for n in volume_info['volume']])
+    vox2ras = conformed_vox2ras_tkr(shape)
+
+    filled = fill_surface(vert, tri, shape, vox2ras)
+    vert, tri = outer_surf_from_fill(filled, vox2ras)
+    vert, tri = largest_component(vert, tri)
+    vert = smooth_surface(vert, tri, num_iter, method=smoothing)
+    if dilate != 0:
+        vert = dilate_surface(vert, tri, abs(dilate))
+
+    write_surface(outfile, vert, tri, volume_info=volume_info)
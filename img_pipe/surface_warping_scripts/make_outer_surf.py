@@ -1,11 +1,78 @@
 import sys
 import numpy as np
 import nibabel as nib
-from scipy.signal import convolve
-from scipy.ndimage.morphology import grey_closing, generate_binary_structure
+from scipy.ndimage.morphology import grey_closing
 from mne import write_surface
 from mcubes import marching_cubes
 
+def outer_surf_mask(filld):
+    '''
+    Smooth, threshold and close a filled pial volume to get the binary mask
+    whose boundary is the outer surface.
+
+    This gives the same mask as smoothing each slice with a 2x2 box filter
+    in float64, thresholding at 25 and running grey_closing with a 3D cross
+    structuring element, but works on 8 and 16 bit arrays in a single pass
+    over the volume:
+      - a voxel of the smoothed slice is 0.25*(sum of its 2x2 window), so the
+        threshold is an integer test on shifted sums of the volume
+      - grey_closing with the (non-flat) cross structure, followed by
+        thresholding at half its maximum, keeps exactly the voxels of a
+        flat 3x3x3 closing of the binary mask
+
+    Args:
+        filld: filled pial volume (e.g. data of lh.pial.filled.mgz), where
+               voxels equal to 1 are inside the surface
+
+    Returns:
+        BW2: uint8 volume of the same shape, 255 inside the mask and 0 outside
+    '''
+    filld = np.asarray(filld)
+    filld = np.where(filld == 1, 255, filld)
+    if filld.dtype.kind in 'bui' and filld.min() >= 0 and filld.max() <= 255:
+        # The sum of four 8 bit values fits in 16 bits
+        window = filld.astype(np.uint16)
+    else:
+        window = filld.astype(np.float32)
+
+    # 2x2 window sums over the first two axes ('same' convolution, so each
+    # voxel is added to its neighbors at +1 along x, y and both)
+    window[1:,:,:] += window[:-1,:,:].copy()
+    window[:,1:,:] += window[:,:-1,:].copy()
+    mask = (window > 100).view(np.uint8)
+    del window
+
+    BW2 = grey_closing(mask, size=(3,3,3))
+    BW2 *= 255
+    return BW2
+
+def outer_surf_from_fill(filld, vox2ras):
+    '''
+    Outer surface of a filled pial volume, as a mesh in surface RAS.
+
+    Args:
+        filld: filled pial volume, where voxels equal to 1 are inside the surface
+        vox2ras: [4 x 4] voxel to surface RAS (tkregister) transform of [filld]
+
+    Returns:
+        v2: [nvertices x 3] vertex coordinates
+        f: [ntriangles x 3] triangle vertex indices
+    '''
+    # Only process the bounding box of the filled voxels. The smoothing and
+    # closing reach 3 voxels beyond the fill, so with a margin of 4 empty
+    # voxels the mask is the same as for the whole volume.
+    lo, hi = _padded_bbox(filld, pad=4)
+    if lo is None:
+        raise ValueError('The filled volume is empty')
+    BW2 = outer_surf_mask(filld[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]])
+
+    v, f = marching_cubes(BW2, 100)
+
+    # Back to voxel coordinates of the whole volume, then to surface RAS
+    v = v + lo
+    v2 = nib.affines.apply_affine(vox2ras, v)
+    return v2, f
+
 def make_outer_surf(orig_pial, image, radius, outfile):
     '''
     Make outer surface based on a pial volume and radius,
@@ -27,37 +94,60 @@ def make_outer_surf(orig_pial, image, radius, outfile):
     volume_info = pial_surf[2]
 
     fill = nib.load( image )
-    filld = fill.get_data()
-    filld[filld==1] = 255
-
-    gaussian = np.ones((2,2))*.25
-
-    image_f = np.zeros((256,256,256))
-
-    for slice in xrange(256):
-        temp = filld[:,:,slice]
-        image_f[:,:,slice] = convolve(temp, gaussian, 'same')
-
-    image2 = np.zeros((256,256,256))
-    image2[np.where(image_f <= 25)] = 0
-    image2[np.where(image_f > 25)] = 255
-
-    strel15 = generate_binary_structure(3, 1)
-
-    BW2 = grey_closing(image2, structure=strel15)
-    thresh = np.max(BW2)/2
-    BW2[np.where(BW2 <= thresh)] = 0
-    BW2[np.where(BW2 > thresh)] = 255
-
-    v, f = marching_cubes(BW2, 100)
-
-    v2 = np.transpose(
-             np.vstack( ( 128 - v[:,0],
-                          v[:,2] - 128,
-                          128 - v[:,1], )))
+    v2, f = outer_surf_from_fill(np.asanyarray(fill.dataobj), _vox2ras_tkr(fill))
     
     write_surface(outfile, v2, f, volume_info=volume_info)
 
+    peak = _peak_memory_mb()
+    if peak is not None:
+        print("Peak memory use while making %s: %.0f MB"%(outfile, peak))
+
+def _padded_bbox(data, pad):
+    ''' Bounds [lo, hi) of the nonzero voxels of [data], grown by [pad]
+    voxels on each side and clipped to the volume. Returns (None, None) if
+    there are no nonzero voxels.'''
+    lo = np.zeros((3,), dtype=int)
+    hi = np.zeros((3,), dtype=int)
+    for axis in range(3):
+        other = tuple([a for a in range(3) if a != axis])
+        inds = np.where(np.any(data, axis=other))[0]
+        if inds.shape[0] == 0:
+            return None, None
+        lo[axis] = max(inds[0] - pad, 0)
+        hi[axis] = min(inds[-1] + 1 + pad, data.shape[axis])
+    return lo, hi
+
+def conformed_vox2ras_tkr(shape):
+    ''' Voxel to surface RAS (tkregister) transform of a conformed (LIA, 1mm)
+    volume of the given shape, centered on the middle voxel as for 256^3
+    FreeSurfer volumes.'''
+    nx, ny, nz = shape[:3]
+    return np.array([[-1., 0., 0., nx/2.],
+                     [0., 0., 1., -nz/2.],
+                     [0., -1., 0., ny/2.],
+                     [0., 0., 0., 1.]])
+
+def _vox2ras_tkr(img):
+    ''' Voxel to surface RAS (tkregister) transform of a volume, assuming a
+    conformed volume for images without a FreeSurfer header.'''
+    try:
+        return img.header.get_vox2ras_tkr()
+    except AttributeError:
+        return conformed_vox2ras_tkr(img.shape)
+
+def _peak_memory_mb():
+    ''' Peak resident memory of this process in MB, or None if it is not
+    available on this platform.'''
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux and bytes on macOS
+    if sys.platform == 'darwin':
+        return peak/1024./1024.
+    return peak/1024.
+
 if __name__=='__main__':
 
     if not len(sys.argv) == 4:
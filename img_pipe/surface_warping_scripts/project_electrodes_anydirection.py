@@ -1,6 +1,16 @@
 import numpy as np
 
-def project_electrodes_anydirection(tri, vert, elecmatrix, proj_direction):
+from .triangle_bvh import TriangleBVH
+
+# Approximate number of bytes of temporary arrays needed per (ray, triangle)
+# pair in TriangleRayIntersectionBatch
+_BYTES_PER_PAIR = 128
+
+# Meshes with fewer triangles than this are intersected by brute force, since
+# building a BVH would take longer than testing every triangle
+BVH_MIN_TRIANGLES = 4096
+
+def project_electrodes_anydirection(tri, vert, elecmatrix, proj_direction, batch=True, max_bytes=2**28, bvh=None):
     ''' 
     Projects electrode locations onto the convex hull of a cortical surface.
     This allows for the electrode locations to wrap smoothly around the
@@ -15,6 +25,18 @@ def project_electrodes_anydirection(tri, vert, elecmatrix, proj_direction):
              proj_direction:    a string with value
                            'lh','rh','top','bottom','front','back' depending
                            on where you want electrodes to project to
+             batch:        if True (default), intersect all electrodes with
+                           the mesh at once in chunked, vectorized passes
+                           (see TriangleRayIntersectionBatch). If False,
+                           loop over electrodes one at a time.
+             max_bytes:    memory budget (in bytes) for the temporary arrays
+                           of each chunk in batch mode (default 256 MB)
+             bvh:          a TriangleBVH built from [tri] and [vert], so the
+                           hierarchy can be reused across calls on the same
+                           mesh. If None, one is built here for meshes with
+                           at least BVH_MIN_TRIANGLES triangles; smaller
+                           meshes are intersected by brute force. Only used
+                           in batch mode.
 
      Output: elecs_proj:   A [nchans] x 3 position array of locations of
                            electrodes that have been projected to the convex
@@ -50,6 +72,20 @@ def project_electrodes_anydirection(tri, vert, elecmatrix, proj_direction):
     vert2 = vert[tri[:,1],:]
     vert3 = vert[tri[:,2],:]
 
+    if batch and bvh is None and tri.shape[0] >= BVH_MIN_TRIANGLES:
+        bvh = TriangleBVH(vert, tri)
+
+    if batch and bvh is not None:
+        _, elecs_proj, _ = TriangleRayIntersectionBVH(elecmatrix, direction, bvh, vert1, vert2, vert3,
+                                                      max_bytes=max_bytes)
+        return elecs_proj
+
+    if batch:
+        # Keep the intersection closest to each electrode, same as the loop below
+        _, elecs_proj, _ = TriangleRayIntersectionBatch(elecmatrix, direction, vert1, vert2, vert3,
+                                                        max_bytes=max_bytes)
+        return elecs_proj
+
     elecs_proj = np.zeros(elecmatrix.shape)
     elec_intersect = np.zeros((elecmatrix.shape[0],1))
     for i in range(elecmatrix.shape[0]): # Loop through all electrodes  
@@ -265,3 +301,191 @@ def TriangleRayIntersection (orig, direction, vert0, vert1, vert2, planeType='tw
         xcoor[o,:] = (vert0[o,:] + edge1[o,:]*u[o] + edge2[o,:]*v[o])
 
     return np.array(intersect), np.array(t), np.array(u), np.array(v), xcoor
+
+def TriangleRayIntersectionBatch(orig, direction, vert0, vert1, vert2, planeType='two sided', border='normal', eps=1e-5, max_bytes=2**28):
+    '''
+    Intersects many rays that share one direction with a triangle mesh and
+    returns, for each ray, the intersection closest to the ray origin. Uses
+    the same Moller-Trumbore test as TriangleRayIntersection, but evaluates
+    all (ray, triangle) pairs in vectorized chunks instead of one ray at a
+    time.
+
+     Inputs: orig:         [nrays x 3] ray origins
+             direction:    length 3 ray direction shared by all rays
+             vert0, vert1, vert2: [ntriangles x 3] triangle vertices
+             planeType, border, eps: as in TriangleRayIntersection
+             max_bytes:    memory budget (in bytes) for the temporary arrays
+                           of each chunk. Rays and triangles are split into
+                           chunks so that each pass stays under this budget.
+
+     Output: intersect:    [nrays] boolean array, whether each ray hits the mesh
+             xcoor:        [nrays x 3] closest intersection coordinates (NaN
+                           where there is no intersection)
+             tri_ind:      [nrays] index of the triangle that was hit (-1
+                           where there is no intersection)
+    '''
+    orig = np.atleast_2d(np.array(orig, dtype=float))
+    direction = np.array(direction, dtype=float).ravel()
+    vert0, vert1, vert2 = np.atleast_2d(vert0), np.atleast_2d(vert1), np.atleast_2d(vert2)
+
+    if border=='normal':
+        zero=0.0
+    elif border=='inclusive':
+        zero=eps
+    elif border=='exclusive':
+        zero=-eps
+    else:
+        print("Using 'normal' border parameter")
+        zero=0.0
+
+    nrays = orig.shape[0]
+    ntri = vert0.shape[0]
+
+    # Per-triangle quantities do not depend on the ray origin, so they are
+    # computed only once
+    edge1 = vert1 - vert0
+    edge2 = vert2 - vert0
+    pvec = np.cross(direction, edge2)
+    det = np.sum(edge1*pvec, axis=1)
+    if planeType=='one sided':
+        angleOK = det>eps
+    else:
+        angleOK = np.abs(det)>eps
+    inv_det = np.zeros(det.shape)
+    inv_det[angleOK] = 1.0/det[angleOK]
+
+    # Choose chunk sizes to stay within the memory budget
+    max_pairs = max(1, int(max_bytes // _BYTES_PER_PAIR))
+    ray_step = max(1, min(nrays, max_pairs))
+    tri_step = max(1, max_pairs // ray_step)
+
+    best_t = np.inf + np.zeros((nrays,))
+    best_tri = -np.ones((nrays,), dtype=int)
+    best_u = np.zeros((nrays,))
+    best_v = np.zeros((nrays,))
+
+    with np.errstate(invalid='ignore'):
+        for r0 in range(0, nrays, ray_step):
+            rays = slice(r0, min(r0+ray_step, nrays))
+            o = orig[rays,:]
+            row = np.arange(o.shape[0])
+            for t0 in range(0, ntri, tri_step):
+                tris = slice(t0, min(t0+tri_step, ntri))
+                if not np.any(angleOK[tris]):
+                    continue
+                tvec = o[:,np.newaxis,:] - vert0[np.newaxis,tris,:]
+                u = np.einsum('rtk,tk->rt', tvec, pvec[tris,:]) * inv_det[tris]
+                qvec = np.cross(tvec, edge1[np.newaxis,tris,:])
+                del tvec
+                v = np.dot(qvec, direction) * inv_det[tris]
+                t = np.einsum('rtk,tk->rt', qvec, edge2[tris,:]) * inv_det[tris]
+                del qvec
+
+                ok = angleOK[tris] & (u>=-zero) & (v>=-zero) & ((u+v)<=(1.0+zero))
+                abs_t = np.where(ok, np.abs(t), np.inf)
+
+                # Closest intersection in this chunk for each ray
+                j = np.argmin(abs_t, axis=1)
+                closer = abs_t[row,j] < best_t[rays]
+                if np.any(closer):
+                    rr = row[closer]
+                    best_t[r0+rr] = abs_t[rr,j[closer]]
+                    best_tri[r0+rr] = t0+j[closer]
+                    best_u[r0+rr] = u[rr,j[closer]]
+                    best_v[r0+rr] = v[rr,j[closer]]
+
+    intersect = best_tri>=0
+    xcoor = np.nan+np.zeros((nrays,3))
+    hit = best_tri[intersect]
+    xcoor[intersect,:] = vert0[hit,:] + edge1[hit,:]*best_u[intersect,np.newaxis] + edge2[hit,:]*best_v[intersect,np.newaxis]
+
+    return intersect, xcoor, best_tri
+
+def TriangleRayIntersectionBVH(orig, direction, bvh, vert0, vert1, vert2, planeType='two sided', border='normal', eps=1e-5, max_bytes=2**28):
+    '''
+    Same as TriangleRayIntersectionBatch, but only tests each ray against
+    the triangles in the leaves of [bvh] (a TriangleBVH of the mesh) whose
+    boxes the ray crosses, instead of against every triangle.
+
+     Inputs: orig:         [nrays x 3] ray origins
+             direction:    length 3 ray direction shared by all rays
+             bvh:          TriangleBVH built from the same triangles
+             vert0, vert1, vert2: [ntriangles x 3] triangle vertices
+             planeType, border, eps: as in TriangleRayIntersection
+             max_bytes:    memory budget (in bytes) for the temporary arrays
+                           of each chunk of (ray, triangle) pairs
+
+     Output: intersect:    [nrays] boolean array, whether each ray hits the mesh
+             xcoor:        [nrays x 3] closest intersection coordinates (NaN
+                           where there is no intersection)
+             tri_ind:      [nrays] index of the triangle that was hit (-1
+                           where there is no intersection)
+    '''
+    orig = np.atleast_2d(np.array(orig, dtype=float))
+    direction = np.array(direction, dtype=float).ravel()
+    vert0, vert1, vert2 = np.atleast_2d(vert0), np.atleast_2d(vert1), np.atleast_2d(vert2)
+
+    if border=='normal':
+        zero=0.0
+    elif border=='inclusive':
+        zero=eps
+    elif border=='exclusive':
+        zero=-eps
+    else:
+        print("Using 'normal' border parameter")
+        zero=0.0
+
+    nrays = orig.shape[0]
+    best_t = np.inf + np.zeros((nrays,))
+    best_tri = -np.ones((nrays,), dtype=int)
+    best_u = np.zeros((nrays,))
+    best_v = np.zeros((nrays,))
+
+    ray_inds, tri_inds = bvh.query_line(orig, direction)
+
+    step = max(1, int(max_bytes // _BYTES_PER_PAIR))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for p0 in range(0, ray_inds.shape[0], step):
+            r = ray_inds[p0:p0+step]
+            k = tri_inds[p0:p0+step]
+            edge1 = vert1[k,:] - vert0[k,:]
+            edge2 = vert2[k,:] - vert0[k,:]
+            tvec = orig[r,:] - vert0[k,:]
+            pvec = np.cross(direction, edge2)
+            det = np.sum(edge1*pvec, axis=1)
+            if planeType=='one sided':
+                angleOK = det>eps
+            else:
+                angleOK = np.abs(det)>eps
+            inv_det = np.zeros(det.shape)
+            inv_det[angleOK] = 1.0/det[angleOK]
+
+            u = np.sum(tvec*pvec, axis=1) * inv_det
+            qvec = np.cross(tvec, edge1)
+            v = np.dot(qvec, direction) * inv_det
+            t = np.sum(edge2*qvec, axis=1) * inv_det
+
+            ok = angleOK & (u>=-zero) & (v>=-zero) & ((u+v)<=(1.0+zero))
+            r, k, u, v, abs_t = r[ok], k[ok], u[ok], v[ok], np.abs(t[ok])
+
+            # Closest intersection in this chunk for each ray: sort by ray,
+            # then distance, and keep the first pair of each ray
+            order = np.lexsort((k, abs_t, r))
+            first = np.ones(order.shape, dtype=bool)
+            first[1:] = r[order[1:]] != r[order[:-1]]
+            order = order[first]
+
+            closer = abs_t[order] < best_t[r[order]]
+            order = order[closer]
+            best_t[r[order]] = abs_t[order]
+            best_tri[r[order]] = k[order]
+            best_u[r[order]] = u[order]
+            best_v[r[order]] = v[order]
+
+    intersect = best_tri>=0
+    xcoor = np.nan+np.zeros((nrays,3))
+    hit = best_tri[intersect]
+    xcoor[intersect,:] = vert0[hit,:] + (vert1[hit,:]-vert0[hit,:])*best_u[intersect,np.newaxis] \
+                         + (vert2[hit,:]-vert0[hit,:])*best_v[intersect,np.newaxis]
+
+    return intersect, xcoor, best_tri
@@ -0,0 +1,59 @@
+import os
+
+import numpy as np
+import nibabel as nib
+import scipy.spatial
+
+def read_sphere(subj_dir, subj, hem, surf='sphere.reg'):
+    '''
+    Reads the vertices of a subject's spherical registration surface.
+
+     Inputs: subj_dir:    freesurfer subjects directory
+             subj:        subject (or template) name
+             hem:         'lh' or 'rh'
+             surf:        name of the surface (default 'sphere.reg')
+
+     Output: vert:        [nvertices x 3] vertex coordinates of
+                          [subj_dir]/[subj]/surf/[hem].[surf]
+    '''
+    vert, _ = nib.freesurfer.read_geometry(os.path.join(subj_dir, subj, 'surf', '%s.%s'%(hem, surf)))
+    return vert
+
+def sphere_tree(sphere_vert):
+    '''
+    Spatial index over the vertices of a sphere, after projecting them to the
+    unit sphere so the nearest vertex is the one with the smallest angle.
+    '''
+    return scipy.spatial.cKDTree(_unit(sphere_vert))
+
+def sphere_surface_warp(src_inds, src_sphere, trg_sphere, trg_vert, trg_tree=None):
+    '''
+    Warps vertices of one subject's surface to another subject's surface
+    through their spherical registrations, in the same way as
+    mri_label2label --regmethod surface: each source vertex is matched to
+    the nearest target vertex on the registered spheres.
+
+     Inputs: src_inds:    [nchans] vertex indices on the source surface
+             src_sphere:  [nvertices x 3] source ?h.sphere.reg vertices
+             trg_sphere:  [mvertices x 3] target ?h.sphere.reg vertices (may
+                          be None if [trg_tree] is given)
+             trg_vert:    [mvertices x 3] target surface (e.g. pial) vertices,
+                          in the same order as [trg_sphere]
+             trg_tree:    optional sphere_tree(trg_sphere), to reuse the
+                          spatial index across calls
+
+     Output: trg_inds:    [nchans] matching vertex indices on the target
+             elecs_warped: [nchans x 3] coordinates of those vertices on
+                          the target surface
+    '''
+    if trg_tree is None:
+        trg_tree = sphere_tree(trg_sphere)
+    src_inds = np.asarray(src_inds, dtype=int)
+    _, trg_inds = trg_tree.query(_unit(np.asarray(src_sphere)[src_inds,:]))
+    return trg_inds, np.asarray(trg_vert)[trg_inds,:]
+
+def _unit(vert):
+    vert = np.asarray(vert, dtype=float)
+    norm = np.sqrt(np.sum(vert**2, axis=1))
+    norm[norm == 0] = 1.
+    return vert / norm[:,np.newaxis]
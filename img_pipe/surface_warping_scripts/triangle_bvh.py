@@ -0,0 +1,172 @@
+import numpy as np
+
+class TriangleBVH(object):
+    '''
+    Bounding volume hierarchy (BVH) of axis-aligned boxes over the triangles
+    of a mesh, used to avoid testing every triangle when intersecting lines
+    with the mesh (see TriangleRayIntersectionBVH in
+    project_electrodes_anydirection.py).
+
+    The tree is built top-down by splitting each node's triangles at the
+    median centroid along the longest axis, until a node holds at most
+    [leaf_size] triangles. Nodes are stored in flat arrays so the tree can
+    be pickled (e.g. into the mesh cache) and queried without recursion.
+
+     Inputs: vert:       [nvertices x 3] vertex coordinates
+             tri:        [ntriangles x 3] zero-indexed triangle vertex indices
+             leaf_size:  maximum number of triangles in a leaf node
+
+     Attributes: node_min, node_max: [nnodes x 3] box corners
+                 node_left, node_right: child node indices (-1 for leaves)
+                 node_start, node_count: range of [order] held by each leaf
+                 order: triangle indices, grouped by leaf
+    '''
+
+    def __init__(self, vert, tri, leaf_size=16):
+        vert = np.asarray(vert, dtype=float)
+        tri = np.asarray(tri, dtype=int)
+        v0, v1, v2 = vert[tri[:,0],:], vert[tri[:,1],:], vert[tri[:,2],:]
+        tri_min = np.minimum(np.minimum(v0, v1), v2)
+        tri_max = np.maximum(np.maximum(v0, v1), v2)
+        centroids = (v0 + v1 + v2)/3.
+
+        # Pad the boxes slightly so triangles lying in a box face are still found
+        pad = 1e-6*max(1., np.abs(vert).max()) if vert.size else 0.
+        tri_min = tri_min - pad
+        tri_max = tri_max + pad
+
+        ntri = tri.shape[0]
+        self.leaf_size = leaf_size
+        self.ntri = ntri
+        order = np.arange(ntri)
+
+        # Build the tree one level at a time. The nodes of a level partition
+        # [order] into contiguous segments, and nodes with more than
+        # [leaf_size] triangles are split in two at the median.
+        level_nodes = np.array([0])
+        level_start = np.array([0])
+        level_count = np.array([ntri])
+        node_left, node_right = [np.array([-1])], [np.array([-1])]
+        node_start, node_count = [level_start], [level_count]
+        levels = [level_nodes]
+        nnodes = 1
+        while ntri > 0 and np.any(level_count > leaf_size):
+            # Sort the triangles of each segment along its longest centroid axis
+            c = centroids[order,:]
+            cmin = np.minimum.reduceat(c, level_start, axis=0)
+            cmax = np.maximum.reduceat(c, level_start, axis=0)
+            axis = np.argmax(cmax - cmin, axis=1)
+            segment = np.repeat(np.arange(level_start.shape[0]), level_count)
+            lo = cmin[segment, axis[segment]]
+            extent = (cmax - cmin)[segment, axis[segment]]
+            # Scale the keys to [0, 0.5] within each segment and offset them
+            # by the segment number, so one sort orders every segment at once
+            key = segment + 0.5*(c[np.arange(ntri), axis[segment]] - lo)/np.maximum(extent, 1e-12)
+            order = order[np.argsort(key)]
+
+            split = level_count > leaf_size
+            nsplit = np.sum(split)
+            mid = level_count[split]//2
+            left = nnodes + 2*np.arange(nsplit)
+            right = left + 1
+            node_left[-1] = node_left[-1].copy()
+            node_right[-1] = node_right[-1].copy()
+            node_left[-1][split] = left
+            node_right[-1][split] = right
+            nnodes += 2*nsplit
+
+            # Children, interleaved as left0, right0, left1, right1, ...
+            level_nodes = np.vstack((left, right)).T.ravel()
+            level_start = np.vstack((level_start[split], level_start[split]+mid)).T.ravel()
+            level_count = np.vstack((mid, level_count[split]-mid)).T.ravel()
+            levels.append(level_nodes)
+            node_left.append(-np.ones(level_nodes.shape, dtype=int))
+            node_right.append(-np.ones(level_nodes.shape, dtype=int))
+            node_start.append(level_start)
+            node_count.append(level_count)
+
+        # Node ids were assigned level by level, so concatenating the levels
+        # gives arrays indexed by node id
+        self.order = order
+        self.node_left = np.hstack(node_left).astype(int)
+        self.node_right = np.hstack(node_right).astype(int)
+        self.node_start = np.hstack(node_start).astype(int)
+        self.node_count = np.hstack(node_count).astype(int)
+
+        # Boxes of the leaves come straight from their triangles, then each
+        # level of inner nodes gets the union of its children's boxes
+        self.node_min = np.zeros((nnodes, 3))
+        self.node_max = -np.ones((nnodes, 3))
+        leaf = np.where((self.node_left < 0) & (self.node_count > 0))[0]
+        if leaf.shape[0] > 0:
+            leaf = leaf[np.argsort(self.node_start[leaf])]
+            self.node_min[leaf,:] = np.minimum.reduceat(tri_min[order,:], self.node_start[leaf], axis=0)
+            self.node_max[leaf,:] = np.maximum.reduceat(tri_max[order,:], self.node_start[leaf], axis=0)
+        for level_nodes in levels[::-1]:
+            inner = level_nodes[self.node_left[level_nodes] >= 0]
+            self.node_min[inner,:] = np.minimum(self.node_min[self.node_left[inner],:],
+                                                self.node_min[self.node_right[inner],:])
+            self.node_max[inner,:] = np.maximum(self.node_max[self.node_left[inner],:],
+                                                self.node_max[self.node_right[inner],:])
+
+    def _line_hits_boxes(self, orig, direction, nodes):
+        ''' Whether the infinite lines through [orig] along [direction]
+        cross the boxes of [nodes] (slab test, one line per node).'''
+        bmin = self.node_min[nodes,:]
+        bmax = self.node_max[nodes,:]
+        tlo = -np.inf + np.zeros((len(nodes),))
+        thi = np.inf + np.zeros((len(nodes),))
+        inside = np.ones((len(nodes),), dtype=bool)
+        for k in range(3):
+            if direction[k] == 0:
+                # Parallel to this slab, so the origin must lie within it
+                inside &= (orig[:,k] >= bmin[:,k]) & (orig[:,k] <= bmax[:,k])
+            else:
+                t1 = (bmin[:,k] - orig[:,k])/direction[k]
+                t2 = (bmax[:,k] - orig[:,k])/direction[k]
+                tlo = np.maximum(tlo, np.minimum(t1, t2))
+                thi = np.minimum(thi, np.maximum(t1, t2))
+        return inside & (tlo <= thi)
+
+    def query_line(self, orig, direction):
+        '''
+        Find the candidate triangles for lines through each point of [orig]
+        along [direction]. The lines extend in both directions, matching
+        TriangleRayIntersection, which reports intersections behind the
+        origin as well.
+
+         Inputs: orig:       [nrays x 3] points on each line
+                 direction:  length 3 direction shared by all lines
+
+         Output: ray_inds:   indices into [orig]
+                 tri_inds:   triangle indices, one per entry of [ray_inds]
+        '''
+        orig = np.atleast_2d(np.asarray(orig, dtype=float))
+        direction = np.asarray(direction, dtype=float).ravel()
+
+        # Traverse all rays through the tree together, one level at a time
+        rays = np.arange(orig.shape[0])
+        nodes = np.zeros(rays.shape, dtype=int)
+        ray_inds, tri_inds = [], []
+        with np.errstate(invalid='ignore'):
+            while rays.size > 0:
+                hit = self._line_hits_boxes(orig[rays,:], direction, nodes)
+                rays, nodes = rays[hit], nodes[hit]
+
+                leaf = self.node_left[nodes] < 0
+                if np.any(leaf):
+                    counts = self.node_count[nodes[leaf]]
+                    starts = self.node_start[nodes[leaf]]
+                    # Concatenate the [start, start+count) ranges of all hit leaves
+                    offsets = np.cumsum(counts) - counts
+                    positions = np.repeat(starts - offsets, counts) + np.arange(counts.sum())
+                    ray_inds.append(np.repeat(rays[leaf], counts))
+                    tri_inds.append(self.order[positions])
+
+                inner = np.invert(leaf)
+                rays = np.hstack((rays[inner], rays[inner]))
+                nodes = np.hstack((self.node_left[nodes[inner]], self.node_right[nodes[inner]]))
+
+        if len(ray_inds) == 0:
+            return np.array([], dtype=int), np.array([], dtype=int)
+        return np.hstack(ray_inds), np.hstack(tri_inds)
@@ -0,0 +1,144 @@
+# volume_io.py
+''' This module contains a shared loader for image volumes (segmentations
+ such as aparc+aseg.mgz, the T1 and the co-registered CT).  Uncompressed
+ volumes (.nii, .mgh) are memory-mapped through nibabel's array proxies, so
+ slicing a volume or looking up a few voxels only pages in the data that is
+ needed.  Compressed volumes (.mgz, .nii.gz) cannot be mapped: the first
+ access reads and decompresses the whole file, which is then kept in memory.
+ This includes FreeSurfer's aparc+aseg.mgz and the CVS warps, so for these
+ Volume saves repeated reads and memory (see below) but not the full read.
+ Segmentation volumes are kept in a compact integer type (int16 when the
+ labels fit) instead of the on-disk int32 or float.
+
+ This module has no relative imports so it can also be used by the scripts
+ in SupplementalScripts, which add the img_pipe directory to sys.path.
+
+ usage: aparc = Volume('/path/to/mri/aparc+aseg.mgz', segmentation=True)
+        labels = aparc.get_voxels(VoxCRS)
+        axial = aparc[:, :, 128]
+
+'''
+
+import numpy as np
+import nibabel as nib
+
+def compact_labels(data):
+    ''' Cast a segmentation (label) array to the smallest of int16 or int32
+    that holds all of its labels. Arrays that are already 8 or 16 bit
+    integers are returned unchanged.
+
+    Parameters
+    ----------
+    data : array-like
+        Array of integer labels (possibly stored as float)
+
+    Returns
+    -------
+    data : array-like
+        The same labels as int16 (or int32 if they do not fit)
+    '''
+    data = np.asarray(data)
+    if data.dtype.kind in 'iu' and data.dtype.itemsize <= 2:
+        return data
+    if data.dtype.kind == 'f':
+        data = np.rint(data)
+    info = np.iinfo(np.int16)
+    if data.size == 0 or (data.min() >= info.min and data.max() <= info.max):
+        return data.astype(np.int16)
+    return data.astype(np.int32)
+
+class Volume(object):
+    ''' Lazily loaded image volume.
+
+    Parameters
+    ----------
+    fname : str
+        Path to a volume that nibabel can read (.mgz, .mgh, .nii, .nii.gz, ...)
+    segmentation : bool, optional
+        Whether the volume holds integer labels, which are then returned as
+        int16/int32 (see compact_labels)
+    mmap : bool, optional
+        Whether to memory-map uncompressed volumes (default: True)
+
+    Attributes
+    ----------
+    img : nibabel image
+    shape : tuple
+    affine : array-like
+        [4 x 4] voxel to RAS transform of the image
+    mmapped : bool
+        Whether voxels are read from disk on demand. False for compressed
+        volumes, which are read whole on first access
+    '''
+
+    def __init__(self, fname, segmentation=False, mmap=True):
+        self.fname = fname
+        self.segmentation = segmentation
+        compressed = fname.endswith('.gz') or fname.endswith('.mgz')
+        self.mmapped = mmap and not compressed
+        if self.mmapped:
+            # Copy-on-write, so modifying a returned array never writes to the file
+            self.img = nib.load(fname, mmap='c')
+        else:
+            self.img = nib.load(fname)
+        self.shape = self.img.shape
+        self.affine = self.img.affine
+        self._data = None
+
+    def _cast(self, data):
+        if self.segmentation:
+            return compact_labels(data)
+        return data
+
+    def _array(self):
+        ''' The whole volume in memory, for volumes that cannot be mapped.'''
+        if self._data is None:
+            self._data = self._cast(np.asanyarray(self.img.dataobj))
+        return self._data
+
+    def get_data(self):
+        ''' The whole volume. For memory-mapped volumes stored without
+        scaling this is a memory map, so voxels are still only read when used.'''
+        if not self.mmapped:
+            return self._array()
+        return self._cast(np.asanyarray(self.img.dataobj))
+
+    def __getitem__(self, key):
+        ''' Basic (slice and integer) indexing, reading only the requested voxels.'''
+        if not self.mmapped:
+            return self._array()[key]
+        data = self._cast(np.asarray(self.img.dataobj[key]))
+        if data.ndim == 0:
+            # A single voxel, return it as a scalar like numpy does
+            return data[()]
+        return data
+
+    def get_voxels(self, crs):
+        ''' Values at integer voxel coordinates.  Only the bounding box of the
+        requested voxels is read.
+
+        Parameters
+        ----------
+        crs : array-like
+            [npoints x 3] voxel column, row, slice indices inside the volume
+
+        Returns
+        -------
+        values : array-like
+            [npoints] voxel values
+        '''
+        crs = np.atleast_2d(np.asarray(crs, dtype=int))
+        if crs.shape[0] == 0:
+            return self._cast(np.zeros((0,), dtype=self.img.get_data_dtype()))
+        if not self.mmapped:
+            return self._array()[crs[:,0], crs[:,1], crs[:,2]]
+        lo = crs.min(axis=0)
+        hi = crs.max(axis=0) + 1
+        box = self[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+        return box[crs[:,0]-lo[0], crs[:,1]-lo[1], crs[:,2]-lo[2]]
+
+    def max(self, block=16):
+        ''' Maximum value of the volume, read [block] slices at a time.'''
+        if not self.mmapped:
+            return self._array().max()
+        return max([self[:, :, z:z+block].max() for z in range(0, self.shape[2], block)])
@@ -24,3 +24,178 @@ mlab.test_mesh()
 # Test import of plotting
 import img_pipe.plotting as plotting
 import img_pipe.SupplementalScripts
+
+# Test the spherical registration surface warp on synthetic spheres
+import numpy as np
+from img_pipe.surface_warping_scripts.sphere_warp import sphere_surface_warp
+
+rng = np.random.RandomState(0)
+src_sphere = rng.randn(500, 3)
+src_sphere = 100*src_sphere/np.sqrt(np.sum(src_sphere**2, axis=1))[:, np.newaxis]
+order = rng.permutation(500)
+trg_sphere = 1.05*src_sphere[order, :]
+trg_pial = 0.7*trg_sphere
+src_inds = np.arange(0, 500, 7)
+trg_inds, elecs_warped = sphere_surface_warp(src_inds, src_sphere, trg_sphere, trg_pial)
+assert np.all(order[trg_inds] == src_inds)
+assert np.allclose(elecs_warped, 0.7*1.05*src_sphere[src_inds, :])
+
+# Test that the electrode loop, the brute-force batch and the BVH ray casts
+# find the same intersections with a convex hull
+import scipy.spatial
+from img_pipe.surface_warping_scripts.project_electrodes_anydirection import project_electrodes_anydirection, \
+    TriangleRayIntersectionBatch, BVH_MIN_TRIANGLES
+
+elecs = np.hstack((150*np.ones((30, 1)), rng.uniform(-60, 60, (30, 2))))
+elecs[0, :] = [150, 200, 200] # misses the mesh
+for npoints in [200, 3000]:
+    hull_verts = rng.randn(npoints, 3)
+    hull_verts = 100*hull_verts/np.sqrt(np.sum(hull_verts**2, axis=1))[:, np.newaxis]
+    hull_tri = scipy.spatial.ConvexHull(hull_verts).simplices
+    assert (hull_tri.shape[0] >= BVH_MIN_TRIANGLES) == (npoints == 3000)
+    elecs_loop = project_electrodes_anydirection(hull_tri, hull_verts, elecs, 'rh', batch=False)
+    elecs_batch = project_electrodes_anydirection(hull_tri, hull_verts, elecs, 'rh', max_bytes=2**16)
+    _, elecs_brute, _ = TriangleRayIntersectionBatch(elecs, [-1000, 0, 0], hull_verts[hull_tri[:, 0], :],
+                                                     hull_verts[hull_tri[:, 1], :], hull_verts[hull_tri[:, 2], :])
+    assert np.all(np.isnan(elecs_loop[0, :]))
+    assert np.allclose(elecs_batch, elecs_loop, equal_nan=True)
+    assert np.allclose(elecs_brute, elecs_loop, equal_nan=True)
+
+# A subject directory with synthetic data for the tests below
+import tempfile
+import scipy.io
+import nibabel as nib
+test_dir = tempfile.mkdtemp()
+for subdir in ['mri', 'label', 'Meshes', 'CT', 'elecs']:
+    os.makedirs(os.path.join(test_dir, 'S2', subdir))
+with open(os.path.join(test_dir, 'FreeSurferColorLUT.txt'), 'w') as fid:
+    fid.write('#No. Label Name:  R   G   B   A\n\n0  Unknown  0 0 0 0\n2  Left-Cerebral-White-Matter  245 245 245 0\n'
+              '17  Left-Hippocampus  220 216 20 0\n41  Right-Cerebral-White-Matter  245 245 245 0\n')
+
+# Test depth electrode labeling against the single voxel lookup, and the
+# neighborhood vote on a one voxel thick slab of another label
+aseg = 2*np.ones((256, 256, 256), dtype=np.int16)
+aseg[100:156, 100:156, 100:156] = rng.choice([0, 2, 17, 41, 53], (56, 56, 56))
+aseg[40, :, :] = 41
+nib.save(nib.MGHImage(aseg, np.eye(4)), os.path.join(test_dir, 'S2', 'mri', 'aparc.a2009s+aseg.mgz'))
+depth_patient = img_pipe.freeCoG(subj='S2', hem='lh', subj_dir=test_dir, fs_dir=test_dir)
+depth_elecs = rng.uniform(-20, 20, (40, 3))
+anatomy, label_dist = depth_patient.label_depth_elecs(depth_elecs)
+lut = {0: 'Unknown', 2: 'Left-Cerebral-White-Matter', 17: 'Left-Hippocampus', 41: 'Right-Cerebral-White-Matter'}
+crs = np.column_stack((128 - depth_elecs[:, 0], 128 - depth_elecs[:, 2], depth_elecs[:, 1] + 128)).astype(int)
+assert list(anatomy) == [lut.get(l, 'Unknown') for l in aseg[crs[:, 0], crs[:, 1], crs[:, 2]]]
+assert all([d == [(a, 1.0)] for a, d in zip(anatomy, label_dist)])
+slab_elec = [[128 - 40, -98, 98]]
+assert depth_patient.label_depth_elecs(slab_elec)[0][0] == 'Right-Cerebral-White-Matter'
+anatomy, label_dist = depth_patient.label_depth_elecs(slab_elec, radius=2)
+assert anatomy[0] == 'Left-Cerebral-White-Matter'
+assert label_dist[0] == [('Left-Cerebral-White-Matter', 20/33.), ('Right-Cerebral-White-Matter', 13/33.)]
+
+# Test the outer surface mask against the per-slice float64 computation it
+# replaced, and that cropping to the filled voxels does not change the surface
+from scipy.signal import convolve
+from scipy.ndimage import grey_closing, generate_binary_structure
+from img_pipe.surface_warping_scripts.make_outer_surf import outer_surf_mask, outer_surf_from_fill, \
+    conformed_vox2ras_tkr
+from mcubes import marching_cubes
+
+xx, yy, zz = np.mgrid[:64, :64, :64]
+filld = ((xx - 30)**2 + (yy - 34)**2 + (zz - 32)**2 <= 20**2).astype(np.uint8)
+filld[30, 20:50, 20:40] = 0 # a groove for the closing to fill
+image_f = np.zeros(filld.shape)
+for s in range(filld.shape[2]):
+    image_f[:, :, s] = convolve(np.where(filld[:, :, s] == 1, 255, 0), np.ones((2, 2))*.25, 'same')
+image2 = np.where(image_f > 25, 255., 0.)
+BW2 = grey_closing(image2, structure=generate_binary_structure(3, 1))
+BW2 = np.where(BW2 > np.max(BW2)/2, 255, 0)
+assert np.array_equal(outer_surf_mask(filld), BW2)
+
+vox2ras = conformed_vox2ras_tkr(filld.shape)
+v, f = outer_surf_from_fill(filld, vox2ras)
+v_full, f_full = marching_cubes(outer_surf_mask(filld), 100)
+assert np.allclose(v, nib.affines.apply_affine(vox2ras, v_full)) and np.array_equal(f, f_full)
+try:
+    outer_surf_from_fill(np.zeros((8, 8, 8)), vox2ras)
+    assert False, 'An empty fill should raise ValueError'
+except ValueError:
+    pass
+
+# Test the ROI meshes against the set-intersection and dictionary
+# reindexing they replaced, using the large convex hull above as the pial surface
+def old_roi_mesh(vert, tri, vertnums):
+    vertnums = sorted(vertnums)
+    tri_row_inds = np.sort(np.array(list(set(np.where(np.isin(tri[:, 0], vertnums))[0]) &
+                                         set(np.where(np.isin(tri[:, 1], vertnums))[0]) &
+                                         set(np.where(np.isin(tri[:, 2], vertnums))[0])), dtype=int))
+    tri_list = tri[tri_row_inds, :]
+    tri_list_reindexed = np.copy(tri_list)
+    for k, v in dict([(vertnums[i], i) for i in range(len(vertnums))]).items():
+        tri_list_reindexed[tri_list == k] = v
+    return vert[vertnums, :], tri_list_reindexed
+
+pial_vert, pial_tri = hull_verts, hull_tri.astype(np.int32)
+scipy.io.savemat(os.path.join(test_dir, 'S2', 'Meshes', 'lh_pial_trivert.mat'), {'tri': pial_tri, 'vert': pial_vert})
+vert_labels = (pial_vert[:, 0] > 0) + 2*(pial_vert[:, 2] > 0)
+vert_labels[np.abs(pial_vert[:, 1]) > 80] = -1
+label_names = ['frontal', 'parietal', 'temporal', 'occipital']
+os.makedirs(os.path.join(test_dir, 'S2', 'label', 'gyri'))
+for i, name in enumerate(label_names):
+    label_verts = np.where(vert_labels == i)[0]
+    with open(os.path.join(test_dir, 'S2', 'label', 'gyri', 'lh.%s.label'%(name)), 'w') as fid:
+        fid.write('#!ascii label\n%d\n'%(label_verts.shape[0]))
+        for v in label_verts:
+            fid.write('%d %f %f %f 0.000000\n'%(v, pial_vert[v, 0], pial_vert[v, 1], pial_vert[v, 2]))
+
+surf_patient = img_pipe.freeCoG(subj='S2', hem='lh', subj_dir=test_dir, fs_dir=test_dir)
+rois = {'front': ['frontal', 'temporal'], 'back': ['occipital'], 'all': label_names}
+roi_meshes = surf_patient.make_roi_meshes(rois, save=False)
+for roi_name, label_list in rois.items():
+    old_vert, old_tri = old_roi_mesh(pial_vert, pial_tri, np.where(np.isin(vert_labels, [label_names.index(l) for l in label_list]))[0])
+    assert np.array_equal(roi_meshes[roi_name]['vert'], old_vert) and np.array_equal(roi_meshes[roi_name]['tri'], old_tri)
+
+# Test splitting the surface by its annotation against the ROI meshes of each label
+ctab = np.array([[20*i, 50, 100, 0, 0] for i in range(len(label_names))])
+nib.freesurfer.write_annot(os.path.join(test_dir, 'S2', 'label', 'lh.aparc.annot'), vert_labels, ctab, label_names)
+split_meshes = surf_patient.split_surface_rois()
+assert sorted(split_meshes.keys()) == sorted(label_names)
+for i, name in enumerate(label_names):
+    old_vert, old_tri = old_roi_mesh(pial_vert, pial_tri, np.where(vert_labels == i)[0])
+    assert np.array_equal(split_meshes[name]['vert'], old_vert) and np.array_equal(split_meshes[name]['tri'], old_tri)
+
+# Test electrode candidate detection on a CT with two bright blobs, a large
+# bright block (bone) and a single bright voxel, and when saved candidates are reused
+from img_pipe import electrode_candidates
+
+ct = np.zeros((48, 48, 48), dtype=np.int16)
+ct[9:12, 11:14, 13:16] = 2000
+ct[30:32, 30:32, 30:32] = 3000
+ct[36:46, 2:12, 2:12] = 1500
+ct[5, 40, 40] = 4000
+ct_affine = np.diag([0.5, 0.5, 0.5, 1.])
+ct_affine[:3, 3] = [-10, -20, -30]
+candidates = electrode_candidates.detect_candidates(ct, ct_affine)
+assert np.allclose(candidates['vox'], [[10, 12, 14], [30.5, 30.5, 30.5]])
+assert np.allclose(candidates['ras'], 0.5*candidates['vox'] + [-10, -20, -30])
+assert np.array_equal(candidates['n_voxels'], [27, 8]) and np.allclose(candidates['volume'], [27/8., 1.])
+assert np.allclose(candidates['max_intensity'], [2000, 3000]) and np.allclose(candidates['mean_intensity'], [2000, 3000])
+
+ct_file = os.path.join(test_dir, 'S2', 'CT', 'rCT.nii')
+nib.save(nib.Nifti1Image(ct, ct_affine), ct_file)
+cand_file = electrode_candidates.candidates_file(ct_file)
+assert cand_file == os.path.join(test_dir, 'S2', 'CT', 'rCT_candidates.mat')
+candidates = electrode_candidates.load_candidates(ct_file)
+assert os.path.isfile(cand_file) and candidates['vox'].shape == (2, 3)
+# Saved candidates are reused for the same parameters, even if the file changed
+saved = scipy.io.loadmat(cand_file)
+saved['vox'] = saved['vox'][:1, :]
+scipy.io.savemat(cand_file, saved)
+assert electrode_candidates.load_candidates(ct_file)['vox'].shape == (1, 3)
+# New parameters detect them again, unless any parameters will do
+assert np.allclose(electrode_candidates.load_candidates(ct_file, threshold=2500)['vox'], [[30.5, 30.5, 30.5]])
+assert np.allclose(electrode_candidates.load_candidates(ct_file, any_params=True)['vox'], [[30.5, 30.5, 30.5]])
+assert electrode_candidates.load_candidates(ct_file, threshold=2500, force=True)['vox'].shape == (1, 3)
+# A CT newer than the saved candidates is detected again
+ct[20:22, 20:22, 20:22] = 3000
+nib.save(nib.Nifti1Image(ct, ct_affine), ct_file)
+os.utime(ct_file, (os.path.getmtime(cand_file) + 10, os.path.getmtime(cand_file) + 10))
+assert electrode_candidates.load_candidates(ct_file, threshold=2500)['vox'].shape == (2, 3)